@@ -1,56 +1,237 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Header
 import uvicorn
-import pickle
 from fastapi.staticfiles import StaticFiles
-from message import Message
-import torch
-from pathlib import Path
-import subprocess
-from fastapi.responses import FileResponse
-
-app = FastAPI()
+from message import Message, BatchMessage
+import os
+from contextlib import asynccontextmanager
+from fastapi.responses import FileResponse, JSONResponse, Response
+from serving.batcher import MicroBatcher
+from serving.model_store import ModelStore
+from serving.result_cache import ResultCache
+from serving.cascade import Cascade, parse_band
+from serving import telemetry
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import random
+import time
+
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "32"))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", "5"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "50000"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "100000"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_NORMALIZE = os.getenv("RESULT_CACHE_NORMALIZE", "0") == "1"
+SERVING_BACKEND = os.getenv("SERVING_BACKEND", "torch")
+MODEL_WATCH_INTERVAL = float(os.getenv("MODEL_WATCH_INTERVAL", "30"))
+MAX_LOADED_VERSIONS = int(os.getenv("MAX_LOADED_VERSIONS", "2"))
+SHADOW_PERCENT = float(os.getenv("SHADOW_PERCENT", "0"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+CASCADE = os.getenv("CASCADE", "0") == "1"
+CASCADE_BAND = parse_band(os.getenv("CASCADE_BAND", "0.05,0.95"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+# Base weights (hub name or local directory) that adapter bundles are merged into when loaded. An image built
+# with BAKE_BASE_MODEL sets it to its baked-in copy; unset, an adapter bundle downloads the base it was trained on from the hub
+BASE_MODEL = os.getenv("BASE_MODEL")
+
+store = ModelStore(backend=SERVING_BACKEND, token_cache_size=TOKEN_CACHE_SIZE,
+                   watch_interval=MODEL_WATCH_INTERVAL, max_versions=MAX_LOADED_VERSIONS, base_model=BASE_MODEL,
+                   prefilter=CASCADE)
+shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+# Every result carries the version that scored it, which can differ from the active one when the request was queued
+batcher = MicroBatcher(store.predict_versioned, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS)
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_NORMALIZE) if RESULT_CACHE_SIZE else None
+# The prefilter answers confident messages itself and only escalates the ones inside CASCADE_BAND to the batcher.
+# Every model version brings the prefilter saved in its bundle
+cascade = Cascade(band=CASCADE_BAND) if CASCADE else None
+telemetry.register(telemetry.StatsCollector(store, result_cache, cascade))
+request_log = telemetry.SampledLogger(telemetry.request_logger, LOG_SAMPLE_RATE, SLOW_REQUEST_MS)
+
+
+@asynccontextmanager
+async def lifespan(app : FastAPI):
+    await batcher.start()
+    store.start()
+    yield
+    await batcher.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-model_path = Path("saved_model") / "model.pkl"
-
-if not model_path.exists():
-    print("Model not found locally...pulling it from DVC")
-    subprocess.run(["dvc","pull",str(model_path)], check=True)
-
-
-model_data = torch.load(model_path, map_location=torch.device("cpu"), weights_only=False)
-
-
-model = model_data['model']
-tokenizer = model_data['tokenizer']
+def active_model():
+    if not store.ready:
+        raise HTTPException(status_code=503, detail=f"Model is not ready (status: {store.status})")
+    return store.active
+
+async def infer(texts : List[str], model) -> Tuple[List[float], Optional[str]]:
+    """
+    Probabilities plus the model version that produced them: `model`'s version when its prefilter
+    answered everything, None when the texts were split across a swap of the active model.
+    """
+    versions = set()
+
+    async def model_proba(model_texts : List[str]) -> List[float]:
+        results = await batcher.submit_many(model_texts)
+        versions.update(version for version, _ in results)
+        return [prob for _, prob in results]
+
+    if cascade is None:
+        probs = await model_proba(texts)
+    else:
+        probs = await cascade.predict_proba(texts, model_proba, model.prefilter)
+
+    if not versions:
+        return probs, model.version
+    return probs, versions.pop() if len(versions) == 1 else None
+
+async def score(texts : List[str], model) -> List[float]:
+    "Answers repeated messages from the result cache and sends only the rest to the model."
+    if result_cache is None:
+        return (await infer(texts, model))[0]
+
+    probs = [result_cache.get(text, model.version) for text in texts]
+    missing = [i for i, prob in enumerate(probs) if prob is None]
+    telemetry.RESULT_CACHE.labels("hit").inc(len(texts) - len(missing))
+    telemetry.RESULT_CACHE.labels("miss").inc(len(missing))
+
+    if missing:
+        unique = list(dict.fromkeys(texts[i] for i in missing))
+        unique_probs, scored_version = await infer(unique, model)
+        scored = dict(zip(unique, unique_probs))
+        # Cached under the version that scored them, and not at all if a swap split them across two
+        if scored_version is not None:
+            for text, prob in scored.items():
+                result_cache.put(text, scored_version, prob)
+        for i in missing:
+            probs[i] = scored[texts[i]]
+
+    return probs
+
+async def shadow_score(texts : List[str], probs : List[float], active, active_seconds : float):
+    "Scores the same texts with the candidate version after the response has been sent."
+    candidate = store.candidate
+    if candidate is None:
+        return
+
+    start = time.perf_counter()
+    candidate_probs = await asyncio.get_running_loop().run_in_executor(
+        shadow_executor, candidate.predictor.predict_proba, texts)
+    candidate_seconds = time.perf_counter() - start
+
+    # Each version labels with its own threshold
+    active_threshold, candidate_threshold = active.predictor.threshold, candidate.predictor.threshold
+    agreements = sum((a >= active_threshold) == (b >= candidate_threshold) for a, b in zip(probs, candidate_probs))
+    store.shadow_stats.record(active_seconds, candidate_seconds, agreements, len(texts))
+
+async def score_with_shadow(texts : List[str], model, background_tasks : BackgroundTasks) -> List[float]:
+    start = time.perf_counter()
+    probs = await score(texts, model)
+
+    if store.candidate is not None and random.uniform(0, 100) < SHADOW_PERCENT:
+        background_tasks.add_task(shadow_score, texts, probs, model, time.perf_counter() - start)
+
+    return probs
+
+def check_admin(x_admin_token : Optional[str] = Header(default=None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+@app.get("/ready")
+def readiness():
+    content = {"ready": store.ready, "status": store.status, "pid": os.getpid()}
+    if not store.ready:
+        return JSONResponse(status_code=503, content={**content, "error": store.error})
+    return {**content, "model_version": store.active.version, "backend": store.active.backend}
 
 @app.get("/")
 def home():
     return FileResponse("static/index.html")
 
-@app.post("/predict")
-def predict(message: Message):
-    print("Predict endpoint was hit!")
-
-    device = torch.device("cpu")
-
-    model.to(device)
-
-    tokenized_input = tokenizer(message.message, return_tensors="pt").to(device)
-
-    with torch.no_grad():
-        output = model(**tokenized_input)  
+def record_request(endpoint : str, start : float, model, predictions : List[Tuple[str, bool]]):
+    "Metrics and the sampled log line of one request, from its (label, is_spam) response items."
+    elapsed = time.perf_counter() - start
+    telemetry.REQUEST_LATENCY.labels(endpoint).observe(elapsed)
+    for label, _ in predictions:
+        telemetry.PREDICTIONS.labels(model.version, label).inc()
+    request_log.log("predict", 1000 * elapsed, endpoint=endpoint, messages=len(predictions),
+                    model_version=model.version, spam=sum(spam for _, spam in predictions))
 
-    logits = output.logits
-    probs = torch.sigmoid(logits)
-    prediction = (probs >= 0.5).long().item()
-
-    if prediction == 1:
-        return {"prediction": "Spam message"}
-    else:
-        return {"prediction": "Valid message"}
+@app.post("/predict")
+async def predict(message: Message, background_tasks: BackgroundTasks):
+    start = time.perf_counter()
+    model = active_model()
+    prob = (await score_with_shadow([message.message], model, background_tasks))[0]
+
+    label = model.predictor.label(prob)
+    record_request("/predict", start, model, [(label, model.predictor.is_spam(prob))])
+    return {"prediction": label}
+
+@app.post("/predict/batch")
+async def predict_batch(batch: BatchMessage, background_tasks: BackgroundTasks):
+    start = time.perf_counter()
+    model = active_model()
+    probs = await score_with_shadow(batch.messages, model, background_tasks)
+
+    labels = [model.predictor.label(prob) for prob in probs]
+    record_request("/predict/batch", start, model, [(label, model.predictor.is_spam(prob))
+                                                    for label, prob in zip(labels, probs)])
+    return {"predictions": [{"prediction": label, "probability": prob} for label, prob in zip(labels, probs)]}
+
+@app.get("/metrics")
+def metrics():
+    content, content_type = telemetry.render()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/cache/stats")
+def cache_stats():
+    token_cache = store.active.token_cache if store.active else None
+    return {"token_cache": {"size": len(token_cache), **token_cache.stats.as_dict()} if token_cache else None,
+            "result_cache": result_cache.stats() if result_cache else None}
+
+@app.get("/cascade/stats")
+def cascade_stats():
+    if cascade is None:
+        raise HTTPException(status_code=404, detail="Cascade is disabled, set CASCADE=1 to enable it")
+    return {"band": [cascade.low, cascade.high], **cascade.stats.as_dict()}
+
+@app.get("/admin/models", dependencies=[Depends(check_admin)])
+def list_models():
+    return {"status": store.status, "versions": store.describe(),
+            "shadow_percent": SHADOW_PERCENT, "shadow": store.shadow_stats.as_dict()}
+
+@app.post("/admin/reload", dependencies=[Depends(check_admin)])
+def reload_model(activate: bool = True):
+    "Loads the bundle on disk (pulling it if its .dvc file changed) as the active or candidate version."
+    version = store.check_for_update(activate=activate)
+    return {"loaded": version, "versions": store.describe()}
+
+@app.post("/admin/models/{version}/activate", dependencies=[Depends(check_admin)])
+def activate_model(version: str):
+    try:
+        store.activate(version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Version {version} is not loaded")
+    return {"versions": store.describe()}
+
+@app.post("/admin/models/{version}/shadow", dependencies=[Depends(check_admin)])
+def shadow_model(version: str):
+    try:
+        store.set_candidate(version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Version {version} is not loaded")
+    return {"versions": store.describe()}
+
+@app.delete("/admin/shadow", dependencies=[Depends(check_admin)])
+def stop_shadow():
+    store.set_candidate(None)
+    return {"versions": store.describe()}
     
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
-
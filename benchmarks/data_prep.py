@@ -0,0 +1,131 @@
+"""
+Rows/sec and peak memory of the fused data_load.prepare_frame pass against the previous
+clean -> transform -> validation chain (a .copy() per step and duplicated() twice), on
+synthetic SMS-like corpora. Every run happens in a fresh interpreter, and its resident
+memory is sampled while the preparation runs, so imports and data generation do not count.
+
+    python -m benchmarks.data_prep --sizes 10000,1000000,10000000
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import click
+import numpy as np
+import pandas as pd
+
+SPAM_SHARE = 0.13
+WORDS = np.array(["free", "call", "now", "win", "prize", "ok", "see", "you", "later", "home",
+                  "txt", "claim", "love", "going", "today", "sorry", "meet", "cash", "reply", "stop"])
+
+
+def synthetic_corpus(rows : int, seed : int = 0) -> pd.DataFrame:
+    "About 10% duplicated rows and 0.1% missing messages, with the spam/ham mix of the real data."
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(0, int(rows * 0.9) or 1, rows)
+    words = WORDS[rng.integers(0, len(WORDS), (rows, 3))]
+    messages = pd.Series(words[:, 0]).str.cat([pd.Series(words[:, 1]), pd.Series(words[:, 2]),
+                                               pd.Series(ids.astype(str))], sep=" ")
+    messages[rng.random(rows) < 0.001] = None
+    labels = np.where(ids % 100 < SPAM_SHARE * 100, "spam", "ham")
+    return pd.DataFrame({"labels": labels, "Messages": messages})
+
+
+def legacy_prepare(data : pd.DataFrame, seed : int = 42) -> pd.DataFrame:
+    "The previous steps: clean, transform and validation's fixed 500-per-class sample, seeded here."
+    df = data.copy()
+    if df.isnull().sum().sum() != 0:
+        df.dropna(inplace=True)
+        df.reset_index(drop=True, inplace=True)
+    if df.duplicated().sum() != 0:
+        df.drop_duplicates(keep='first', inplace=True)
+        df.reset_index(drop=True, inplace=True)
+
+    df = df.copy()
+    label_map = {label: idx for idx, label in enumerate(sorted(df["labels"].unique()))}
+    df['labels'] = df['labels'].map(label_map)
+
+    df = df.copy()
+    df = df.copy()
+    majority = df[df['labels'] == 0]
+    minority = df[df['labels'] == 1]
+    pd.concat([majority, minority.sample(len(majority), replace=True, random_state=seed)]).reset_index(drop=True)
+    sample = pd.concat([majority.sample(500, random_state=seed), minority.sample(500, random_state=seed)])
+    return sample.reset_index(drop=True)
+
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRSS:
+    "Polls the resident set size in a background thread and keeps the maximum (Linux only)."
+
+    def __init__(self, interval : float = 0.002):
+        self.interval = interval
+        self.peak = self.start = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def run(implementation : str, rows : int, balance : str, queue):
+    logging.disable(logging.WARNING)
+    from steps.data_load import balance_frame, prepare_frame
+
+    data = synthetic_corpus(rows)
+
+    with PeakRSS() as memory:
+        start = time.perf_counter()
+        if implementation == "fused":
+            balance_frame(prepare_frame(data), balance=balance)
+        else:
+            legacy_prepare(data)
+        elapsed = time.perf_counter() - start
+
+    queue.put({"seconds": elapsed, "rows_per_sec": rows / elapsed, "peak_extra_mb": (memory.peak - memory.start) / 2**20})
+
+
+def measure(implementation : str, rows : int, balance : str):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=run, args=(implementation, rows, balance, queue))
+    process.start()
+    process.join()
+    # A non-zero exit code is usually the OOM killer at the larger sizes
+    return queue.get() if process.exitcode == 0 else None
+
+
+@click.command(help="Compare the fused data preparation pass with the previous per-step copies.")
+@click.option("--sizes", default="10000,1000000,10000000", help="Comma separated synthetic corpus sizes.")
+@click.option("--balance", default="fixed", help="Balancing strategy for the fused pass.")
+@click.option("--skip-legacy", is_flag=True, default=False, help="Only measure the fused pass.")
+def main(sizes, balance, skip_legacy):
+    implementations = ["fused"] if skip_legacy else ["legacy", "fused"]
+    for rows in [int(size) for size in sizes.split(",")]:
+        for implementation in implementations:
+            result = measure(implementation, rows, balance)
+            if result is None:
+                print(f"{rows:>10} {implementation:<7} failed (out of memory?)")
+                continue
+            print(f"{rows:>10} {implementation:<7} rows/sec={result['rows_per_sec']:12.0f}  "
+                  f"peak memory above the input={result['peak_extra_mb']:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
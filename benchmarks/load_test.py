@@ -0,0 +1,87 @@
+"""
+Load test of the pre-fork server: requests/sec and latency for every combination of
+worker count and torch threads per worker.
+
+    python -m benchmarks.load_test --workers 1,2,4 --threads 1,2 --duration 20
+"""
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+import click
+import httpx
+import numpy as np
+from benchmarks.micro_batching import load_messages
+
+
+def wait_until_ready(url : str, process : subprocess.Popen, timeout : float = 300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server at {url} did not become ready in {timeout}s")
+
+
+async def hammer(url : str, messages, concurrency : int, duration : float):
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def client(worker_id):
+        async with httpx.AsyncClient(base_url=url, timeout=30) as http:
+            i = worker_id
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await http.post("/predict", json={"message": messages[i % len(messages)]})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+                i += concurrency
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+@click.command(help="Measure requests/sec of the pre-fork server against worker and thread counts.")
+@click.option("--workers", default="1,2,4", help="Comma separated worker counts.")
+@click.option("--threads", default="1,2", help="Comma separated torch threads per worker.")
+@click.option("--port", default=8100, type=click.INT, help="Port the server under test binds.")
+@click.option("--concurrency", default=64, type=click.INT, help="Concurrent clients.")
+@click.option("--duration", default=20.0, type=click.FLOAT, help="Seconds of load per configuration.")
+@click.option("--data-path", default=str(Path("data") / "SMSSpamCollection"), help="Messages to send.")
+def main(workers, threads, port, concurrency, duration, data_path):
+    messages = load_messages(data_path, 5000)
+    url = f"http://127.0.0.1:{port}"
+    # Every message should reach the model, so the result cache is disabled for the test
+    env = {**os.environ, "RESULT_CACHE_SIZE": "0"}
+
+    print(f"{'workers':>7} {'threads':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for num_workers, num_threads in itertools.product(map(int, workers.split(",")), map(int, threads.split(","))):
+        process = subprocess.Popen([sys.executable, "-m", "serving.prefork", "--host", "127.0.0.1",
+                                    "--port", str(port), "--workers", str(num_workers),
+                                    "--threads", str(num_threads)],
+                                   env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_ready(url, process)
+            # /ready is answered by whichever worker accepts first, give the others time to warm up
+            time.sleep(2)
+            latencies, elapsed = asyncio.run(hammer(url, messages, concurrency, duration))
+        finally:
+            process.terminate()
+            process.wait()
+
+        latencies_ms = np.asarray(latencies) * 1000
+        print(f"{num_workers:>7} {num_threads:>7} {len(latencies) / elapsed:>9.1f} "
+              f"{np.percentile(latencies_ms, 50):>8.2f} {np.percentile(latencies_ms, 99):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares the old one-message-per-forward-pass path of /predict against the
+micro-batching engine, in process and without HTTP overhead.
+
+    python -m benchmarks.micro_batching --requests 2000 --concurrency 64
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import click
+import numpy as np
+from serving.model_store import load_model_data
+from serving.artifacts import BUNDLE_DIR
+from serving.inference import Predictor
+from serving.batcher import MicroBatcher
+
+
+def load_messages(data_path : str, count : int):
+    with open(data_path, encoding="utf-8") as f:
+        messages = [line.rstrip("\n").split("\t", 1)[-1] for line in f if line.strip()]
+    return [messages[i % len(messages)] for i in range(count)]
+
+
+def report(name : str, latencies, elapsed : float):
+    latencies_ms = np.asarray(latencies) * 1000
+    print(f"{name:<14} requests={len(latencies_ms):<6} "
+          f"p50={np.percentile(latencies_ms, 50):8.2f} ms  "
+          f"p99={np.percentile(latencies_ms, 99):8.2f} ms  "
+          f"throughput={len(latencies_ms) / elapsed:8.1f} req/s")
+
+
+def run_per_request(predictor : Predictor, messages, concurrency : int):
+    "The previous behaviour: every request runs its own forward pass in a threadpool worker."
+
+    def one(text):
+        start = time.perf_counter()
+        predictor.predict_proba([text])
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, messages))
+    return latencies, time.perf_counter() - start
+
+
+async def run_batched(predictor : Predictor, messages, concurrency : int, max_batch_size : int, max_wait_ms : float):
+    batcher = MicroBatcher(predictor.predict_proba, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    await batcher.start()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(text):
+        async with semaphore:
+            start = time.perf_counter()
+            await batcher.submit(text)
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(one(text) for text in messages))
+    elapsed = time.perf_counter() - start
+    await batcher.stop()
+    return latencies, elapsed
+
+
+@click.command(help="Benchmark per-request inference against dynamic micro-batching.")
+@click.option("--bundle-dir", default=str(BUNDLE_DIR), help="Saved model bundle to benchmark.")
+@click.option("--data-path", default=str(Path("data") / "SMSSpamCollection"), help="Messages to send.")
+@click.option("--requests", "num_requests", default=1000, type=click.INT, help="Total number of requests.")
+@click.option("--concurrency", default=32, type=click.INT, help="Number of concurrent clients.")
+@click.option("--max-batch-size", default=32, type=click.INT, help="Micro-batcher max batch size.")
+@click.option("--max-wait-ms", default=5.0, type=click.FLOAT, help="Micro-batcher max wait in ms.")
+def main(bundle_dir, data_path, num_requests, concurrency, max_batch_size, max_wait_ms):
+    model_data = load_model_data(bundle_dir)
+    predictor = Predictor(model_data["model"], model_data["tokenizer"])
+    messages = load_messages(data_path, num_requests)
+
+    # Warm up so neither path pays for lazy initialisation
+    predictor.predict_proba(messages[:max_batch_size])
+
+    report("per-request", *run_per_request(predictor, messages, concurrency))
+    report("micro-batched", *asyncio.run(run_batched(predictor, messages, concurrency, max_batch_size, max_wait_ms)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Padding ratio and training tokens/sec of the previous loaders (padding=True inside
+Dataset.map, plain shuffled batches) against length-bucketed dynamic padding.
+
+    python -m benchmarks.padding --max-batches 50
+"""
+import time
+from pathlib import Path
+import click
+import pandas as pd
+import torch
+from datasets import Dataset
+from torch.utils.data import DataLoader
+from transformers import BertConfig, BertForSequenceClassification, DataCollatorWithPadding
+from steps import bert_tokenizer
+from steps.sampler import LengthBucketBatchSampler
+
+COLUMNS = ["input_ids", "token_type_ids", "attention_mask", "labels"]
+
+
+def build_loaders(messages, batch_size : int):
+    tokenizer = bert_tokenizer.get_tokenizer()
+    collator = DataCollatorWithPadding(tokenizer=tokenizer)
+    dataset = Dataset.from_dict({"Messages": messages, "labels": [0] * len(messages)})
+
+    padded = dataset.map(lambda data: tokenizer(data['Messages'], truncation=True, padding=True, max_length=512),
+                         batched=True, remove_columns=["Messages"])
+    padded.set_format("torch", columns=COLUMNS)
+    before = DataLoader(padded, batch_size=batch_size, shuffle=True, collate_fn=collator)
+
+    dynamic = dataset.map(bert_tokenizer.tokenize_data, batched=True, remove_columns=["Messages"])
+    dynamic.set_format("torch", columns=COLUMNS)
+    sampler = LengthBucketBatchSampler(dynamic.with_format("numpy")["length"], batch_size)
+    after = DataLoader(dynamic, batch_sampler=sampler, collate_fn=collator)
+
+    return before, after
+
+
+def measure(model, loader, max_batches : int):
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+    loss_fun = torch.nn.BCEWithLogitsLoss()
+    real_tokens = padded_tokens = 0
+    model.train()
+
+    start = time.perf_counter()
+    for i, batch in enumerate(loader):
+        if i == max_batches:
+            break
+        real_tokens += int(batch['attention_mask'].sum())
+        padded_tokens += batch['attention_mask'].numel()
+
+        labels = batch['labels'].float()
+        logits = model(**batch).logits.squeeze(1)
+        loss = loss_fun(logits, labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    elapsed = time.perf_counter() - start
+    return 1 - real_tokens / padded_tokens, real_tokens / elapsed
+
+
+@click.command(help="Compare padding ratio and tokens/sec before and after length bucketing.")
+@click.option("--data-path", default=str(Path("data") / "SMSSpamCollection"), help="Dataset to tokenize.")
+@click.option("--batch-size", default=16, type=click.INT, help="Batch size for data loading.")
+@click.option("--max-batches", default=50, type=click.INT, help="Training steps measured per loader.")
+@click.option("--num-layers", default=2, type=click.INT, help="Encoder layers of the randomly initialised BERT.")
+def main(data_path, batch_size, max_batches, num_layers):
+    messages = pd.read_csv(data_path, sep='\t', names=['labels', 'Messages'])['Messages'].tolist()
+    before, after = build_loaders(messages, batch_size)
+
+    torch.manual_seed(42)
+    model = BertForSequenceClassification(BertConfig(num_hidden_layers=num_layers, num_labels=1))
+
+    for name, loader in [("padding=True", before), ("bucketed", after)]:
+        ratio, tokens_per_sec = measure(model, loader, max_batches)
+        print(f"{name:<14} padding_ratio={ratio:.3f}  tokens/sec={tokens_per_sec:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
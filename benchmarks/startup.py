@@ -0,0 +1,90 @@
+"""
+Cold start timings: how long importing the API and the pipeline steps takes in a fresh
+interpreter, and how long a server takes to bind its port and to report /ready.
+
+    python -m benchmarks.startup --output startup_times.json --max-ready-seconds 120
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import click
+import httpx
+
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+
+def import_time(module : str) -> float:
+    "Seconds to import `module` in a fresh interpreter, so earlier imports cannot hide its cost."
+    output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def server_times(port : int, timeout : float) -> dict:
+    url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    times = {}
+    try:
+        while time.perf_counter() - start < timeout and "ready_s" not in times:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                if "bind_s" not in times and httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                    times["bind_s"] = time.perf_counter() - start
+                if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                    times["ready_s"] = time.perf_counter() - start
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.05)
+    finally:
+        process.terminate()
+        process.wait()
+    return times
+
+
+def git_commit() -> str:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or "unknown"
+
+
+@click.command(help="Measure import and server startup times.")
+@click.option("--port", default=8200, type=click.INT, help="Port for the server under test.")
+@click.option("--timeout", default=600.0, type=click.FLOAT, help="Seconds to wait for /ready.")
+@click.option("--skip-server", is_flag=True, default=False, help="Only measure import times.")
+@click.option("--output", default=None, type=click.STRING, help="JSON file the result is appended to.")
+@click.option("--max-ready-seconds", default=None, type=click.FLOAT,
+              help="Fail when the server takes longer than this to report /ready.")
+def main(port, timeout, skip_server, output, max_ready_seconds):
+    result = {"commit": git_commit(),
+              "timestamp": datetime.now(timezone.utc).isoformat(),
+              "import_api_s": import_time("api"),
+              "import_steps_s": import_time("steps.bert_tokenizer, steps.data_load, steps.training, steps.evaluation")}
+    if not skip_server:
+        result.update(server_times(port, timeout))
+
+    print(json.dumps(result, indent=2))
+
+    if output:
+        path = Path(output)
+        history = json.loads(path.read_text()) if path.exists() else []
+        history.append(result)
+        path.write_text(json.dumps(history, indent=2))
+
+    if skip_server:
+        return
+    if "ready_s" not in result:
+        print(f"Server did not report /ready within {timeout:.0f}s")
+        sys.exit(1)
+    if max_ready_seconds is not None and result["ready_s"] > max_ready_seconds:
+        print(f"Server took {result['ready_s']:.1f}s to report /ready, more than the {max_ready_seconds:.0f}s budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
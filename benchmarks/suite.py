@@ -0,0 +1,314 @@
+"""
+Offline performance suite with a regression gate. Measures, on data/SMSSpamCollection and
+synthetic scaled-up corpora:
+
+    ingestion rows/sec (steps.ingest_data), tokenization throughput, training samples/sec
+    (steps.training.fit on a tiny randomly initialized BERT), evaluation throughput and
+    /predict latency through an in-process ASGI client
+
+Every random choice is seeded and torch runs with a fixed thread count, so two runs on the
+same machine are comparable. Nothing is downloaded or written outside a temporary directory
+except the results file.
+
+    python -m benchmarks.suite run --output benchmarks/baseline.json
+    python -m benchmarks.suite run --output current.json
+    python -m benchmarks.suite compare benchmarks/baseline.json current.json --threshold 0.1
+"""
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import click
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+TINY_CONFIG = {"hidden_size": 64, "num_hidden_layers": 2, "num_attention_heads": 2,
+               "intermediate_size": 128, "max_position_embeddings": 512}
+
+
+def metric(value : float, unit : str, higher_is_better : bool = True) -> dict:
+    return {"value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+
+
+def median_of(measure, repeats : int) -> float:
+    return statistics.median(measure() for _ in range(repeats))
+
+
+def scaled_corpus(rows : int, seed : int = 0) -> pd.DataFrame:
+    from benchmarks.data_prep import synthetic_corpus
+
+    return synthetic_corpus(rows, seed).dropna()
+
+
+def bench_ingestion(data_path : str, scales, repeats : int, seed : int, workdir : Path) -> dict:
+    from steps.ingest_data import Ingest
+
+    corpora = {"sms": Path(data_path)}
+    for rows in scales:
+        path = workdir / f"synthetic_{rows}.tsv"
+        scaled_corpus(rows, seed).to_csv(path, sep="\t", header=False, index=False)
+        corpora[f"synthetic_{rows}"] = path
+
+    results = {}
+    for name, path in corpora.items():
+        rows = len(Ingest(path).get_run())
+
+        def measure():
+            start = time.perf_counter()
+            Ingest(path).get_run()
+            return rows / (time.perf_counter() - start)
+
+        results[f"ingest.{name}.rows_per_sec"] = metric(median_of(measure, repeats), "rows/s")
+    return results
+
+
+def bench_tokenization(corpora : dict, repeats : int, batch_size : int = 1000) -> dict:
+    "Batch encoding as the tokenize step's worker processes do it, without the token caches."
+    from steps.bert_tokenizer import encode_batch
+
+    results = {}
+    for name, messages in corpora.items():
+        tokens = sum(sum(encode_batch({"Messages": messages[i:i + batch_size]})["length"])
+                     for i in range(0, len(messages), batch_size))
+
+        def measure():
+            start = time.perf_counter()
+            for i in range(0, len(messages), batch_size):
+                encode_batch({"Messages": messages[i:i + batch_size]})
+            return time.perf_counter() - start
+
+        seconds = median_of(measure, repeats)
+        results[f"tokenize.{name}.messages_per_sec"] = metric(len(messages) / seconds, "messages/s")
+        results[f"tokenize.{name}.tokens_per_sec"] = metric(tokens / seconds, "tokens/s")
+    return results
+
+
+def tiny_model(seed : int):
+    import torch
+    from transformers import BertConfig, BertForSequenceClassification
+    from steps.bert_tokenizer import get_tokenizer
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(get_tokenizer()), num_labels=1, **TINY_CONFIG)
+    return BertForSequenceClassification(config).eval()
+
+
+def tokenized_dataset(frame : pd.DataFrame):
+    "The columns the handoff publishes, formatted the way handoff.load_split formats them."
+    import torch
+    from datasets import Dataset
+    from steps.bert_tokenizer import encode_batch
+
+    encoded = encode_batch({"Messages": frame["Messages"].tolist()})
+    dataset = Dataset.from_dict({"input_ids": encoded["input_ids"], "length": encoded["length"],
+                                 "labels": frame["labels"].tolist()})
+    dataset.set_format("torch", columns=["input_ids", "labels"], dtype=torch.long)
+    return dataset
+
+
+def bench_training(dataset, batch_size : int, epochs : int, seed : int, workdir : Path) -> dict:
+    "samples/sec as the training loop itself logs it, averaged over the epochs."
+    import mlflow
+    from steps.data_load import make_loader
+    from steps.training import TrainingConfig, fit
+
+    mlflow.set_tracking_uri(f"sqlite:///{workdir / 'mlflow.db'}")
+    model = tiny_model(seed).train()
+    loader = make_loader(dataset, batch_size, shuffle=True)
+
+    with mlflow.start_run() as run:
+        fit(model, loader, epochs, 1e-3, TrainingConfig(), "cpu")
+    history = mlflow.tracking.MlflowClient().get_metric_history(run.info.run_id, "samples_per_sec")
+    return {"train.samples_per_sec": metric(np.mean([m.value for m in history]), "samples/s")}
+
+
+def bench_evaluation(dataset, batch_size : int, seed : int, repeats : int) -> dict:
+    "The scoring loop the evaluation and optimize steps run over the test loader."
+    from steps.data_load import make_loader
+    from steps.optimize import benchmark_backend
+
+    model = tiny_model(seed)
+    loader = make_loader(dataset, batch_size, shuffle=False)
+    runs = [benchmark_backend(model, loader) for _ in range(repeats)]
+    return {"eval.samples_per_sec": metric(statistics.median(r["samples_per_sec"] for r in runs), "samples/s"),
+            "eval.batch_latency_ms": metric(statistics.median(r["batch_latency_ms"] for r in runs), "ms", False)}
+
+
+async def bench_predict(bundle_dir : Path, messages, requests : int, concurrency : int) -> dict:
+    "Latency of POST /predict through httpx's ASGI transport, so no sockets or server process are involved."
+    # Caches off so every request reaches the model, and no background model watcher
+    for name, value in {"RESULT_CACHE_SIZE": "0", "TOKEN_CACHE_SIZE": "0", "MODEL_WATCH_INTERVAL": "0",
+                        "CASCADE": "0", "SHADOW_PERCENT": "0", "LOG_SAMPLE_RATE": "0"}.items():
+        os.environ[name] = value
+    import httpx
+    import api
+
+    # One INFO line per request from httpx would be part of the measured latency
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    api.store.bundle_dir = Path(bundle_dir)
+    latencies = []
+
+    async with api.lifespan(api.app):
+        while not api.store.ready:
+            if api.store.status == "failed":
+                raise RuntimeError(f"Benchmark model failed to load: {api.store.error}")
+            await asyncio.sleep(0.05)
+
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for text in messages[:concurrency]:
+                (await client.post("/predict", json={"message": text})).raise_for_status()
+
+            async def worker(offset):
+                for i in range(offset, requests, concurrency):
+                    start = time.perf_counter()
+                    response = await client.post("/predict", json={"message": messages[i % len(messages)]})
+                    latencies.append(time.perf_counter() - start)
+                    response.raise_for_status()
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+            elapsed = time.perf_counter() - start
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {"predict.p50_ms": metric(np.percentile(latencies_ms, 50), "ms", False),
+            "predict.p99_ms": metric(np.percentile(latencies_ms, 99), "ms", False),
+            "predict.requests_per_sec": metric(requests / elapsed, "requests/s")}
+
+
+def environment(threads : int) -> dict:
+    import torch
+    import transformers
+
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(), "torch_threads": threads,
+            "torch": torch.__version__, "transformers": transformers.__version__}
+
+
+def compare(baseline : dict, current : dict, threshold : float) -> list:
+    """
+    One row per baseline metric. A metric regresses when it moves in its bad direction
+    by more than `threshold` (a fraction of the baseline), or is missing from `current`.
+    """
+    rows = []
+    for name, base in baseline["metrics"].items():
+        now = current["metrics"].get(name)
+        if now is None:
+            rows.append({"metric": name, "baseline": base["value"], "current": None, "change": None,
+                         "status": "missing"})
+            continue
+
+        change = (now["value"] - base["value"]) / base["value"] if base["value"] else 0.0
+        worse = -change if base["higher_is_better"] else change
+        rows.append({"metric": name, "baseline": base["value"], "current": now["value"], "change": change,
+                     "status": "regressed" if worse > threshold else ("improved" if -worse > threshold else "ok")})
+    return rows
+
+
+@click.group(help="Reproducible offline benchmarks with a JSON baseline and a regression gate.")
+def cli():
+    pass
+
+
+@cli.command(help="Run every benchmark and write the results as JSON.")
+@click.option("--output", default="benchmarks/baseline.json", help="Where the results are written.")
+@click.option("--data-path", default=str(Path("data") / "SMSSpamCollection"), help="The real SMS corpus.")
+@click.option("--scales", default="100000", help="Comma separated row counts of the synthetic corpora.")
+@click.option("--repeats", default=3, type=click.IntRange(min=1), help="Repeats per measurement, the median is kept.")
+@click.option("--threads", default=1, type=click.IntRange(min=1), help="torch intra-op threads.")
+@click.option("--train-rows", default=1000, type=click.IntRange(min=1), help="SMS rows the tiny model trains on.")
+@click.option("--epochs", default=2, type=click.IntRange(min=1), help="Training epochs of the tiny model.")
+@click.option("--batch-size", default=16, type=click.IntRange(min=1), help="Training and evaluation batch size.")
+@click.option("--requests", "num_requests", default=500, type=click.IntRange(min=1), help="/predict requests sent.")
+@click.option("--concurrency", default=8, type=click.IntRange(min=1), help="Concurrent /predict clients.")
+@click.option("--seed", default=0, type=click.INT, help="Seed for the synthetic data and model weights.")
+def run(output, data_path, scales, repeats, threads, train_rows, epochs, batch_size, num_requests, concurrency, seed):
+    import torch
+    from serving.artifacts import save_bundle
+    from steps.bert_tokenizer import get_tokenizer
+    from steps.stream_ingest import LABEL_MAP
+
+    torch.manual_seed(seed)
+    torch.set_num_threads(threads)
+    scales = [int(size) for size in scales.split(",") if size]
+
+    sms = pd.read_csv(data_path, sep="\t", names=["labels", "Messages"]).dropna()
+    sms["labels"] = sms["labels"].map(LABEL_MAP)
+    messages = sms["Messages"].tolist()
+    sample = sms.sample(min(train_rows, len(sms)), random_state=seed)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="benchmarks-") as workdir:
+        workdir = Path(workdir)
+
+        print("Ingestion...")
+        results.update(bench_ingestion(data_path, scales, repeats, seed, workdir))
+
+        print("Tokenization...")
+        corpora = {"sms": messages, **{f"synthetic_{rows}": scaled_corpus(rows, seed)["Messages"].tolist()
+                                       for rows in scales}}
+        results.update(bench_tokenization(corpora, repeats))
+
+        print("Training...")
+        dataset = tokenized_dataset(sample)
+        results.update(bench_training(dataset, batch_size, epochs, seed, workdir))
+
+        print("Evaluation...")
+        results.update(bench_evaluation(tokenized_dataset(sms), batch_size, seed, repeats))
+
+        print("/predict...")
+        bundle_dir = save_bundle(tiny_model(seed), get_tokenizer(), workdir / "bundle")
+        results.update(asyncio.run(bench_predict(bundle_dir, messages, num_requests, concurrency)))
+
+    report = {"format_version": FORMAT_VERSION,
+              "created_at": datetime.now(timezone.utc).isoformat(),
+              "environment": environment(threads),
+              "settings": {"scales": scales, "repeats": repeats, "train_rows": train_rows, "epochs": epochs,
+                           "batch_size": batch_size, "requests": num_requests, "concurrency": concurrency,
+                           "seed": seed},
+              "metrics": results}
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    Path(output).write_text(json.dumps(report, indent=2))
+
+    for name, value in results.items():
+        print(f"{name:<40} {value['value']:14.2f} {value['unit']}")
+    print(f"Wrote {output}")
+
+
+@cli.command("compare", help="Compare a run against a baseline, failing when a metric regressed beyond the threshold.")
+@click.argument("baseline_path", type=click.Path(exists=True))
+@click.argument("current_path", type=click.Path(exists=True))
+@click.option("--threshold", default=0.1, type=click.FloatRange(min=0), help="Allowed relative regression (0.1 = 10%).")
+def compare_command(baseline_path, current_path, threshold):
+    baseline = json.loads(Path(baseline_path).read_text())
+    current = json.loads(Path(current_path).read_text())
+
+    if baseline.get("settings") != current.get("settings"):
+        print(f"Warning: runs used different settings\n  baseline {baseline.get('settings')}\n"
+              f"  current  {current.get('settings')}")
+    if baseline.get("environment") != current.get("environment"):
+        print("Warning: runs come from different environments, differences may not be regressions")
+
+    rows = compare(baseline, current, threshold)
+    for row in rows:
+        current_value = f"{row['current']:14.2f}" if row["current"] is not None else f"{'-':>14}"
+        change = f"{row['change']:+8.1%}" if row["change"] is not None else f"{'-':>8}"
+        print(f"{row['metric']:<40} {row['baseline']:14.2f} {current_value} {change}  {row['status']}")
+
+    failed = [row["metric"] for row in rows if row["status"] in ("regressed", "missing")]
+    if failed:
+        print(f"{len(failed)} metric(s) regressed more than {threshold:.0%} or are missing: {', '.join(failed)}")
+        sys.exit(1)
+    print(f"No metric regressed more than {threshold:.0%}")
+
+
+if __name__ == "__main__":
+    cli()
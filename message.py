@@ -1,4 +1,10 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List
+
+MAX_BATCH_MESSAGES = 1000
 
 class Message(BaseModel):
-    message : str
\ No newline at end of file
+    message : str
+
+class BatchMessage(BaseModel):
+    messages : List[str] = Field(min_length=1, max_length=MAX_BATCH_MESSAGES)
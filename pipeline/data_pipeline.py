@@ -1,19 +1,31 @@
+import logging
 from zenml import pipeline
-from typing import Annotated, Tuple
-from steps import data_load, ingest_data, bert_tokenizer
-from torch.utils.data import DataLoader
+from typing import Annotated
+from steps import data_load, ingest_data, bert_tokenizer, stream_ingest, handoff, prefilter
 
 
 @pipeline
-def processing(data_path : str, batch_size : int) -> Tuple[Annotated[DataLoader, "training_batch"],
-                                         Annotated[DataLoader, "testing_batch"]]:
+def processing(data_path : str, batch_size : int, streaming : bool = False, chunk_size : int = 100_000,
+               dedupe : str = "hash", balance : str = "fixed", samples_per_class : int = 500,
+               seed : int = 42, num_proc : int = 1, length_percentile : float = 99.5) -> Annotated[dict, "dataset_manifest"]:
     
-    data = ingest_data.ingester(data_path)
-    cleaned_data = data_load.clean(data)
-    transformed_data = data_load.transform(cleaned_data)
-    validated_data = data_load.validation(transformed_data)
-    training_set, test_set= data_load.split(validated_data)
-    tokeninzed_train, tokenized_test = bert_tokenizer.tokenized_with_step(training_set, test_set)
-    training_batch, testing_batch = data_load.load(tokeninzed_train, tokenized_test, batch_size)
+    if streaming:
+        # Out-of-core path: chunked read, dedupe, label encoding and a hash split straight to Arrow files.
+        # Only class_weights balances it, through the loss, from the streamed split's label counts
+        if balance in data_load.RESAMPLING_STRATEGIES:
+            logging.warning(f"The {balance} balancing strategy is not applied with streaming, "
+                            f"use class_weights to balance the streamed training split")
+        training_set, test_set = stream_ingest.stream_ingest(data_path, chunk_size, dedupe)
+    else:
+        data = ingest_data.ingester(data_path)
+        prepared_data = data_load.prepare(data)
+        # Balancing happens inside the split, on the training partition only
+        training_set, test_set= data_load.split(prepared_data, balance, samples_per_class, seed)
+    # First stage of the serving cascade, fitted on the same cleaned split BERT is trained on
+    trained_prefilter = prefilter.train_prefilter(training_set, test_set)
+    tokeninzed_train, tokenized_test = bert_tokenizer.tokenized_with_step(training_set, test_set, num_proc,
+                                                                          length_percentile=length_percentile)
+    # Tokenized Arrow shards plus a manifest, the training and evaluation steps build their own loaders from them
+    dataset_manifest = handoff.publish(tokeninzed_train, tokenized_test, batch_size, trained_prefilter)
 
-    return training_batch, testing_batch
\ No newline at end of file
+    return dataset_manifest
\ No newline at end of file
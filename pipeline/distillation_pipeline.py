@@ -0,0 +1,16 @@
+from steps.distillation import distill_student, compare_models, DistillationConfig
+from steps.load_artifacts import load_dataset_manifest, load_trained_model
+from steps.evaluation import evaluation_model
+from zenml import pipeline
+from typing import Optional
+
+STUDENT_BUNDLE_DIR = "saved_model/student"
+
+@pipeline
+def distillation_pipeline(no_of_epoch, lr, distillation_config : Optional[DistillationConfig] = None,
+                          bundle_dir : str = STUDENT_BUNDLE_DIR):
+    dataset_manifest = load_dataset_manifest()
+    teacher = load_trained_model()
+    student = distill_student(teacher, dataset_manifest, no_of_epoch, lr, distillation_config)
+    evaluation_model(student, dataset_manifest, bundle_dir)
+    compare_models(teacher, student, dataset_manifest)
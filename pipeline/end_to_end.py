@@ -1,27 +1,51 @@
 from pipeline import data_pipeline
 from zenml import pipeline
-from steps import training, evaluation
+from steps import training, evaluation, optimize, prefilter
+from serving.cascade import DEFAULT_BAND
 import logging
+from typing import Optional, Tuple
 
 @pipeline(enable_cache=False)
-def end_to_end_pipeline(epoch : int, learning_rate : float, data_path : str, num_of_labels, batch_size):
+def end_to_end_pipeline(epoch : int, learning_rate : float, data_path : str, num_of_labels, batch_size,
+                        serving_tolerance : float = 0.01,
+                        training_config : Optional[training.TrainingConfig] = None,
+                        streaming : bool = False, chunk_size : int = 100_000, dedupe : str = "hash",
+                        balance : str = "fixed", samples_per_class : int = 500, seed : int = 42,
+                        num_proc : int = 1, length_percentile : float = 99.5,
+                        cascade_band : Tuple[float, float] = DEFAULT_BAND):
     try:
-        training_data, testing_data = data_pipeline.processing(data_path, batch_size)
+        dataset_manifest = data_pipeline.processing(data_path, batch_size, streaming, chunk_size, dedupe,
+                                                               balance, samples_per_class, seed, num_proc,
+                                                               length_percentile)
         logging.info("Successfully loaded and processed the training and testing data.")
     except Exception as e:
         logging.error(f"Error in data processing: {e}")
         raise
     
     try:
-        trained_model = training.training_model(training_data, epoch, learning_rate, num_of_labels)
+        trained_model, adapter = training.training_model(dataset_manifest, epoch, learning_rate, num_of_labels, training_config)
         logging.info("Model training complete.")
     except Exception as e:
         logging.error(f"Error during model training: {e}")
         raise
     
     try:
-        accuracy, precision, recall, score = evaluation.evaluation_model(trained_model, testing_data)
+        accuracy, precision, recall, score = evaluation.evaluation_model(trained_model, dataset_manifest, adapter_path=adapter)
         logging.info(f"Evaluation complete. Accuracy: {accuracy}, Precision: {precision}, Recall: {recall}, F1 Score: {score}")
     except Exception as e:
         logging.error(f"Error during model evaluation: {e}")
         raise
+
+    try:
+        optimize.optimize_model(trained_model, dataset_manifest, accuracy, score, serving_tolerance)
+        logging.info("Serving optimizations complete.")
+    except Exception as e:
+        logging.error(f"Error during serving optimization: {e}")
+        raise
+
+    try:
+        prefilter.evaluate_cascade(trained_model, dataset_manifest, cascade_band)
+        logging.info("Cascade evaluation complete.")
+    except Exception as e:
+        logging.error(f"Error during cascade evaluation: {e}")
+        raise
@@ -1,9 +1,16 @@
-from steps.load_artifacts import load_testing_pipeline, load_trained_model
+from steps.load_artifacts import load_dataset_manifest, load_trained_model, load_trained_adapter
 from steps.evaluation import evaluation_model
+from steps.optimize import optimize_model
+from steps.prefilter import evaluate_cascade
+from serving.cascade import DEFAULT_BAND
 from zenml import pipeline
+from typing import Tuple
 
 @pipeline
-def model_evaluation_pipeline():
-    testing_batch = load_testing_pipeline()
+def model_evaluation_pipeline(serving_tolerance : float = 0.01, cascade_band : Tuple[float, float] = DEFAULT_BAND):
+    dataset_manifest = load_dataset_manifest()
     model = load_trained_model()
-    accuracy, precision, recall, f1_score = evaluation_model(model, testing_batch)
\ No newline at end of file
+    adapter = load_trained_adapter()
+    accuracy, precision, recall, f1_score = evaluation_model(model, dataset_manifest, adapter_path=adapter)
+    optimize_model(model, dataset_manifest, accuracy, f1_score, serving_tolerance)
+    evaluate_cascade(model, dataset_manifest, cascade_band)
\ No newline at end of file
@@ -1,9 +1,17 @@
-from steps.training import training_model
-from steps.load_artifacts import load_training_pipeline, load_testing_pipeline
+from steps.training import training_model, TrainingConfig
+from steps.load_artifacts import load_dataset_manifest, load_trained_model
 from steps.evaluation import evaluation_model
 from zenml import pipeline
+from typing import Optional
 
 @pipeline
-def model_training(no_of_epoch, lr, num_of_labels):
-    training_batch = load_training_pipeline()
-    model = training_model(training_batch, no_of_epoch, lr, num_of_labels)
\ No newline at end of file
+def model_training(no_of_epoch, lr, num_of_labels, training_config : Optional[TrainingConfig] = None,
+                   promote_tolerance : float = 0.01):
+    dataset_manifest = load_dataset_manifest()
+    if training_config is not None and training_config.incremental:
+        # Warm-start from the last trained model, and only replace the deployed one if the metrics hold
+        base_model = load_trained_model()
+        model, adapter = training_model(dataset_manifest, no_of_epoch, lr, num_of_labels, training_config, base_model)
+        evaluation_model(model, dataset_manifest, promote_tolerance=promote_tolerance, adapter_path=adapter)
+    else:
+        model, adapter = training_model(dataset_manifest, no_of_epoch, lr, num_of_labels, training_config)
\ No newline at end of file
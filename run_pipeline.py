@@ -4,6 +4,12 @@ from pipeline.data_pipeline import processing
 from pipeline.model_training_pipeline import model_training
 from pipeline.model_evaluation_pipeline import model_evaluation_pipeline
 from pipeline.end_to_end import end_to_end_pipeline
+from pipeline.distillation_pipeline import distillation_pipeline, STUDENT_BUNDLE_DIR
+from steps.training import TrainingConfig
+from steps.distillation import DistillationConfig
+from serving.cascade import parse_band
+from steps.data_load import BALANCE_STRATEGIES, RESAMPLING_STRATEGIES
+from steps import profiling
 from zenml.client import Client
 
 
@@ -20,16 +26,69 @@ def check_trained_model_exists():
         )
 
 
+def bulk_score(input_path: str, output_path: str, chunk_size: int, batch_size: int):
+    "Scores a file offline with the saved model, without going through the API."
+    from serving.model_store import load_model_data
+    from serving.inference import Predictor
+    from serving.bulk_score import score_file
+
+    model_data = load_model_data()
+    max_length = int((model_data.get('params') or {}).get('max_length', 512))
+    predictor = Predictor(model_data['model'], model_data['tokenizer'], max_length=max_length)
+    total = score_file(predictor, input_path, output_path, chunk_size=chunk_size, batch_size=batch_size)
+    print(f"Scored {total} messages into {output_path}")
+
+
 @click.command(help="Run various stages of the ZenML pipeline.")
 @click.option("--load-data", is_flag=True, default=False, help="Create the dataset.")
 @click.option("--train-model", is_flag=True, default=False, help="Run the training pipeline.")
 @click.option("--evaluate-model", is_flag=True, default=False, help="Evaluate the last trained model.")
 @click.option("--end-to-end", is_flag=True, default=False, help="Run all pipelines in sequence.")
+@click.option("--distill", is_flag=True, default=False, help="Distill the last trained model into a smaller student.")
 @click.option("--path", default=None, type=click.STRING, help="Path to the dataset.")
 @click.option("--learning-rate", default=0.0002, type=click.FLOAT, help="Learning rate for training.")
 @click.option("--num-epochs", default=2, type=click.INT, help="Number of training epochs.")
 @click.option("--num-of-labels", default=1, type=click.INT, help="Number of classification labels.")
 @click.option("--batch-size", default=16, type=click.INT, help="Batch size for data loading.")
+@click.option("--serving-tolerance", default=0.01, type=click.FLOAT, help="Max accuracy/F1 drop allowed for int8/ONNX serving.")
+@click.option("--cascade-band", default="0.05,0.95", type=click.STRING, help="low,high prefilter probabilities escalated to BERT in the cascade report.")
+@click.option("--score-file", default=None, type=click.STRING, help="Score a TSV/JSONL file with the saved model.")
+@click.option("--output", default="scored_messages.tsv", type=click.STRING, help="Where --score-file writes its results.")
+@click.option("--chunk-size", default=10000, type=click.INT, help="Rows read per chunk by --score-file and --streaming.")
+@click.option("--streaming", is_flag=True, default=False, help="Ingest out-of-core: chunked TSV/Parquet/Arrow reads straight to Arrow files.")
+@click.option("--dedupe", default="hash", type=click.Choice(["hash", "bloom"]), help="Exact hash-set or fixed-memory Bloom filter dedupe for --streaming.")
+@click.option("--balance", default=None, type=click.Choice(BALANCE_STRATEGIES), help="How imbalanced classes are balanced (class_weights weights the loss instead). Defaults to fixed, or none with --streaming, which only supports none and class_weights.")
+@click.option("--samples-per-class", default=500, type=click.IntRange(min=1), help="Rows per class for --balance fixed.")
+@click.option("--seed", default=42, type=click.INT, help="Seed for class balancing.")
+@click.option("--num-proc", default=1, type=click.IntRange(min=1), help="Worker processes for tokenization.")
+@click.option("--length-percentile", default=99.5, type=click.FloatRange(0, 100), help="Token length percentile that sets max_length (0 = fixed 512).")
+@click.option("--precision", default="fp32", type=click.Choice(["fp32", "bf16"]), help="Train in fp32 or with bf16 autocast.")
+@click.option("--grad-accum-steps", default=1, type=click.IntRange(min=1), help="Batches accumulated per optimizer step.")
+@click.option("--num-threads", default=0, type=click.IntRange(min=0), help="torch intra-op threads for training (0 = torch default).")
+@click.option("--interop-threads", default=0, type=click.IntRange(min=0), help="torch inter-op threads for training (0 = torch default).")
+@click.option("--compile-model", is_flag=True, default=False, help="Train through torch.compile.")
+@click.option("--world-size", default=1, type=click.IntRange(min=1), help="Total DDP training processes (gloo) across all nodes.")
+@click.option("--num-nodes", default=1, type=click.IntRange(min=1), help="Machines taking part in DDP training.")
+@click.option("--node-rank", default=0, type=click.IntRange(min=0), help="Index of this machine among --num-nodes.")
+@click.option("--master-addr", default="127.0.0.1", type=click.STRING, help="Address of node 0 for the DDP rendezvous.")
+@click.option("--master-port", default=0, type=click.IntRange(min=0), help="DDP rendezvous port (0 = any free port, single node only).")
+@click.option("--checkpoint-dir", default="checkpoints", type=click.STRING, help="Where training checkpoints are written.")
+@click.option("--checkpoint-every", default=0, type=click.IntRange(min=0), help="Checkpoint every N optimizer steps and at each epoch end (0 = off).")
+@click.option("--resume", is_flag=True, default=False, help="Continue training from the last checkpoint in --checkpoint-dir.")
+@click.option("--early-stopping-patience", default=0, type=click.IntRange(min=0), help="Stop after N epochs without validation loss improvement (0 = off).")
+@click.option("--validation-fraction", default=0.1, type=click.FloatRange(0, 1, min_open=True, max_open=True), help="Share of the training data held out for early stopping.")
+@click.option("--student-layers", default=4, type=click.IntRange(min=1), help="Encoder layers the distilled student keeps.")
+@click.option("--distill-temperature", default=2.0, type=click.FloatRange(0, min_open=True), help="Temperature that softens the teacher's soft labels.")
+@click.option("--distill-alpha", default=0.5, type=click.FloatRange(0, 1), help="Weight of the hard labels in the distillation loss.")
+@click.option("--student-dir", default=STUDENT_BUNDLE_DIR, type=click.STRING, help="Where the distilled student bundle is saved.")
+@click.option("--incremental", is_flag=True, default=False, help="With --train-model, fine-tune the last trained model on the rows the last --load-data added.")
+@click.option("--replay-ratio", default=1.0, type=click.FloatRange(min=0), help="Old rows replayed per new row by --incremental.")
+@click.option("--promote-tolerance", default=0.01, type=click.FloatRange(min=0), help="Max accuracy/F1 drop against the deployed model for --incremental to replace it.")
+@click.option("--finetune", default="full", type=click.Choice(["full", "frozen", "lora"]), help="Train all weights, only the classifier head, or LoRA adapters plus the head.")
+@click.option("--lora-rank", default=8, type=click.IntRange(min=1), help="Rank of the LoRA adapters.")
+@click.option("--lora-alpha", default=16.0, type=click.FloatRange(0, min_open=True), help="LoRA scaling numerator (updates are scaled by alpha/rank).")
+@click.option("--compare-steps", default=5, type=click.IntRange(min=0), help="Optimizer steps timed against full fine-tuning for --finetune frozen/lora (0 = off).")
+@click.option("--profile-dir", default=None, type=click.STRING, help="Profile every step (wall, CPU, peak RSS, torch traces) into this directory.")
 
 def main(
     load_data: bool,
@@ -40,10 +99,61 @@ def main(
     num_of_labels: int,
     evaluate_model: bool,
     end_to_end: bool,
-    batch_size: int
+    distill: bool,
+    batch_size: int,
+    serving_tolerance: float,
+    cascade_band: str,
+    score_file: str,
+    output: str,
+    chunk_size: int,
+    streaming: bool,
+    dedupe: str,
+    balance: str,
+    samples_per_class: int,
+    seed: int,
+    num_proc: int,
+    length_percentile: float,
+    precision: str,
+    grad_accum_steps: int,
+    num_threads: int,
+    interop_threads: int,
+    compile_model: bool,
+    world_size: int,
+    num_nodes: int,
+    node_rank: int,
+    master_addr: str,
+    master_port: int,
+    checkpoint_dir: str,
+    checkpoint_every: int,
+    resume: bool,
+    early_stopping_patience: int,
+    validation_fraction: float,
+    student_layers: int,
+    distill_temperature: float,
+    distill_alpha: float,
+    student_dir: str,
+    incremental: bool,
+    replay_ratio: float,
+    promote_tolerance: float,
+    finetune: str,
+    lora_rank: int,
+    lora_alpha: float,
+    compare_steps: int,
+    profile_dir: str
 ):
+    if balance is None:
+        balance = "none" if streaming else "fixed"
+    elif streaming and balance in RESAMPLING_STRATEGIES:
+        # Resampling needs the whole training split in memory; the class weights only need its label counts
+        raise click.UsageError(f"--balance {balance} resamples the training split in memory and cannot be used with "
+                               f"--streaming; use --balance class_weights to weight the loss instead")
+
     print(f"Flags - load_data={load_data}, train_model={train_model}, "
-          f"evaluate_model={evaluate_model}, end_to_end={end_to_end}")
+          f"evaluate_model={evaluate_model}, end_to_end={end_to_end}, distill={distill}")
+
+    if score_file:
+        bulk_score(score_file, output, chunk_size, batch_size)
+        return
 
     if train_model:
         run_name = "training_pipeline"
@@ -51,6 +161,8 @@ def main(
         run_name = "end_to_end_pipeline"
     elif evaluate_model:
         run_name = "evaluation_pipeline"
+    elif distill:
+        run_name = "distillation_pipeline"
     elif load_data:
         run_name = "data_pipeline"
     else:
@@ -58,23 +170,54 @@ def main(
 
     with mlflow.start_run(run_name=run_name):
 
-        if train_model or end_to_end:
+        if train_model or end_to_end or distill:
             mlflow.log_param("num_epochs", num_epochs)
             mlflow.log_param("batch_size", batch_size)
             mlflow.log_param("learning_rate", learning_rate)
 
-        if load_data:
-            processing(path, batch_size)
-
-        if train_model:
-            model_training(num_epochs, learning_rate, num_of_labels)
-
-        if evaluate_model:
-            check_trained_model_exists()
-            model_evaluation_pipeline()
-
-        if end_to_end:
-            end_to_end_pipeline(num_epochs, learning_rate, path, num_of_labels, batch_size)
+        training_config = TrainingConfig(precision=precision, grad_accum_steps=grad_accum_steps,
+                                         num_threads=num_threads, interop_threads=interop_threads,
+                                         compile_model=compile_model, world_size=world_size,
+                                         num_nodes=num_nodes, node_rank=node_rank,
+                                         master_addr=master_addr, master_port=master_port,
+                                         checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every,
+                                         resume=resume, early_stopping_patience=early_stopping_patience,
+                                         validation_fraction=validation_fraction,
+                                         class_weighted_loss=balance == "class_weights",
+                                         incremental=incremental, replay_ratio=replay_ratio,
+                                         finetune=finetune, lora_rank=lora_rank, lora_alpha=lora_alpha,
+                                         compare_steps=compare_steps)
+
+        if profile_dir:
+            profiling.start_profiling(profile_dir)
+
+        try:
+            if load_data:
+                processing(path, batch_size, streaming, chunk_size, dedupe, balance, samples_per_class, seed,
+                           num_proc, length_percentile)
+
+            if train_model:
+                if incremental:
+                    check_trained_model_exists()
+                model_training(num_epochs, learning_rate, num_of_labels, training_config, promote_tolerance)
+
+            if evaluate_model:
+                check_trained_model_exists()
+                model_evaluation_pipeline(serving_tolerance, parse_band(cascade_band))
+
+            if distill:
+                check_trained_model_exists()
+                distillation_config = DistillationConfig(student_layers=student_layers, temperature=distill_temperature,
+                                                         alpha=distill_alpha, precision=precision)
+                distillation_pipeline(num_epochs, learning_rate, distillation_config, student_dir)
+
+            if end_to_end:
+                end_to_end_pipeline(num_epochs, learning_rate, path, num_of_labels, batch_size, serving_tolerance,
+                                    training_config, streaming, chunk_size, dedupe, balance, samples_per_class, seed,
+                                    num_proc, length_percentile, parse_band(cascade_band))
+        finally:
+            if profile_dir:
+                profiling.write_report(profile_dir)
 
 
 if __name__ == "__main__":
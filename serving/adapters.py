@@ -0,0 +1,139 @@
+"""
+Parameter-efficient fine-tuning: low-rank (LoRA) adapters on the attention projections, or a
+frozen encoder with only the classifier head trained.
+
+Training saves only the trained weights to ADAPTER_DIR and returns the file as a step output
+next to the merged model, so `evaluation_model` deploys a bundle of a few MB instead of the
+full weights. Serving rebuilds the base model and merges the adapter back into it once,
+at load time, so inference runs on plain Linear layers.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Iterable, Optional
+import torch
+import torch.nn as nn
+from safetensors.torch import load_file, save_file
+
+ADAPTER_DIR = Path("saved_model") / "adapters"
+# Adapters of the latest training runs kept in ADAPTER_DIR; a deployed bundle holds its own copy
+ADAPTERS_KEPT = 3
+BASE_MODEL = "bert-base-uncased"
+# The attention projections LoRA is added to, the usual choice for BERT
+TARGET_MODULES = ("query", "value")
+
+
+class LoRALinear(nn.Module):
+    "A frozen Linear layer plus a trainable rank-`rank` update B @ A, scaled by alpha / rank."
+
+    def __init__(self, base : nn.Linear, rank : int, alpha : float, dropout : float = 0.0):
+        super().__init__()
+        self.base = base
+        self.base.requires_grad_(False)
+        self.scaling = alpha / rank
+        self.dropout = nn.Dropout(dropout) if dropout else nn.Identity()
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features))
+        # B starts at zero, so training starts from exactly the base model
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank))
+        nn.init.kaiming_uniform_(self.lora_A, a=5 ** 0.5)
+
+    def forward(self, x):
+        return self.base(x) + (self.dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+    def merged(self) -> nn.Linear:
+        with torch.no_grad():
+            self.base.weight += (self.lora_B @ self.lora_A) * self.scaling
+        return self.base
+
+
+def add_lora(model : nn.Module, rank : int, alpha : float, dropout : float = 0.0,
+             targets : Iterable[str] = TARGET_MODULES) -> nn.Module:
+    "Freezes the model, wraps every targeted Linear in a LoRALinear and leaves the classifier head trainable."
+    model.requires_grad_(False)
+    targets = tuple(targets)
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if name in targets and isinstance(child, nn.Linear):
+                setattr(module, name, LoRALinear(child, rank, alpha, dropout))
+    model.classifier.requires_grad_(True)
+    return model
+
+
+def freeze_encoder(model : nn.Module) -> nn.Module:
+    "Trains the classifier head only."
+    model.requires_grad_(False)
+    model.classifier.requires_grad_(True)
+    return model
+
+
+def merge_lora(model : nn.Module) -> nn.Module:
+    "Folds every adapter into its Linear layer, in place, and makes all parameters trainable again."
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRALinear):
+                setattr(module, name, child.merged())
+    return model.requires_grad_(True)
+
+
+def trainable_state_dict(model : nn.Module) -> dict:
+    return {name: p.detach().cpu().contiguous() for name, p in model.named_parameters() if p.requires_grad}
+
+
+def state_dict_mb(state_dict : dict) -> float:
+    return sum(t.numel() * t.element_size() for t in state_dict.values()) / 2**20
+
+
+def prune_adapters(directory : Path = ADAPTER_DIR, keep : int = ADAPTERS_KEPT):
+    "Deletes all but the `keep` newest adapter files."
+    adapters = sorted(Path(directory).glob("*.safetensors"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for path in adapters[keep:]:
+        path.unlink(missing_ok=True)
+        logging.info(f"Removed old adapter {path}")
+
+
+def save_adapter(weights : dict, name : str, metadata : dict, directory : Path = ADAPTER_DIR) -> Path:
+    "Writes the trained weights as NAME.safetensors and prunes the older adapters."
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{name}.safetensors"
+    save_file(weights, str(path), metadata={"adapter": json.dumps(metadata)})
+    logging.info(f"Saved {len(weights)} adapter tensors ({path.stat().st_size / 2**20:.1f} MB) to {path}")
+    prune_adapters(directory)
+    return path
+
+
+def existing_adapter(path : Optional[str]) -> Optional[Path]:
+    "The adapter file a training run returned, if it has not been pruned since."
+    if path is None:
+        return None
+    if not Path(path).exists():
+        logging.warning(f"Adapter {path} no longer exists, deploying the full weights")
+        return None
+    return Path(path)
+
+
+def read_metadata(path : Path) -> dict:
+    from safetensors import safe_open
+
+    with safe_open(str(path), framework="pt") as f:
+        return json.loads(f.metadata()["adapter"])
+
+
+def load_adapter_model(path : Path, metadata : dict, base_model : Optional[str] = None):
+    """
+    Rebuilds the base model and merges the adapter at `path` into it. `base_model` overrides the
+    name or directory recorded at training time, for hosts that keep the base weights locally.
+    """
+    from transformers import AutoModelForSequenceClassification
+
+    weights = load_file(str(path), device="cpu")
+    model = AutoModelForSequenceClassification.from_pretrained(base_model or metadata["base_model"],
+                                                               num_labels=metadata["num_labels"])
+    if metadata["method"] == "lora":
+        add_lora(model, metadata["rank"], metadata["alpha"], targets=metadata["targets"])
+
+    missing = set(weights) - set(model.state_dict())
+    if missing:
+        raise RuntimeError(f"Adapter {path} has tensors the base model does not: {sorted(missing)[:5]}")
+    model.load_state_dict(weights, strict=False)
+    return merge_lora(model)
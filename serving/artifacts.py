@@ -0,0 +1,169 @@
+"""
+Versioned model artifact: safetensors weights, the model config and tokenizer files,
+and a JSON manifest with the metrics, params and MLflow run of the model. A model trained
+with adapters (`serving.adapters`) is saved as its adapter weights only, and merged into
+its base model when the bundle is loaded.
+
+Convert an existing pickle with:
+
+    python -m serving.artifacts saved_model/model.pkl saved_model/bundle
+"""
+import hashlib
+import json
+import logging
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+import click
+
+BUNDLE_DIR = Path("saved_model") / "bundle"
+FORMAT_VERSION = 1
+WEIGHTS_FILE = "model.safetensors"
+ADAPTER_FILE = "adapter.safetensors"
+MANIFEST_FILE = "manifest.json"
+# The cascade's prefilter (serving.cascade), copied in when the model is saved
+PREFILTER_SUBDIR = "prefilter"
+
+
+def sha256(path : Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_bundle(model, tokenizer, directory : Path = BUNDLE_DIR, metrics : dict = None,
+                params : dict = None, mlflow_run_id : str = None, adapter : Path = None,
+                prefilter : Path = None) -> Path:
+    """
+    Writes the bundle next to `directory` and swaps it in, so a reader never sees a half written one.
+    With an `adapter` file only that file is stored in place of the full weights. A `prefilter`
+    directory is copied in, so the cascade always serves the prefilter evaluated with this model.
+    """
+    directory = Path(directory)
+    tmp_dir = directory.with_name(directory.name + ".tmp")
+    old_dir = directory.with_name(directory.name + ".old")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    adapter_metadata = None
+    if adapter is not None:
+        from serving.adapters import read_metadata
+
+        tmp_dir.mkdir(parents=True)
+        model.config.save_pretrained(tmp_dir)
+        weights = ADAPTER_FILE
+        shutil.copyfile(adapter, tmp_dir / weights)
+        adapter_metadata = read_metadata(tmp_dir / weights)
+    else:
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        weights = WEIGHTS_FILE
+    tokenizer.save_pretrained(tmp_dir)
+    if prefilter is not None:
+        shutil.copytree(prefilter, tmp_dir / PREFILTER_SUBDIR)
+
+    manifest = {"format_version": FORMAT_VERSION,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "weights": weights,
+                "weights_sha256": sha256(tmp_dir / weights),
+                "adapter": adapter_metadata,
+                "prefilter": PREFILTER_SUBDIR if prefilter is not None else None,
+                "mlflow_run_id": mlflow_run_id,
+                "metrics": metrics or {},
+                "params": params or {}}
+    (tmp_dir / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if directory.exists():
+        directory.rename(old_dir)
+    tmp_dir.rename(directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    logging.info(f"Saved model bundle to {directory}")
+    return directory
+
+
+def read_manifest(directory : Path = BUNDLE_DIR) -> dict:
+    manifest = json.loads((Path(directory) / MANIFEST_FILE).read_text())
+    if manifest.get("format_version", 0) > FORMAT_VERSION:
+        raise RuntimeError(f"Bundle format {manifest['format_version']} is newer than supported {FORMAT_VERSION}")
+    return manifest
+
+
+def _materialize_buffers(model):
+    "Non-persistent buffers are not in the weights file and stay on the meta device after loading."
+    import torch
+
+    for module in model.modules():
+        for name, buffer in list(module.named_buffers(recurse=False)):
+            if buffer is None or not buffer.is_meta:
+                continue
+            if name == "position_ids":
+                value = torch.arange(buffer.shape[-1]).expand(buffer.shape)
+            else:
+                value = torch.zeros(buffer.shape, dtype=buffer.dtype)
+            module.register_buffer(name, value.contiguous(), persistent=False)
+
+
+def load_bundle(directory : Path = BUNDLE_DIR, base_model : str = None) -> dict:
+    """
+    Loads a bundle into the same dict the pickled artifact used to hold. The model is built
+    on the meta device and its parameters are assigned straight from the memory-mapped
+    safetensors file, so worker processes share the weight pages instead of copying them.
+    An adapter bundle is merged into its base model instead (`base_model` overrides the
+    base recorded at training time, e.g. with a local copy of it).
+    """
+    # Imported here so the API can import this module and bind its port before torch is loaded
+    import torch
+    from safetensors.torch import load_file
+    from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+
+    directory = Path(directory)
+    manifest = read_manifest(directory)
+
+    if manifest.get("adapter"):
+        from serving.adapters import load_adapter_model
+
+        model = load_adapter_model(directory / manifest["weights"], manifest["adapter"], base_model)
+        logging.info(f"Merged the {manifest['adapter']['method']} adapter of {directory} into "
+                     f"{base_model or manifest['adapter']['base_model']}")
+    else:
+        config = AutoConfig.from_pretrained(directory)
+        with torch.device("meta"):
+            model = AutoModelForSequenceClassification.from_config(config)
+
+        state_dict = load_file(directory / manifest["weights"], device="cpu")
+        model.load_state_dict(state_dict, assign=True)
+        _materialize_buffers(model)
+    model.requires_grad_(False)
+    model.eval()
+
+    return {"model": model,
+            "tokenizer": AutoTokenizer.from_pretrained(directory),
+            "metrics": manifest["metrics"],
+            "params": manifest["params"],
+            "mlflow_run_id": manifest["mlflow_run_id"],
+            "prefilter_dir": directory / manifest["prefilter"] if manifest.get("prefilter") else None,
+            "manifest": manifest}
+
+
+def convert_pickle(pickle_path : Path, directory : Path = BUNDLE_DIR) -> Path:
+    "Converts a `model.pkl` written by the previous `evaluation_model` into a bundle."
+    import torch
+
+    model_data = torch.load(pickle_path, map_location=torch.device("cpu"), weights_only=False)
+    return save_bundle(model_data["model"], model_data["tokenizer"], directory,
+                       metrics=model_data.get("metrics"), params=model_data.get("params"),
+                       mlflow_run_id=model_data.get("mlflow_run_id"))
+
+
+@click.command(help="Convert a pickled model.pkl into a safetensors model bundle.")
+@click.argument("pickle_path", type=click.Path(exists=True))
+@click.argument("directory", default=str(BUNDLE_DIR))
+def main(pickle_path, directory):
+    convert_pickle(Path(pickle_path), Path(directory))
+    print(f"Converted {pickle_path} to {directory}")
+
+
+if __name__ == "__main__":
+    main()
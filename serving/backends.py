@@ -0,0 +1,118 @@
+import json
+import logging
+from pathlib import Path
+from types import SimpleNamespace
+import torch
+import torch.nn as nn
+
+OPTIMIZED_DIR = Path("saved_model") / "optimized"
+BACKENDS = ("torch", "int8", "onnx")
+
+
+def quantize_int8(model : nn.Module) -> nn.Module:
+    "Dynamic int8 quantization of every Linear layer, which is where BERT spends its CPU time."
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_int8(model : nn.Module, path : Path) -> nn.Module:
+    """
+    Quantizes a copy of `model` and loads the saved int8 state dict into it. The file only holds
+    quantized tensors and dtypes, so it loads with the weights-only unpickler; `optimize_model`
+    reloads every artifact this way before accepting it.
+    """
+    quantized = quantize_int8(model)
+    quantized.load_state_dict(torch.load(path, map_location="cpu", weights_only=True))
+    return quantized.eval()
+
+
+class LogitsOnly(nn.Module):
+    "Export wrapper so the ONNX graph takes input_ids/attention_mask and returns the logits tensor."
+
+    def __init__(self, model : nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+
+def export_onnx(model : nn.Module, path : Path, opset_version : int = 17):
+    wrapper = LogitsOnly(model).eval()
+    dummy = torch.ones((2, 8), dtype=torch.long)
+    torch.onnx.export(wrapper, (dummy, dummy), str(path),
+                      input_names=["input_ids", "attention_mask"], output_names=["logits"],
+                      dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                    "attention_mask": {0: "batch", 1: "sequence"},
+                                    "logits": {0: "batch"}},
+                      opset_version=opset_version, dynamo=False)
+    # Exporting restores the wrapper's training flag, which would put the model back in train mode
+    model.eval()
+
+
+class OnnxModel:
+    "ONNX Runtime session that can stand in for the torch model inside `Predictor`."
+
+    def __init__(self, path : Path, optimized_path : Path = None, num_threads : int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        if optimized_path is not None:
+            # Layout optimizations from ORT_ENABLE_ALL are hardware specific, so the saved graph
+            # stops at the portable level and the serving box applies the rest when it loads it
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+            options.optimized_model_filepath = str(optimized_path)
+
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        logits = self.session.run(["logits"], {"input_ids": input_ids.cpu().numpy(),
+                                               "attention_mask": attention_mask.cpu().numpy()})[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+
+def load_serving_model(model : nn.Module, backend : str = "torch", directory : Path = OPTIMIZED_DIR,
+                       weights_sha256 : str = None):
+    """
+    Returns the model for the configured serving backend and the backend actually used. Falls back
+    to the fp32 torch model when the backend's artifact is unavailable, or was built from other
+    weights than the loaded bundle's `weights_sha256`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown serving backend '{backend}', expected one of {BACKENDS}")
+    if backend == "torch":
+        return model, "torch"
+
+    manifest_path = Path(directory) / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    entry = manifest.get(backend)
+
+    if not entry or not entry.get("accepted"):
+        logging.warning(f"No accepted '{backend}' artifact in {directory}, serving the fp32 torch model")
+        return model, "torch"
+
+    source = manifest.get("source") or {}
+    if weights_sha256 is None or source.get("weights_sha256") != weights_sha256:
+        logging.warning(f"The '{backend}' artifact in {directory} was built from weights {source.get('weights_sha256')} "
+                        f"(run {source.get('mlflow_run_id')}), not the loaded bundle's {weights_sha256}; "
+                        f"serving the fp32 torch model until optimize_model runs for this bundle")
+        return model, "torch"
+
+    path = Path(directory) / entry["path"]
+    logging.info(f"Serving the '{backend}' backend from {path}")
+
+    if backend == "int8":
+        try:
+            return load_int8(model, path), backend
+        except Exception:
+            logging.exception(f"Could not load the int8 artifact {path}, serving the fp32 torch model")
+            return model, "torch"
+
+    return OnnxModel(path), backend
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+from serving import telemetry
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into batches of at most `max_batch_size`, waiting
+    no longer than `max_wait_ms` for a batch to fill. A single worker thread owns
+    the model and runs every batch, and each caller gets its own result back.
+    """
+
+    def __init__(self, predict_fn : Callable[[List[str]], List[float]],
+                 max_batch_size : int = 32, max_wait_ms : float = 5.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+        logging.info(f"Micro-batcher started (max_batch_size={self.max_batch_size}, "
+                     f"max_wait_ms={self.max_wait * 1000})")
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Micro-batcher stopped"))
+
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, text : str) -> float:
+        if self._worker is None:
+            raise RuntimeError("Micro-batcher is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def submit_many(self, texts : List[str]) -> List[float]:
+        "Queues every text individually so they are batched together with concurrent requests."
+        return list(await asyncio.gather(*(self.submit(text) for text in texts)))
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Requests that queued up while the previous batch was running are taken without waiting
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Queue wait ends when the batch is handed to the model, which includes filling the batch
+        now = time.perf_counter()
+        for _, _, enqueued in batch:
+            telemetry.observe_stage("queue_wait", now - enqueued)
+        return [(text, future) for text, future, _ in batch if not future.cancelled()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+
+            texts = [text for text, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.predict_fn, texts)
+            except Exception as e:
+                logging.error(f"Batch inference failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
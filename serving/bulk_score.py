@@ -0,0 +1,51 @@
+import logging
+from pathlib import Path
+from typing import Iterator
+import numpy as np
+import pandas as pd
+from serving.inference import Predictor
+
+
+def read_chunks(path : str, chunk_size : int) -> Iterator[pd.DataFrame]:
+    "Streams a TSV in the format `Ingest` reads, or a JSONL file with the same columns, in chunks."
+    if Path(path).suffix in (".jsonl", ".json"):
+        return pd.read_json(path, lines=True, chunksize=chunk_size)
+    return pd.read_csv(path, sep='\t', names=['labels', 'Messages'], chunksize=chunk_size)
+
+
+def score_chunk(predictor : Predictor, chunk : pd.DataFrame, batch_size : int) -> pd.DataFrame:
+    texts = chunk['Messages'].fillna("").astype(str)
+
+    # Sorting by length keeps messages of similar size in the same batch, so little padding is computed
+    order = np.argsort(texts.str.len().to_numpy(), kind="stable")
+    probs = np.empty(len(texts), dtype=np.float32)
+
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start + batch_size]
+        probs[idx] = predictor.predict_proba(texts.iloc[idx].tolist())
+
+    return chunk.assign(probability=probs, prediction=np.where(probs >= predictor.threshold, "spam", "ham"))
+
+
+def score_file(predictor : Predictor, input_path : str, output_path : str,
+               chunk_size : int = 10000, batch_size : int = 64) -> int:
+    "Scores `input_path` chunk by chunk and appends every scored chunk to `output_path` as soon as it is ready."
+    output_path = Path(output_path)
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    as_jsonl = output_path.suffix in (".jsonl", ".json")
+    total = 0
+
+    with open(output_path, "w", encoding="utf-8") as out:
+        for chunk in read_chunks(input_path, chunk_size):
+            scored = score_chunk(predictor, chunk, batch_size)
+
+            if as_jsonl:
+                scored.to_json(out, orient="records", lines=True, force_ascii=False)
+            else:
+                scored.to_csv(out, sep='\t', header=(total == 0), index=False)
+            out.flush()
+
+            total += len(scored)
+            logging.info(f"Scored {total} messages")
+
+    return total
@@ -0,0 +1,149 @@
+"""
+Two-stage cascade: a TF-IDF + logistic regression prefilter answers the messages it is
+confident about, and only the ones whose spam probability falls inside the uncertainty
+band go on to the BERT model. The prefilter is saved inside the model bundle, so it is
+versioned, pulled and hot-reloaded together with the model it was evaluated with.
+"""
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, List, Tuple
+import numpy as np
+from serving import telemetry
+
+PREFILTER_DIR = Path("saved_model") / "prefilter"
+PREFILTER_FILE = "prefilter.joblib"
+MANIFEST_FILE = "manifest.json"
+# Prefilter probabilities inside [low, high] are escalated to BERT
+DEFAULT_BAND = (0.05, 0.95)
+
+
+def build_prefilter():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import Pipeline
+
+    return Pipeline([("tfidf", TfidfVectorizer(lowercase=True, ngram_range=(1, 2), min_df=2, sublinear_tf=True)),
+                     ("classifier", LogisticRegression(max_iter=1000, C=10.0))])
+
+
+def save_prefilter(prefilter, directory : Path = PREFILTER_DIR, metrics : dict = None) -> Path:
+    "Written next to `directory` and swapped in, like the model bundle."
+    import joblib
+    import shutil
+
+    directory = Path(directory)
+    tmp_dir = directory.with_name(directory.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    joblib.dump(prefilter, tmp_dir / PREFILTER_FILE)
+    manifest = {"created_at": datetime.now(timezone.utc).isoformat(),
+                "vocabulary_size": len(prefilter.named_steps["tfidf"].vocabulary_),
+                "metrics": metrics or {}}
+    (tmp_dir / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+
+    shutil.rmtree(directory, ignore_errors=True)
+    tmp_dir.rename(directory)
+    logging.info(f"Saved prefilter to {directory}")
+    return directory
+
+
+def load_prefilter(directory : Path = PREFILTER_DIR):
+    import joblib
+    return joblib.load(Path(directory) / PREFILTER_FILE)
+
+
+def parse_band(value : str) -> Tuple[float, float]:
+    "`low,high` as used by the CASCADE_BAND environment variable."
+    low, high = (float(part) for part in value.split(","))
+    if not 0 <= low <= high <= 1:
+        raise ValueError(f"Cascade band {value} must satisfy 0 <= low <= high <= 1")
+    return low, high
+
+
+class CascadeStats:
+    "How much traffic the prefilter answered and how long each stage took."
+
+    def __init__(self):
+        self.messages = 0
+        self.escalated = 0
+        self.prefilter_seconds = 0.0
+        self.model_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, messages : int, escalated : int, prefilter_seconds : float, model_seconds : float):
+        with self._lock:
+            self.messages += messages
+            self.escalated += escalated
+            self.prefilter_seconds += prefilter_seconds
+            self.model_seconds += model_seconds
+
+    def as_dict(self) -> dict:
+        messages = max(self.messages, 1)
+        return {"messages": self.messages,
+                "escalated": self.escalated,
+                "escalated_fraction": self.escalated / messages,
+                "prefilter_ms_per_message": 1000 * self.prefilter_seconds / messages,
+                "model_ms_per_escalated": 1000 * self.model_seconds / max(self.escalated, 1),
+                "mean_ms_per_message": 1000 * (self.prefilter_seconds + self.model_seconds) / messages}
+
+
+class Cascade:
+    "Routing and stats of the cascade; the prefilter itself belongs to the model version serving the request."
+
+    def __init__(self, band : Tuple[float, float] = DEFAULT_BAND):
+        self.low, self.high = band
+        self.stats = CascadeStats()
+
+    def uncertain(self, probs : np.ndarray) -> np.ndarray:
+        "Positions of the prefilter probabilities inside the band, which go to the model."
+        return np.flatnonzero((probs >= self.low) & (probs <= self.high))
+
+    async def predict_proba(self, texts : List[str], model_proba : Callable[[List[str]], Awaitable[List[float]]],
+                            prefilter) -> List[float]:
+        """
+        Prefilter probabilities for the confident texts, the awaited `model_proba` for the uncertain ones.
+        Without a prefilter (a bundle saved without one) every text goes to the model.
+        """
+        start = time.perf_counter()
+        if prefilter is None:
+            probs = np.asarray(await model_proba(texts), dtype=np.float64)
+            self.stats.record(len(texts), len(texts), 0.0, time.perf_counter() - start)
+            return probs.tolist()
+
+        probs = prefilter.predict_proba(texts)[:, 1]
+        escalate = self.uncertain(probs)
+        prefilter_seconds = time.perf_counter() - start
+        telemetry.observe_stage("prefilter", prefilter_seconds)
+
+        if len(escalate):
+            probs[escalate] = await model_proba([texts[i] for i in escalate])
+        self.stats.record(len(texts), len(escalate), prefilter_seconds,
+                          time.perf_counter() - start - prefilter_seconds)
+        return probs.tolist()
+
+
+def band_sweep(prefilter_probs : np.ndarray, model_probs : np.ndarray, labels : np.ndarray,
+               prefilter_seconds : float, model_seconds : float, bands, threshold : float = 0.5) -> List[dict]:
+    """
+    Accuracy, F1, escalated fraction and the expected mean latency of the cascade for every
+    band, from one prefilter and one model pass over the same messages.
+    """
+    from strategy.metrics import confusion_counts, Metrics
+
+    n = max(len(labels), 1)
+    rows = []
+    for low, high in bands:
+        escalate = (prefilter_probs >= low) & (prefilter_probs <= high)
+        probs = np.where(escalate, model_probs, prefilter_probs)
+        metrics = Metrics(*confusion_counts(probs >= threshold, labels))
+        escalated = float(escalate.mean()) if len(labels) else 0.0
+        rows.append({"low": low, "high": high,
+                     "accuracy": metrics.accuracy(), "f1_score": metrics.f1_score(),
+                     "escalated_fraction": escalated,
+                     "mean_latency_ms": 1000 * (prefilter_seconds + escalated * model_seconds) / n})
+    return rows
@@ -0,0 +1,63 @@
+from typing import List, Optional
+import time
+import torch
+from serving import telemetry
+from steps.token_cache import TokenCache
+
+
+def pad_batch(input_ids : List[List[int]], pad_token_id : int) -> dict:
+    max_len = max(len(ids) for ids in input_ids)
+    padded = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+
+    for i, ids in enumerate(input_ids):
+        padded[i, :len(ids)] = torch.as_tensor(ids, dtype=torch.long)
+        attention_mask[i, :len(ids)] = 1
+
+    return {"input_ids": padded, "attention_mask": attention_mask}
+
+
+class Predictor:
+
+    def __init__(self, model, tokenizer, device : str = "cpu", threshold : float = 0.5, max_length : int = 512,
+                 token_cache : Optional[TokenCache] = None):
+        self.device = torch.device(device)
+        self.model = model.to(self.device)
+        self.model.eval()
+        self.tokenizer = tokenizer
+        self.threshold = threshold
+        self.max_length = max_length
+        self.token_cache = token_cache
+
+    def encode(self, texts : List[str]) -> dict:
+        if self.token_cache is None:
+            return self.tokenizer(texts, truncation=True, padding=True,
+                                  max_length=self.max_length, return_tensors="pt")
+        return pad_batch(self.token_cache.encode(texts), self.tokenizer.pad_token_id)
+
+    def predict_proba(self, texts : List[str]) -> List[float]:
+        "Runs one padded forward pass over the batch and returns the spam probability of every text."
+        start = time.perf_counter()
+        encoded = {k: v.to(self.device) for k, v in self.encode(texts).items()}
+        tokenized = time.perf_counter()
+
+        with torch.inference_mode():
+            logits = self.model(**encoded).logits
+        forwarded = time.perf_counter()
+
+        probs = torch.sigmoid(logits).squeeze(-1).tolist()
+        done = time.perf_counter()
+
+        telemetry.observe_stage("tokenization", tokenized - start)
+        telemetry.observe_stage("forward", forwarded - tokenized)
+        telemetry.observe_stage("postprocess", done - forwarded)
+        telemetry.BATCH_SIZE.observe(len(texts))
+        for length in encoded["attention_mask"].sum(dim=1).tolist():
+            telemetry.TOKEN_LENGTH.observe(length)
+        return probs
+
+    def is_spam(self, prob : float) -> bool:
+        return prob >= self.threshold
+
+    def label(self, prob : float) -> str:
+        return "Spam message" if self.is_spam(prob) else "Valid message"
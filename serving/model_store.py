@@ -0,0 +1,285 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+import time
+from pathlib import Path
+import subprocess
+from typing import List, Optional, Tuple
+from serving.artifacts import BUNDLE_DIR, MANIFEST_FILE
+
+MODEL_PATH = Path("saved_model") / "model.pkl"
+
+
+def pull(path : Path) -> bool:
+    "Pulls a DVC-tracked path, returning whether it is available afterwards."
+    logging.info(f"Pulling {path} from DVC")
+    result = subprocess.run(["dvc","pull",str(path)])
+    return result.returncode == 0 and Path(path).exists()
+
+
+def load_model_data(bundle_dir : Path = BUNDLE_DIR, legacy_path : Path = MODEL_PATH,
+                    base_model : Optional[str] = None, allow_pull : bool = True) -> dict:
+    """
+    Loads the safetensors bundle, pulling it from DVC if needed. A pickled `model.pkl` is
+    only used when no bundle exists; convert it with `python -m serving.artifacts`.
+    `base_model` is where an adapter bundle finds its base weights, if not the recorded one.
+    Without `allow_pull` a missing bundle raises instead, for callers that only reload a local bundle.
+    """
+    import torch
+    from serving.artifacts import load_bundle
+
+    bundle_dir, legacy_path = Path(bundle_dir), Path(legacy_path)
+
+    if (bundle_dir / MANIFEST_FILE).exists() or (allow_pull and pull(bundle_dir)):
+        return load_bundle(bundle_dir, base_model)
+    if not allow_pull:
+        raise FileNotFoundError(f"No bundle in {bundle_dir}")
+
+    if not legacy_path.exists():
+        subprocess.run(["dvc","pull",str(legacy_path)], check=True)
+
+    logging.warning(f"Loading legacy pickle {legacy_path}, convert it with `python -m serving.artifacts`")
+    return torch.load(legacy_path, map_location=torch.device("cpu"), weights_only=False)
+
+
+class LoadedModel:
+    "One deployed model version with its predictor."
+
+    def __init__(self, model_data : dict, backend : str = "torch", token_cache_size : int = 0,
+                 prefilter : bool = False):
+        from serving.backends import load_serving_model
+        from serving.inference import Predictor
+        from steps.token_cache import LRUTokenCache
+
+        tokenizer = model_data['tokenizer']
+        # Serve with the data-driven max_length the model was trained with (logged as a run param)
+        self.max_length = int((model_data.get('params') or {}).get('max_length', 512))
+        token_cache = LRUTokenCache(tokenizer, tokenizer.name_or_path, max_length=self.max_length,
+                                    maxsize=token_cache_size) if token_cache_size else None
+
+        self.weights_sha256 = model_data.get('manifest', {}).get('weights_sha256')
+        self.version = model_data.get('mlflow_run_id') or (self.weights_sha256 or "legacy")[:12]
+        self.metrics = model_data.get('metrics', {})
+        self.loaded_at = time.time()
+        self.token_cache = token_cache
+        # The backend can fall back to torch when the optimized artifacts belong to another bundle
+        serving_model, self.backend = load_serving_model(model_data['model'], backend,
+                                                         weights_sha256=self.weights_sha256)
+        self.predictor = Predictor(serving_model, tokenizer,
+                                   device="cpu", max_length=self.max_length, token_cache=token_cache)
+
+        # Loaded now, not on first use, since a hot reload renames the bundle directory away
+        self.prefilter = None
+        if prefilter:
+            if model_data.get('prefilter_dir') is not None:
+                from serving.cascade import load_prefilter
+                self.prefilter = load_prefilter(model_data['prefilter_dir'])
+            else:
+                logging.warning(f"Model {self.version} was saved without a prefilter, "
+                                f"every message goes to the model")
+
+    def warm_up(self):
+        self.predictor.predict_proba(["warm up"])
+
+    def describe(self) -> dict:
+        return {"version": self.version, "backend": self.backend, "loaded_at": self.loaded_at, "max_length": self.max_length,
+                "weights_sha256": self.weights_sha256, "metrics": self.metrics, "prefilter": self.prefilter is not None}
+
+
+class ShadowStats:
+    "Latency and agreement of the candidate model on the share of traffic it shadows."
+
+    def __init__(self):
+        self.requests = 0
+        self.agreements = 0
+        self.active_seconds = 0.0
+        self.candidate_seconds = 0.0
+
+    def record(self, active_seconds : float, candidate_seconds : float, agreements : int, count : int):
+        self.requests += count
+        self.agreements += agreements
+        self.active_seconds += active_seconds
+        self.candidate_seconds += candidate_seconds
+
+    def as_dict(self) -> dict:
+        calls = max(self.requests, 1)
+        return {"requests": self.requests,
+                "agreement_rate": self.agreements / calls,
+                "active_ms_per_message": 1000 * self.active_seconds / calls,
+                "candidate_ms_per_message": 1000 * self.candidate_seconds / calls}
+
+
+class ModelStore:
+    """
+    Owns the served model versions. The heavy work (DVC pull, torch/transformers imports,
+    deserialization and a warm-up inference) runs in a background thread so the server can
+    bind its port immediately and report progress through `status`.
+
+    A watcher thread polls the bundle's manifest and its `.dvc` file. A new version is
+    loaded and warmed next to the active one and then swapped in with a single reference
+    assignment, so batches already running finish on the old model. The last
+    `max_versions` versions stay loaded for rollback, and a loaded version that is not
+    active can shadow a share of the traffic.
+    """
+
+    def __init__(self, backend : str = "torch", token_cache_size : int = 0, bundle_dir : Path = BUNDLE_DIR,
+                 watch_interval : float = 0, max_versions : int = 2, base_model : Optional[str] = None,
+                 prefilter : bool = False):
+        self.backend = backend
+        self.prefilter = prefilter
+        self.base_model = base_model
+        self.token_cache_size = token_cache_size
+        self.bundle_dir = Path(bundle_dir)
+        self.dvc_file = self.bundle_dir.with_name(self.bundle_dir.name + ".dvc")
+        self.watch_interval = watch_interval
+        self.max_versions = max_versions
+        self.status = "starting"
+        self.error = None
+        self.active : Optional[LoadedModel] = None
+        self.candidate : Optional[LoadedModel] = None
+        self.versions = OrderedDict()
+        self.shadow_stats = ShadowStats()
+        self._dvc_state = self._read_dvc_file()
+        self._thread = None
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    def _add(self, loaded : LoadedModel, activate : bool):
+        with self._lock:
+            self.versions[loaded.version] = loaded
+            self.versions.move_to_end(loaded.version)
+            if activate:
+                self.active = loaded
+            else:
+                self.candidate = loaded
+
+            evictable = [v for v, loaded in self.versions.items() if loaded not in (self.active, self.candidate)]
+            while len(self.versions) > self.max_versions and evictable:
+                del self.versions[evictable.pop(0)]
+
+    def load(self) -> LoadedModel:
+        "Loads the model synchronously without warming it up (the pre-fork supervisor uses this)."
+        if self.active is None:
+            self.status = "loading"
+            start = time.perf_counter()
+            self._add(LoadedModel(load_model_data(self.bundle_dir, base_model=self.base_model), self.backend,
+                                  self.token_cache_size, self.prefilter), activate=True)
+            logging.info(f"Model {self.active.version} loaded in {time.perf_counter() - start:.1f}s "
+                         f"with the '{self.active.backend}' backend")
+            if self.active.backend != self.backend:
+                logging.error(f"SERVING_BACKEND is '{self.backend}' but the model is served with "
+                              f"'{self.active.backend}', see the warnings above")
+        return self.active
+
+    def _prepare(self):
+        try:
+            self.load()
+            self.status = "warming"
+            self.active.warm_up()
+            self.status = "ready"
+        except Exception as e:
+            logging.exception("Model failed to load")
+            self.error = str(e)
+            self.status = "failed"
+            return
+
+        if self.watch_interval > 0:
+            self._watcher = threading.Thread(target=self._watch, name="model-watcher", daemon=True)
+            self._watcher.start()
+
+    def start(self):
+        "Loads (if needed) and warms the model in the background, then starts watching for new versions."
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._prepare, name="model-loader", daemon=True)
+            self._thread.start()
+
+    def _read_dvc_file(self) -> Optional[str]:
+        return self.dvc_file.read_text() if self.dvc_file.exists() else None
+
+    def _bundle_sha(self) -> Optional[str]:
+        try:
+            return json.loads((self.bundle_dir / MANIFEST_FILE).read_text()).get("weights_sha256")
+        except (FileNotFoundError, json.JSONDecodeError):
+            # No bundle, or one that is being swapped in right now
+            return None
+
+    def check_for_update(self, activate : bool = True) -> Optional[str]:
+        """
+        Loads and warms the bundle if it differs from every loaded version, returning its version.
+        Only a changed `.dvc` file triggers a DVC pull. A bundle directory that is missing or changes
+        while it is read (`save_bundle` swaps it in by renaming) is left for the next poll.
+        """
+        dvc_state = self._read_dvc_file()
+        if dvc_state != self._dvc_state:
+            logging.info(f"{self.dvc_file} changed, pulling the new model")
+            if pull(self.bundle_dir):
+                self._dvc_state = dvc_state
+
+        sha = self._bundle_sha()
+        if sha is None or any(loaded.weights_sha256 == sha for loaded in self.versions.values()):
+            return None
+
+        start = time.perf_counter()
+        try:
+            model_data = load_model_data(self.bundle_dir, base_model=self.base_model, allow_pull=False)
+        except FileNotFoundError:
+            model_data = {}
+        if model_data.get('manifest', {}).get('weights_sha256') != sha or self._bundle_sha() != sha:
+            logging.info(f"{self.bundle_dir} changed while it was loaded, retrying on the next poll")
+            return None
+        loaded = LoadedModel(model_data, self.backend, self.token_cache_size, self.prefilter)
+        if loaded.backend != self.backend:
+            logging.warning(f"Model {loaded.version} is served with the '{loaded.backend}' backend instead of "
+                            f"'{self.backend}': the optimized artifacts were built from another bundle")
+        loaded.warm_up()
+        self._add(loaded, activate)
+        logging.info(f"Model {loaded.version} loaded in {time.perf_counter() - start:.1f}s "
+                     f"({'active' if activate else 'candidate'}, {loaded.backend} backend)")
+        return loaded.version
+
+    def _watch(self):
+        while True:
+            time.sleep(self.watch_interval)
+            try:
+                self.check_for_update()
+            except Exception:
+                # A bundle that is being replaced while we read it is simply picked up next time
+                logging.exception("Checking for a new model version failed")
+
+    def activate(self, version : str) -> LoadedModel:
+        "Switches traffic to an already loaded version, which is how a rollback is done."
+        with self._lock:
+            if version not in self.versions:
+                raise KeyError(version)
+            self.active = self.versions[version]
+            if self.candidate is self.active:
+                self.candidate = None
+        logging.info(f"Model {version} is now active")
+        return self.active
+
+    def set_candidate(self, version : Optional[str]):
+        with self._lock:
+            if version is not None and version not in self.versions:
+                raise KeyError(version)
+            self.candidate = self.versions[version] if version is not None else None
+            self.shadow_stats = ShadowStats()
+
+    def describe(self) -> List[dict]:
+        return [{**loaded.describe(), "active": loaded is self.active, "candidate": loaded is self.candidate}
+                for loaded in self.versions.values()]
+
+    def predict_proba(self, texts : List[str]) -> List[float]:
+        return [prob for _, prob in self.predict_versioned(texts)]
+
+    def predict_versioned(self, texts : List[str]) -> List[Tuple[str, float]]:
+        "(version, probability) per text, naming the model that actually scored the batch."
+        # Read once, so a swap in the middle of a batch cannot mix two models
+        active = self.active
+        if active is None:
+            raise RuntimeError(f"Model is not loaded yet (status: {self.status})")
+        return [(active.version, prob) for prob in active.predictor.predict_proba(texts)]
@@ -0,0 +1,118 @@
+"""
+Pre-fork server: the model is loaded once in the supervisor, then N workers are forked
+that share its weights (memory-mapped bundle pages, or copy-on-write pages for a legacy
+pickle) and each serve the same listening socket with their own torch thread pool.
+
+    python -m serving.prefork --workers 4 --threads 2
+"""
+import logging
+import os
+import signal
+import socket
+import time
+import click
+import uvicorn
+
+
+def bind_socket(host : str, port : int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def worker_cores(index : int, threads : int):
+    cores = sorted(os.sched_getaffinity(0))
+    start = (index * threads) % len(cores)
+    return {cores[(start + i) % len(cores)] for i in range(threads)}
+
+
+def run_worker(app, sock : socket.socket, index : int, threads : int, pin_cores : bool):
+    "Runs in the forked child; torch thread pools are only created here, the supervisor computes on one thread."
+    import torch
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    if pin_cores:
+        os.sched_setaffinity(0, worker_cores(index, threads))
+
+    logging.info(f"Worker {index} (pid {os.getpid()}) serving with {threads} torch threads")
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def spawn(app, sock, index, threads, pin_cores) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(app, sock, index, threads, pin_cores)
+        except Exception:
+            logging.exception(f"Worker {index} crashed")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+@click.command(help="Serve the API from N pre-forked workers sharing one loaded model.")
+@click.option("--host", default="0.0.0.0", help="Address to bind.")
+@click.option("--port", default=8000, type=click.INT, help="Port to bind.")
+@click.option("--workers", default=2, type=click.INT, help="Number of worker processes.")
+@click.option("--threads", default=None, type=click.INT, help="Torch intra-op threads per worker (default: cores / workers).")
+@click.option("--pin-cores", is_flag=True, default=False, help="Pin every worker to its own set of cores.")
+def main(host, port, workers, threads, pin_cores):
+    logging.basicConfig(level=logging.INFO)
+    threads = threads or max(1, len(os.sched_getaffinity(0)) // workers)
+
+    # The model is loaded once here, before any worker exists; each worker then only warms it up.
+    # Loading can compute (an adapter bundle merges its LoRA weights into the base model), so the
+    # supervisor does it on a single thread: an OpenMP pool started before fork can hang the workers
+    import torch
+    torch.set_num_threads(1)
+    import api
+    api.store.load()
+
+    sock = bind_socket(host, port)
+    children = {spawn(api.app, sock, i, threads, pin_cores): i for i in range(workers)}
+    logging.info(f"Supervisor {os.getpid()} started {workers} workers on {host}:{port}")
+
+    stopping = False
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logging.warning(f"Worker {index} (pid {pid}) exited with status {status}, restarting it")
+        time.sleep(1)
+        children[spawn(api.app, sock, index, threads, pin_cores)] = index
+
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+
+URL_PATTERN = re.compile(r"(https?://|www\.)\S+", re.IGNORECASE)
+DIGITS_PATTERN = re.compile(r"\d+")
+
+
+def normalize_message(text : str) -> str:
+    "Collapses template spam (different phone numbers, links, casing or spacing) to one key."
+    text = URL_PATTERN.sub(" <url> ", text.lower())
+    text = DIGITS_PATTERN.sub("0", text)
+    return " ".join(text.split())
+
+
+class ResultCache:
+    """
+    Size-bounded LRU of prediction results with a TTL. Entries are keyed by the model
+    version and the message hash, so versions served side by side (shadow traffic, a
+    swap with requests in flight) keep their own results; a retired version's entries
+    age out through the LRU and the TTL.
+    """
+
+    def __init__(self, maxsize : int = 100000, ttl : float = 3600, normalize : bool = False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.normalize = normalize
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, text : str, model_version) -> tuple:
+        if self.normalize:
+            text = normalize_message(text)
+        return model_version, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, text : str, model_version) -> Optional[float]:
+        key = self.key(text, model_version)
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+            self.expirations += 1
+
+        self.misses += 1
+        return None
+
+    def put(self, text : str, model_version, value : float):
+        key = self.key(text, model_version)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._entries),
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions, "expirations": self.expirations}
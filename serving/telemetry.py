@@ -0,0 +1,104 @@
+"""
+Prometheus metrics and sampled request logging for the API.
+
+Every process keeps its own metrics (the default registry, which also exports the process
+RSS, CPU time and open file descriptors), so with `serving.prefork` each scrape reports the
+worker that answered it.
+"""
+import json
+import logging
+import random
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Sub-millisecond (cache hits, prefilter) up to multi-second (long batches on a busy CPU)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+TOKEN_BUCKETS = (8, 16, 32, 64, 96, 128, 192, 256, 384, 512)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+REQUEST_LATENCY = Histogram("spam_request_latency_seconds", "End-to-end latency of a prediction request",
+                            ["endpoint"], buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram("spam_stage_latency_seconds",
+                          "Time spent per stage: queue_wait, prefilter, tokenization, forward, postprocess",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+TOKEN_LENGTH = Histogram("spam_token_length", "Token length of every scored message", buckets=TOKEN_BUCKETS)
+BATCH_SIZE = Histogram("spam_batch_size", "Messages per model forward pass", buckets=BATCH_BUCKETS)
+PREDICTIONS = Counter("spam_predictions_total", "Predictions returned", ["model_version", "label"])
+RESULT_CACHE = Counter("spam_result_cache_requests_total", "Result cache lookups", ["result"])
+
+request_logger = logging.getLogger("api.requests")
+
+
+def observe_stage(stage : str, seconds : float):
+    STAGE_LATENCY.labels(stage).observe(seconds)
+
+
+class StatsCollector:
+    """
+    Exports what the serving code already keeps (active model version, token cache, result cache
+    size, cascade routing) at scrape time, so the request path does no extra work for them.
+    """
+
+    def __init__(self, store, result_cache=None, cascade=None):
+        self.store = store
+        self.result_cache = result_cache
+        self.cascade = cascade
+
+    def describe(self):
+        # Nothing to check up front, the families depend on what is loaded when scraped
+        return []
+
+    def collect(self):
+        active = self.store.active
+        if active is not None:
+            info = GaugeMetricFamily("spam_model_info", "1 for the active model version",
+                                     labels=["model_version", "backend"])
+            info.add_metric([active.version, active.backend], 1)
+            yield info
+
+        token_cache = active.token_cache if active is not None else None
+        if token_cache is not None:
+            lookups = CounterMetricFamily("spam_token_cache_requests", "Token cache lookups", labels=["result"])
+            lookups.add_metric(["hit"], token_cache.stats.hits)
+            lookups.add_metric(["miss"], token_cache.stats.misses)
+            yield lookups
+            yield GaugeMetricFamily("spam_token_cache_entries", "Entries in the token cache", value=len(token_cache))
+
+        if self.result_cache is not None:
+            yield GaugeMetricFamily("spam_result_cache_entries", "Entries in the result cache",
+                                    value=len(self.result_cache))
+
+        if self.cascade is not None:
+            stats = self.cascade.stats
+            routed = CounterMetricFamily("spam_cascade_messages", "Messages seen by the cascade", labels=["route"])
+            routed.add_metric(["prefilter"], stats.messages - stats.escalated)
+            routed.add_metric(["model"], stats.escalated)
+            yield routed
+
+
+def register(collector : StatsCollector):
+    REGISTRY.register(collector)
+
+
+def render() -> tuple:
+    "The metrics page and its content type."
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class SampledLogger:
+    """
+    Logs one JSON line for a `rate` share of the requests, and for every request slower than
+    `slow_ms`, so logging stays off the hot path at high request rates.
+    """
+
+    def __init__(self, logger : logging.Logger, rate : float = 0.01, slow_ms : float = 500):
+        self.logger = logger
+        self.rate = rate
+        self.slow_ms = slow_ms
+
+    def log(self, event : str, latency_ms : float, **fields):
+        slow = latency_ms >= self.slow_ms
+        if not slow and random.random() >= self.rate:
+            return
+        self.logger.info(json.dumps({"event": event, "latency_ms": round(latency_ms, 3), "slow": slow,
+                                     "sample_rate": self.rate, **fields}))
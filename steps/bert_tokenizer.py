@@ -1,22 +1,127 @@
 from transformers import AutoTokenizer
 from datasets import Dataset
 from zenml import step
+from steps.profiling import profiled
 from typing import Annotated, Tuple
 import logging
+import mlflow
+from pathlib import Path
+from steps.token_cache import DiskTokenCache
+from functools import lru_cache
+import hashlib
+import numpy as np
+import pandas as pd
 
-tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
+MODEL_NAME = "bert-base-uncased"
+MAX_LENGTH = 512
+TOKEN_CACHE_DIR = Path("token_cache")
+TOKENIZED_CACHE_DIR = Path("token_cache") / "datasets"
+# Bump when tokenize_data / encode_batch change what they write, so old cached Arrow files are not reused
+TOKENIZED_FORMAT = 1
+# The data-driven max_length is rounded up to a multiple of this
+LENGTH_MULTIPLE = 8
+
+_token_cache = None
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    "Loaded on first use, so importing the steps package does not hit the Hugging Face hub."
+    return AutoTokenizer.from_pretrained(MODEL_NAME)
+
+
+def __getattr__(name):
+    if name == "tokenizer":
+        return get_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_token_cache() -> DiskTokenCache:
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = DiskTokenCache(TOKEN_CACHE_DIR, get_tokenizer(), MODEL_NAME, MAX_LENGTH)
+    return _token_cache
+
+
+def encode_batch(data, max_length : int = MAX_LENGTH):
+    "Straight batch encoding with the fast (Rust) tokenizer, used by the worker processes of a num_proc map."
+    input_ids = get_tokenizer()(data['Messages'], truncation=True, max_length=max_length,
+                                return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+    return {"input_ids": input_ids,
+            "token_type_ids": [[0] * len(ids) for ids in input_ids],
+            "attention_mask": [[1] * len(ids) for ids in input_ids],
+            "length": [len(ids) for ids in input_ids]}
+
+
+def truncate(data, max_length : int, sep_token_id : int):
+    "Cuts rows down to max_length, keeping the closing [SEP]."
+    input_ids = [ids if len(ids) <= max_length else ids[:max_length - 1] + [sep_token_id] for ids in data['input_ids']]
+    return {"input_ids": input_ids,
+            "token_type_ids": [ids[:max_length] for ids in data['token_type_ids']],
+            "attention_mask": [ids[:max_length] for ids in data['attention_mask']],
+            "length": [len(ids) for ids in input_ids]}
+
+
+def content_fingerprint(dataset : Dataset, *parts) -> str:
+    """
+    Hash of the labels and messages (in row order) plus `parts`. Unlike the datasets
+    fingerprint it does not depend on file modification times, so re-ingesting the same
+    data maps to the same cached Arrow file.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("\0".join(str(part) for part in (TOKENIZED_FORMAT, MODEL_NAME, *parts)).encode("utf-8"))
+    for batch in dataset.select_columns(["labels", "Messages"]).with_format("arrow").iter(batch_size=100_000):
+        digest.update(pd.util.hash_pandas_object(batch.to_pandas(), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def percentile_max_length(lengths, percentile : float) -> int:
+    "Token length covering `percentile`% of the messages, rounded up to a multiple of 8 and capped at 512."
+    if percentile <= 0 or len(lengths) == 0:
+        return MAX_LENGTH
+    length = int(np.ceil(np.percentile(lengths, percentile) / LENGTH_MULTIPLE) * LENGTH_MULTIPLE)
+    return int(min(MAX_LENGTH, max(LENGTH_MULTIPLE, length)))
+
+
+def tokenize_cached(dataset : Dataset, name : str, num_proc : int, batch_size : int) -> Tuple[Dataset, str]:
+    """
+    Tokenizes `dataset` into TOKENIZED_CACHE_DIR/<content fingerprint>.arrow, or memory-maps
+    that file if the same data was tokenized before. One process goes through the on-disk
+    token cache; with num_proc > 1 every worker batch-encodes with the fast tokenizer instead,
+    since the token cache is not safe to append to from several processes.
+    """
+    TOKENIZED_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fingerprint = content_fingerprint(dataset, MAX_LENGTH)
+    cache_file = str(TOKENIZED_CACHE_DIR / f"{fingerprint}.arrow")
+    remove_columns = [c for c in ['__index_level_0__'] if c in dataset.column_names]
+
+    if num_proc > 1:
+        tokenized = dataset.map(encode_batch, batched=True, batch_size=batch_size, num_proc=num_proc,
+                                remove_columns=remove_columns, cache_file_name=cache_file,
+                                load_from_cache_file=True, desc=f"Tokenizing {name}")
+    else:
+        tokenized = dataset.map(tokenize_data, batched=True, batch_size=batch_size, remove_columns=remove_columns,
+                                cache_file_name=cache_file, load_from_cache_file=True, desc=f"Tokenizing {name}")
+    return tokenized, fingerprint
 
 
 def tokenize_data(data):
-    encoding = tokenizer(data['Messages'], truncation=True, padding=True, max_length=512)
-    return encoding
+    # No padding here, DataCollatorWithPadding pads every batch to its own longest message
+    input_ids = get_token_cache().encode(data['Messages'])
+    return {"input_ids": input_ids,
+            "token_type_ids": [[0] * len(ids) for ids in input_ids],
+            "attention_mask": [[1] * len(ids) for ids in input_ids],
+            "length": [len(ids) for ids in input_ids]}
 
 
 @step
-def tokenized_with_step(train_data, test_data) -> Tuple[Annotated[Dataset, "training_dataset"],
+@profiled
+def tokenized_with_step(train_data, test_data, num_proc : int = 1, batch_size : int = 1000,
+                        length_percentile : float = 99.5) -> Tuple[Annotated[Dataset, "training_dataset"],
                                        Annotated[Dataset, "test_dataset"]]:
-    train_dataset = Dataset.from_pandas(train_data)
-    test_dataset = Dataset.from_pandas(test_data)
+    # The streaming ingest already hands over Arrow-backed datasets
+    train_dataset = train_data if isinstance(train_data, Dataset) else Dataset.from_pandas(train_data)
+    test_dataset = test_data if isinstance(test_data, Dataset) else Dataset.from_pandas(test_data)
 
     for dataset, name in [(train_dataset, "training"), (test_dataset, "testing")]:
         if "Messages" not in dataset.column_names:
@@ -27,8 +132,38 @@ def tokenized_with_step(train_data, test_data) -> Tuple[Annotated[Dataset, "trai
         logging.info(f"{name} datasets are verfied both Messages and labels columns are present")
 
 
-    tokenized_train = train_dataset.map(tokenize_data, batched=True, remove_columns=["Messages", '__index_level_0__'])
-    tokenized_test = test_dataset.map(tokenize_data, batched=True, remove_columns=["Messages", '__index_level_0__'])
+    cache = get_token_cache()
+    hits, misses = cache.stats.hits, cache.stats.misses
+
+    tokenized_train, train_fingerprint = tokenize_cached(train_dataset, "training", num_proc, batch_size)
+    tokenized_test, test_fingerprint = tokenize_cached(test_dataset, "testing", num_proc, batch_size)
+
+    cache.flush()
+    run_hits, run_misses = cache.stats.hits - hits, cache.stats.misses - misses
+    hit_rate = run_hits / (run_hits + run_misses) if run_hits + run_misses else 0.0
+    logging.info(f"Token cache: {run_hits} hits, {run_misses} misses ({hit_rate:.1%} hit rate)")
+    if mlflow.active_run():
+        mlflow.log_metrics({"token_cache_hits": run_hits, "token_cache_misses": run_misses,
+                            "token_cache_hit_rate": hit_rate})
+
+    # max_length from the training lengths only, then applied to both splits
+    train_lengths = np.asarray(tokenized_train.with_format("numpy")["length"])
+    max_length = percentile_max_length(train_lengths, length_percentile)
+    truncated = float((train_lengths > max_length).mean()) if len(train_lengths) else 0.0
+    logging.info(f"max_length {max_length} covers the {length_percentile}th length percentile, "
+                 f"{truncated:.2%} of training messages are truncated")
+    if mlflow.active_run():
+        mlflow.log_params({"max_length": max_length, "length_percentile": length_percentile})
+        mlflow.log_metric("truncated_share", truncated)
+
+    if max_length < MAX_LENGTH:
+        sep_token_id = get_tokenizer().sep_token_id
+        tokenized_train, tokenized_test = [
+            dataset.map(truncate, batched=True, batch_size=batch_size,
+                        fn_kwargs={"max_length": max_length, "sep_token_id": sep_token_id},
+                        cache_file_name=str(TOKENIZED_CACHE_DIR / f"{fingerprint}_max{max_length}.arrow"),
+                        load_from_cache_file=True, desc=f"Truncating to {max_length}")
+            for dataset, fingerprint in [(tokenized_train, train_fingerprint), (tokenized_test, test_fingerprint)]]
 
     tokenized_train.set_format("torch", columns=["input_ids", "token_type_ids","attention_mask", "labels"])
     tokenized_test.set_format("torch", columns=["input_ids", "token_type_ids","attention_mask", "labels"])
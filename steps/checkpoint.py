@@ -0,0 +1,67 @@
+import logging
+import os
+import random
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import torch
+
+CHECKPOINT_FILE = "last.pt"
+BEST_FILE = "best.pt"
+
+
+def save_checkpoint(state : dict, path):
+    "Writes next to the target and renames over it, so a crash mid-write never leaves a truncated checkpoint."
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    torch.save(state, tmp)
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path) -> Optional[dict]:
+    path = Path(path)
+    if not path.exists():
+        return None
+    logging.info(f"Loading checkpoint {path}")
+    # Optimizer and RNG states are plain Python objects, not only tensors
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def rng_state() -> dict:
+    return {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+
+
+def set_rng_state(state : dict):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+
+
+class EarlyStopping:
+    "Stops training once the validation loss has not improved by `min_delta` for `patience` epochs."
+
+    def __init__(self, patience : int, min_delta : float = 0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.bad_epochs = 0
+        self.improved = False
+
+    def step(self, loss : float) -> bool:
+        self.improved = self.best is None or loss < self.best - self.min_delta
+        if self.improved:
+            self.best = loss
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+        return self.bad_epochs >= self.patience
+
+    def state_dict(self) -> dict:
+        return {"best": self.best, "bad_epochs": self.bad_epochs}
+
+    def load_state_dict(self, state : dict):
+        self.best = state["best"]
+        self.bad_epochs = state["bad_epochs"]
@@ -1,130 +1,188 @@
 import logging
 import pandas as pd
 from zenml import step
-from sklearn.model_selection import train_test_split
+from steps.profiling import profiled
 from typing import Annotated, Tuple
 from transformers import DataCollatorWithPadding
 from torch.utils.data import DataLoader
 from steps import bert_tokenizer
+from steps.sampler import LengthBucketBatchSampler, padding_ratio
+from steps.stream_ingest import in_test_split
+import numpy as np
 import mlflow
-from sklearn.utils import resample
-from collections import Counter
 from datetime import datetime
 
-@step(enable_cache=False)
-def clean(data : pd.DataFrame) -> pd.DataFrame:
-
-    df = data.copy()
-    original_df_shape = df.shape
-    if df.isnull().sum().sum() != 0:             
-        logging.info("Dropping missing values")
-        df.dropna(inplace=True)
-        df.reset_index(drop=True, inplace=True)
-    else:
-        logging.info("No Missing values found")
-
-    if df.duplicated().sum() != 0:
-        logging.info("Duplicated found and dropping it")
-        df.drop_duplicates(keep='first', inplace=True)
-        df.reset_index(drop=True, inplace=True)
-    else:
-        logging.info("No duplicated found")
-    
-    logging.info(f"Reduced from {original_df_shape} to {df.shape} after cleaning.")
-    return df
-
-
-@step
-def transform(data : pd.DataFrame) -> pd.DataFrame:
-
-    data = data.copy()
+BALANCE_STRATEGIES = ("fixed", "upsample", "downsample", "class_weights", "none")
+# Strategies that pick rows, which needs the whole training split in memory (not available with --streaming)
+RESAMPLING_STRATEGIES = ("fixed", "upsample", "downsample")
+# Label count difference above which the data counts as imbalanced
+IMBALANCE_THRESHOLD = 100
+
+
+def row_keys(data : pd.DataFrame, seed : int = 42) -> np.ndarray:
+    "A seeded 64-bit hash of every row's label and message, the order balancing picks rows in."
+    return pd.util.hash_pandas_object(data[['labels', 'Messages']], index=False,
+                                      hash_key=f"balance{seed % 10**9:09d}").to_numpy()
+
+
+def balance_indices(codes : np.ndarray, strategy : str, samples_per_class : int = 500, seed : int = 42,
+                    keys : np.ndarray = None) -> np.ndarray:
+    """
+    Row positions that make up the balanced dataset, class by class:
+    fixed - `samples_per_class` rows of every class (repeating rows only if a class is smaller)
+    upsample - every class repeated up to the largest one
+    downsample - every class cut down to the smallest one
+    class_weights / none - all rows; class_weights balances through the training loss instead
+    Within a class, rows are taken in the order of their `keys` (a content hash, see `row_keys`),
+    so adding rows to the corpus only changes the selection by those rows. A class smaller than
+    the target is repeated whole, and the remainder is filled in the same order.
+    Without `keys`, a seeded random order is used.
+    """
+    if strategy not in BALANCE_STRATEGIES:
+        raise ValueError(f"Unknown balancing strategy {strategy}, expected one of {BALANCE_STRATEGIES}")
+
+    groups = [np.flatnonzero(codes == label) for label in range(codes.max() + 1)] if len(codes) else []
+    if strategy in ("class_weights", "none") or not groups:
+        return np.arange(len(codes))
+
+    if keys is None:
+        keys = np.random.default_rng(seed).permutation(len(codes))
+    sizes = [len(group) for group in groups]
+    target = {"fixed": samples_per_class, "upsample": max(sizes), "downsample": min(sizes)}[strategy]
+
+    selected = []
+    for group in groups:
+        ordered = group[np.argsort(keys[group], kind="stable")]
+        if not len(ordered) or len(ordered) >= target:
+            selected.append(ordered[:target])
+        else:
+            selected.append(np.concatenate([np.tile(ordered, target // len(ordered)), ordered[:target % len(ordered)]]))
+    return np.concatenate(selected)
+
+
+def prepare_frame(data : pd.DataFrame) -> pd.DataFrame:
+    """
+    Cleaning and label encoding in one pass. Missing and duplicated rows are dropped through
+    a single boolean mask, labels are factorized in sorted order (so ham=0, spam=1 as before)
+    and the output frame is the only copy of the data that is made. Balancing happens after
+    the split (`balance_frame`), so resampled copies of a row never land in both partitions.
+    """
     if 'labels' not in data.columns:
         raise ValueError("Missing column labels in dataset")
-    
-    else:
-        unique_labels = sorted(data["labels"].unique())
-        label_map = {label: idx for idx, label in enumerate(unique_labels)}
-        logging.info("Encoding the labels....")
-        data['labels'] = data['labels'].map(label_map)
+    if 'Messages' not in data.columns:
+        raise ValueError("Missing column Messages in dataset")
 
-    return data
+    missing = data[['labels', 'Messages']].isna().any(axis=1).to_numpy()
+    duplicated = data.duplicated(subset=['labels', 'Messages'], keep='first').to_numpy()
+    rows = np.flatnonzero(~(missing | duplicated))
+    logging.info(f"Dropping {int(missing.sum())} missing and {int((duplicated & ~missing).sum())} duplicated rows, "
+                 f"reduced from {len(data)} to {len(rows)} rows after cleaning")
 
-def oversample_dataset(data : pd.DataFrame, labels_name : str = 'labels') -> pd.DataFrame:
+    codes, label_names = pd.factorize(data['labels'].to_numpy()[rows], sort=True)
+    logging.info(f"Label counts : {dict(zip(label_names, np.bincount(codes, minlength=len(label_names)).tolist()))}")
 
-    data = data.copy()
+    return pd.DataFrame({"labels": codes.astype(np.int64), "Messages": data['Messages'].to_numpy()[rows]})
 
-    # Upsample minority class
-    majority_class = data[data[labels_name] == 0]
-    minority_class = data[data[labels_name] == 1]
 
-    minority_resamples = resample(minority_class, replace=True, n_samples=len(majority_class), random_state=42)
+def balance_frame(data : pd.DataFrame, balance : str = "fixed", samples_per_class : int = 500,
+                  seed : int = 42) -> pd.DataFrame:
+    "The rows of an encoded frame picked by `balance_indices`, when its label counts are far enough apart."
+    codes = data['labels'].to_numpy()
+    label_counts = np.bincount(codes) if len(codes) else np.zeros(0, dtype=np.int64)
+    logging.info(f"Label counts before resampling : {dict(enumerate(label_counts.tolist()))}")
 
-    balanced_dataset = pd.concat([majority_class, minority_resamples], axis=0)
-    balanced_dataset.reset_index(drop = True, inplace = True)
-    
-    logging.info(f"Original dataset size : {data.shape}")
-    logging.info(f"Balanced dataset size : {balanced_dataset.shape}")
-
-    majority_class_sample = data[data[labels_name] == 0].sample(500)
-    minority_class_sample = data[data[labels_name] == 1].sample(500)
+    if len(label_counts) > 1 and label_counts.max() - label_counts.min() >= IMBALANCE_THRESHOLD:
+        logging.warning(f"Data is imbalanced, balancing with the {balance} strategy")
+        keys = row_keys(data, seed)
+        balanced = data.iloc[balance_indices(codes, balance, samples_per_class, seed, keys)].reset_index(drop=True)
+    else:
+        logging.info("Data is balanced")
+        balanced = data
 
-    dataset = pd.concat([majority_class_sample, minority_class_sample], axis=0)
-    dataset.reset_index(drop = True, inplace = True)
+    logging.info(f"Label counts after resampling : {balanced['labels'].value_counts().sort_index().to_dict()}")
+    return balanced
 
-    logging.info(f"Original dataset size : {data.shape}")
-    logging.info(f"Sample dataset size : {dataset.shape}")
 
-    return dataset
+@step
+@profiled
+def prepare(data : pd.DataFrame) -> pd.DataFrame:
+    prepared = prepare_frame(data)
+    if mlflow.active_run():
+        mlflow.log_param("prepared_rows", len(prepared))
+    return prepared
 
 @step
-def validation(data : pd.DataFrame) -> pd.DataFrame:
+@profiled
+def split(data : pd.DataFrame, balance : str = "fixed", samples_per_class : int = 500,
+          seed : int = 42) -> Tuple[Annotated[pd.DataFrame, "training_data"],
+                                    Annotated[pd.DataFrame, "testing_data"]]:
+    """
+    Routes every row by a hash of its message, as the streaming path does, so a message stays on
+    the same side as the corpus grows. Then balances the training partition only: the test set
+    keeps the real class mix and shares no resampled copy with the training set.
+    """
+    logging.info("Preparing the dataset with train and test")
 
-    new_data = data.copy()
-    logging.info("Checking class imbalance")
+    in_test = in_test_split(data['Messages'], test_size=0.2)
+    training_data, testing_data = data[~in_test], data[in_test]
+    training_data = balance_frame(training_data, balance, samples_per_class, seed)
+    if mlflow.active_run():
+        mlflow.log_params({"balance_strategy": balance, "samples_per_class": samples_per_class,
+                           "balance_seed": seed, "training_rows": len(training_data)})
+    return training_data, testing_data 
 
-    ham_count = (new_data['labels'] == 0).sum()
-    spam_count = (new_data['labels'] == 1).sum()
 
+def log_padding(lengths, sampler : LengthBucketBatchSampler, batch_size : int, name : str):
+    "Logs the padding ratio of the bucketed batches next to the one plain shuffled batches would have."
+    rng = np.random.default_rng(sampler.seed)
+    random_order = rng.permutation(len(lengths))
+    random_batches = [random_order[i:i + batch_size] for i in range(0, len(random_order), batch_size)]
 
-    is_imbalanced = abs(ham_count - spam_count) >= 100
+    bucketed = padding_ratio(lengths, sampler.batches())
+    unbucketed = padding_ratio(lengths, random_batches)
 
-    if is_imbalanced:
-        
-        label_counts = Counter(new_data['labels'])
-        logging.info(f"Label counts before resampling :  {label_counts}")
+    logging.info(f"{name} padding ratio: {bucketed:.3f} bucketed vs {unbucketed:.3f} shuffled")
+    if mlflow.active_run():
+        mlflow.log_metrics({f"{name}_padding_ratio": bucketed,
+                            f"{name}_padding_ratio_unbucketed": unbucketed})
 
-        logging.info("Difference in count %d", ham_count - spam_count)
-        logging.warning("Data is imbalanced")
-        new_data = oversample_dataset(new_data)
 
-        label_counts = Counter(new_data['labels'])
-        logging.info(f"Label counts after resampling :  {label_counts}")
+def make_loader(dataset, batch_size : int, shuffle : bool, name : str = None) -> DataLoader:
+    "A length-bucketed loader that pads every batch to its own longest sequence; logs the padding ratio when named."
+    collator = DataCollatorWithPadding(tokenizer=bert_tokenizer.get_tokenizer())
 
-        is_imbalanced = False
+    lengths = np.asarray(dataset.with_format("numpy")["length"])
+    sampler = LengthBucketBatchSampler(lengths, batch_size, shuffle=shuffle)
+    if name:
+        log_padding(lengths, sampler, batch_size, name)
 
-    else:
-        logging.info("Data is balanced")
+    return DataLoader(dataset, batch_sampler=sampler, collate_fn=collator)
 
-    return new_data  
-    
-@step
-def split(data : pd.DataFrame) -> Tuple[Annotated[pd.DataFrame, "training_data"],
-                                      Annotated[pd.DataFrame, "testing_data"]]:
-    logging.info("Preparing the dataset with train and test")
 
-    training_data, testing_data = train_test_split(data, test_size=0.2, random_state=42)
-    return training_data, testing_data 
+def subset_loader(loader : DataLoader, indices, shuffle : bool) -> DataLoader:
+    "The same kind of length-bucketed loader over only the rows at `indices`."
+    sampler = loader.batch_sampler
+    indices = np.sort(indices)
+    subset_sampler = LengthBucketBatchSampler(sampler.lengths[indices], sampler.batch_size, shuffle=shuffle,
+                                              bucket_width=sampler.bucket_width, seed=sampler.seed,
+                                              drop_last=sampler.drop_last)
+    return DataLoader(loader.dataset.select(indices), batch_sampler=subset_sampler, collate_fn=loader.collate_fn)
 
 
-@step
-def load(training, testing, batch_size) -> Tuple[Annotated[DataLoader, "training_batch"],
-                                      Annotated[DataLoader, "testing_batch"]]:
-    
-    logging.info("Applying padding to get same size for inputs")
+def holdout_split(loader : DataLoader, fraction : float, seed : int = 42) -> Tuple[DataLoader, DataLoader]:
+    "Splits a random held-out slice off a length-bucketed loader, for validation during training."
+    size = len(loader.dataset)
+    order = np.random.default_rng(seed).permutation(size)
+    held_out = min(size - 1, max(1, int(size * fraction)))
 
-    collator = DataCollatorWithPadding(tokenizer=bert_tokenizer.tokenizer)
+    return (subset_loader(loader, order[held_out:], loader.batch_sampler.shuffle),
+            subset_loader(loader, order[:held_out], False))
 
-    train_loader = DataLoader(training, batch_size=batch_size, shuffle=True, collate_fn=collator)
-    test_loader = DataLoader(testing, batch_size=batch_size, shuffle=False, collate_fn=collator)
 
-    return train_loader, test_loader
+def shard_loader(loader : DataLoader, num_replicas : int, rank : int) -> DataLoader:
+    "The same loader restricted to one rank's share of the length-bucketed batches."
+    sampler = loader.batch_sampler
+    shard = LengthBucketBatchSampler(sampler.lengths, sampler.batch_size, shuffle=sampler.shuffle,
+                                     bucket_width=sampler.bucket_width, seed=sampler.seed,
+                                     drop_last=sampler.drop_last, num_replicas=num_replicas, rank=rank)
+    return DataLoader(loader.dataset, batch_sampler=shard, collate_fn=loader.collate_fn)
@@ -0,0 +1,179 @@
+import copy
+import logging
+from typing import Annotated, Literal, Optional
+import mlflow
+import numpy as np
+import torch
+import torch.nn.functional as F
+from pydantic import BaseModel, Field
+from torch.utils.data import DataLoader
+from tqdm.auto import tqdm
+from transformers import BertForSequenceClassification
+from zenml import step
+from steps.profiling import profiled
+from steps.bert_tokenizer import get_tokenizer
+from steps.data_load import make_loader
+from steps.evaluation import evaluation_order
+from steps.handoff import load_split
+from steps.optimize import benchmark_backend
+from steps.training import TrainingConfig, autocast, peak_rss_mb
+
+# Row position of every training example, so each batch can look up its teacher logits
+ROW_COLUMN = "row"
+
+
+class DistillationConfig(BaseModel):
+    "How the student is built and trained. alpha weighs the hard labels against the teacher's soft labels."
+
+    # The student keeps the teacher's width and takes this many encoder layers, evenly spaced
+    student_layers: int = Field(default=4, ge=1)
+    temperature: float = Field(default=2.0, gt=0)
+    alpha: float = Field(default=0.5, ge=0, le=1)
+    precision: Literal["fp32", "bf16"] = "fp32"
+
+
+def student_from_teacher(teacher : BertForSequenceClassification, num_layers : int) -> BertForSequenceClassification:
+    """
+    A shallower copy of the teacher: same embeddings, pooler and classifier, and `num_layers`
+    encoder layers taken evenly from the bottom to the top of the teacher's stack.
+    """
+    teacher_layers = teacher.config.num_hidden_layers
+    if num_layers > teacher_layers:
+        raise ValueError(f"Student can not have more layers ({num_layers}) than the teacher ({teacher_layers})")
+
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = num_layers
+    student = BertForSequenceClassification(config)
+
+    kept = np.linspace(0, teacher_layers - 1, num_layers).round().astype(int)
+    state_dict = {}
+    for name, value in teacher.state_dict().items():
+        if name.startswith("bert.encoder.layer."):
+            layer, rest = name[len("bert.encoder.layer."):].split(".", 1)
+            if int(layer) not in kept:
+                continue
+            name = f"bert.encoder.layer.{int(np.flatnonzero(kept == int(layer))[0])}.{rest}"
+        state_dict[name] = value
+    student.load_state_dict(state_dict)
+
+    logging.info(f"Student keeps teacher layers {kept.tolist()} of {teacher_layers}")
+    return student
+
+
+def teacher_logits(teacher : BertForSequenceClassification, dataset, batch_size : int, device : str) -> torch.Tensor:
+    "The teacher's logit for every row of `dataset`, in dataset order."
+    loader = make_loader(dataset, batch_size, shuffle=False)
+    order = evaluation_order(loader)
+    logits = torch.empty(len(order), dtype=torch.float32)
+
+    teacher.to(device).eval()
+    offset = 0
+    with torch.inference_mode():
+        for batch in tqdm(loader, desc="Teacher soft labels"):
+            batch = {k: v.to(device) for k, v in batch.items() if k != "labels"}
+            output = teacher(**batch).logits.float().squeeze(-1).cpu()
+            logits[order[offset:offset + len(output)]] = output
+            offset += len(output)
+    return logits
+
+
+def distillation_loss(student_logits, soft_logits, labels, temperature : float, alpha : float):
+    """
+    alpha * BCE on the hard labels plus (1 - alpha) * BCE against the teacher's probabilities,
+    both softened by the temperature; the soft term is scaled by T^2 so its gradients keep their size.
+    """
+    hard = F.binary_cross_entropy_with_logits(student_logits, labels)
+    soft = F.binary_cross_entropy_with_logits(student_logits / temperature, torch.sigmoid(soft_logits / temperature))
+    return alpha * hard + (1 - alpha) * temperature ** 2 * soft
+
+
+def distill(student, training_data : DataLoader, soft_logits : torch.Tensor, epoch : int, lr : float,
+            config : DistillationConfig, device : str):
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+    precision = TrainingConfig(precision=config.precision)
+    student.to(device).train()
+
+    for epoch_idx in range(epoch):
+        training_data.batch_sampler.set_epoch(epoch_idx)
+        epoch_loss = 0.0
+        for batch in tqdm(training_data, desc=f"Distillation epoch {epoch_idx + 1}"):
+            rows = batch.pop(ROW_COLUMN)
+            batch = {k: v.to(device) for k, v in batch.items()}
+            labels = batch.pop("labels").float()
+
+            with autocast(device, precision):
+                logits = student(**batch).logits
+            loss = distillation_loss(logits.float().squeeze(1), soft_logits[rows].to(device), labels,
+                                     config.temperature, config.alpha)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item()
+
+        avg_loss = epoch_loss / len(training_data)
+        mlflow.log_metric("distillation_loss", avg_loss, step=epoch_idx)
+        logging.info(f"Epoch {epoch_idx + 1} distillation loss: {avg_loss:.5f}, peak RSS {peak_rss_mb():.0f} MB")
+
+    student.eval()
+    return student
+
+
+def size_mb(model) -> float:
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+
+
+@step(enable_cache=False)
+@profiled
+def distill_student(teacher : BertForSequenceClassification, dataset_manifest : dict, epoch : int, lr : float,
+                    config : Optional[DistillationConfig] = None) -> Annotated[BertForSequenceClassification, "student_model"]:
+    "Trains a shallower BERT on the teacher's soft labels plus the hard labels of the training split."
+    config = config or DistillationConfig()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    batch_size = dataset_manifest["batch_size"]
+
+    dataset = load_split(dataset_manifest, "train")
+    soft_logits = teacher_logits(teacher, dataset, batch_size, device)
+
+    dataset = dataset.with_format(None)
+    dataset = dataset.add_column(ROW_COLUMN, np.arange(len(dataset)))
+    dataset.set_format("torch", columns=["input_ids", "labels", ROW_COLUMN], dtype=torch.long)
+    training_data = make_loader(dataset, batch_size, shuffle=True)
+
+    student = student_from_teacher(teacher.to("cpu"), config.student_layers)
+    mlflow.log_params({"student_layers": config.student_layers,
+                       "teacher_layers": teacher.config.num_hidden_layers,
+                       "distillation_temperature": config.temperature,
+                       "distillation_alpha": config.alpha})
+
+    distill(student, training_data, soft_logits, epoch, lr, config, device)
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    mlflow.transformers.log_model(transformers_model={"model": student, "tokenizer": get_tokenizer()},
+                                  task="text-classification", name="student_model")
+    return student
+
+
+@step(enable_cache=False)
+@profiled
+def compare_models(teacher : BertForSequenceClassification, student : BertForSequenceClassification,
+                   dataset_manifest : dict) -> Annotated[dict, "distillation_report"]:
+    "Teacher and student accuracy, F1, size and CPU latency on the test split, side by side."
+    testing_batch = make_loader(load_split(dataset_manifest, "test"), dataset_manifest["batch_size"], shuffle=False)
+
+    report = {}
+    for name, model in [("teacher", teacher), ("student", student)]:
+        model = model.to("cpu").eval()
+        report[name] = {**benchmark_backend(model, testing_batch), "size_mb": size_mb(model),
+                        "layers": model.config.num_hidden_layers}
+        mlflow.log_metrics({f"{name}_{key}": value for key, value in report[name].items()})
+        logging.info(f"{name}: accuracy={report[name]['accuracy']:.4f} f1={report[name]['f1_score']:.4f} "
+                     f"{report[name]['batch_latency_ms']:.1f} ms/batch, {report[name]['size_mb']:.1f} MB")
+
+    report["speedup"] = report["teacher"]["batch_latency_ms"] / max(report["student"]["batch_latency_ms"], 1e-9)
+    report["size_ratio"] = report["student"]["size_mb"] / report["teacher"]["size_mb"]
+    mlflow.log_metrics({"student_speedup": report["speedup"], "student_size_ratio": report["size_ratio"]})
+    mlflow.log_dict(report, "distillation_report.json")
+    return report
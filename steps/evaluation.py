@@ -1,76 +1,171 @@
 import logging
 from zenml import step
-from typing import Tuple, Annotated
+from typing import Tuple, Annotated, Optional
+from pathlib import Path
 from transformers import BertForSequenceClassification
 import torch
 from torch.utils.data import DataLoader
 from strategy import metrics
 import mlflow
 from tqdm.auto import tqdm
-import pickle
-from pathlib import Path
+import numpy as np
 from steps import bert_tokenizer
+from serving.artifacts import BUNDLE_DIR, MANIFEST_FILE, load_bundle, save_bundle
+from serving.adapters import existing_adapter
+from steps.handoff import build_loader, published_prefilter
+from steps.profiling import profiled, torch_trace
 import pandas as pd
 
+DEPLOY_ACCURACY = 0.90
+DECISION_THRESHOLD = 0.5
+# 101 evenly spaced thresholds, so index 50 is exactly DECISION_THRESHOLD
+SWEEP_POINTS = 101
+
+
+def evaluation_order(testing_batch : DataLoader) -> np.ndarray:
+    "Dataset indices in the order the loader yields them (the length-sorted order of the test sampler)."
+    batch_sampler = testing_batch.batch_sampler
+    if hasattr(batch_sampler, "batches"):
+        batches = batch_sampler.batches()
+        return np.concatenate(batches) if batches else np.empty(0, dtype=np.int64)
+    return np.arange(len(testing_batch.dataset))
+
+
+def decision_metrics(model, testing_batch : DataLoader, device : str) -> dict:
+    "Accuracy and F1 of `model` on the test loader at DECISION_THRESHOLD."
+    TP = TN = FP = FN = 0
+    with torch.inference_mode():
+        for batch in testing_batch:
+            batch = {k:v.to(device, non_blocking=True) for k, v in batch.items()}
+            probs = torch.sigmoid(model(**batch).logits.float()).squeeze(-1)
+            counts = metrics.confusion_counts((probs >= DECISION_THRESHOLD).cpu().numpy(), batch['labels'].cpu().numpy())
+            TP, TN, FP, FN = (total + count for total, count in zip((TP, TN, FP, FN), counts))
+    scores = metrics.Metrics(TP, TN, FP, FN)
+    return {"accuracy": scores.accuracy(), "f1_score": scores.f1_score()}
+
+
+def holds_against_deployed(bundle_dir : str, testing_batch : DataLoader, device : str,
+                           accuracy : float, f1_score : float, tolerance : float) -> bool:
+    """
+    Whether accuracy and F1 are within `tolerance` of the bundle deployed in `bundle_dir` (true if there is none).
+    The deployed model is scored on the same test loader, since the metrics in its manifest come from an older test set.
+    """
+    if not (Path(bundle_dir) / MANIFEST_FILE).exists():
+        return True
+    deployed_model = load_bundle(bundle_dir)["model"].to(device)
+    deployed = decision_metrics(deployed_model, testing_batch, device)
+    del deployed_model
+    mlflow.log_metrics({f"deployed_{name}": value for name, value in deployed.items()})
+
+    holds = all(new >= deployed[name] - tolerance
+                for name, new in (("accuracy", accuracy), ("f1_score", f1_score)))
+    logging.info(f"Deployed model has accuracy {deployed['accuracy']:.4f}, F1 {deployed['f1_score']:.4f} on this test set; "
+                 f"this model {accuracy:.4f}, {f1_score:.4f} ({'holds' if holds else 'does not hold'} "
+                 f"within {tolerance})")
+    return holds
+
+
 @step(enable_cache=False)
+@profiled
 def evaluation_model(model : BertForSequenceClassification, 
-                     testing_batch : DataLoader) -> Tuple[Annotated[float, "accuracy"],
+                     dataset_manifest : dict,
+                     bundle_dir : str = str(BUNDLE_DIR),
+                     promote_tolerance : Optional[float] = None,
+                     adapter_path : Optional[str] = None) -> Tuple[Annotated[float, "accuracy"],
                                                                Annotated[float, "precision"],
                                                                Annotated[float, "recall"],
                                                                Annotated[float, "f1_score"]]:
 
     logging.info("Evaluation phase started")
+    testing_batch = build_loader(dataset_manifest, "test")
     model.eval()
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     model.to(device)
 
-    y_true = []
-    preds = []
+    order = evaluation_order(testing_batch)
+    n = len(order)
 
-    misclassified = []
+    thresholds = torch.arange(SWEEP_POINTS, device=device, dtype=torch.float32) / (SWEEP_POINTS - 1)
+    decision_index = int(round(DECISION_THRESHOLD * (SWEEP_POINTS - 1)))
 
-    no_of_steps = len(testing_batch)
+    # Confusion counts for every threshold are accumulated on the device, batch by batch,
+    # instead of collecting Python lists and counting them afterwards
+    true_positives = torch.zeros(SWEEP_POINTS, dtype=torch.long, device=device)
+    false_positives = torch.zeros(SWEEP_POINTS, dtype=torch.long, device=device)
+    positives = torch.zeros((), dtype=torch.long, device=device)
 
-    for batch in tqdm(testing_batch, total=no_of_steps):
-        batch = {k:v.to(device) for k, v in batch.items()}
+    probs_buffer = torch.empty(n, dtype=torch.float32, device=device)
+    labels_buffer = torch.empty(n, dtype=torch.long, device=device)
+    offset = 0
 
-        labels = batch['labels'].float()
+    with torch.inference_mode(), torch_trace("evaluation") as trace_step:
+        for batch in tqdm(testing_batch, total=len(testing_batch)):
+            batch = {k:v.to(device, non_blocking=True) for k, v in batch.items()}
+            labels = batch['labels'].long()
 
-        with torch.no_grad():
-            output = model(**batch)
-        
-        logits = output.logits
-        probs = torch.sigmoid(logits).squeeze(-1)
-        predictions= (probs >= 0.5).long()
-        preds.extend(predictions.cpu().tolist())          
-        y_true.extend(batch['labels'].cpu().tolist())     
-        
-        for true_label, predicted_label in zip(labels.tolist(), predictions.tolist()):
-            if true_label != predicted_label:
-                misclassified.append({"true_label": true_label,
-                                      "predicted_label": predicted_label})
-                
-    if misclassified:
-        df_misclassified = pd.DataFrame(misclassified)
+            probs = torch.sigmoid(model(**batch).logits.float()).squeeze(-1)
+
+            predicted = probs.unsqueeze(1) >= thresholds
+            is_positive = labels.bool().unsqueeze(1)
+            true_positives += (predicted & is_positive).sum(dim=0)
+            false_positives += (predicted & ~is_positive).sum(dim=0)
+            positives += labels.sum()
+
+            size = labels.shape[0]
+            probs_buffer[offset:offset + size] = probs
+            labels_buffer[offset:offset + size] = labels
+            offset += size
+            trace_step()
+
+    logging.info("Testing is finished")
+
+    # One device to host copy for the whole test set, put back in dataset order
+    probs = np.empty(n, dtype=np.float32)
+    y_true = np.empty(n, dtype=np.int64)
+    probs[order] = probs_buffer.cpu().numpy()
+    y_true[order] = labels_buffer.cpu().numpy()
+
+    TP = true_positives.cpu().numpy()
+    FP = false_positives.cpu().numpy()
+    P = int(positives.item())
+    FN = P - TP
+    TN = (n - P) - FP
+
+    sweep = metrics.Metrics(TP, TN, FP, FN)
+    precision_curve = sweep.precision()
+    recall_curve = sweep.recall()
+    f1_curve = sweep.f1_score(precision=precision_curve, recall=recall_curve)
+    best = int(np.argmax(f1_curve))
+
+    curve = pd.DataFrame({"threshold": thresholds.cpu().numpy(), "true_positives": TP, "false_positives": FP,
+                          "true_negatives": TN, "false_negatives": FN, "precision": precision_curve,
+                          "recall": recall_curve, "f1_score": f1_curve,
+                          "false_positive_rate": sweep.false_positive_rate()})
+    curve.to_csv("threshold_sweep.csv", index=False)
+    mlflow.log_artifact("threshold_sweep.csv")
+
+    mlflow.log_metrics({"best_f1_threshold": float(curve["threshold"][best]),
+                        "best_f1_score": float(f1_curve[best])})
+    roc_auc = metrics.roc_auc(probs, y_true)
+    if np.isnan(roc_auc):
+        logging.warning("The test set holds a single class, ROC-AUC is undefined and not logged")
+    else:
+        mlflow.log_metric("roc_auc", roc_auc)
+
+    predictions = (probs >= DECISION_THRESHOLD).astype(np.int64)
+    wrong = np.flatnonzero(predictions != y_true)
+    if len(wrong):
+        messages = testing_batch.dataset.with_format(None).select(wrong)["Messages"] \
+            if "Messages" in testing_batch.dataset.column_names else [None] * len(wrong)
+        df_misclassified = pd.DataFrame({"message": messages, "true_label": y_true[wrong],
+                                         "predicted_label": predictions[wrong], "probability": probs[wrong]})
         df_misclassified.to_csv("misclassified_samples_test.csv", index=False)
         logging.info(f"Saved {len(df_misclassified)} misclassified samples to CSV.")
     else:
         logging.info("No misclassified samples found")
 
-    logging.info("Testing is finished")
-
-    TP = TN = FP = FN = 0
-
-    for i in range(len(preds)):
-        if y_true[i] == 1 and preds[i] == 1:
-            TP += 1
-        elif y_true[i] == 0 and preds[i] == 0:
-            TN += 1
-        elif y_true[i] == 1 and preds[i] == 0:
-            FN += 1
-        elif y_true[i] == 0 and preds[i] == 1:
-            FP += 1
+    TP, TN, FP, FN = (int(count[decision_index]) for count in (TP, TN, FP, FN))
 
     mlflow.log_metrics({"true_positives":TP,
                         "true_negatives":TN,
@@ -88,18 +183,20 @@ def evaluation_model(model : BertForSequenceClassification,
 
     params = run.data.params
 
-    if accuracy >= 0.90:
-        model_dict = {"model":model, "metrics" : {"accuracy": accuracy, "f1_score": f1_score}, 
-                      "params": params,
-                      "mlflow_run_id": run_id,"tokenizer":bert_tokenizer.tokenizer}
-
-        save_path = Path("saved_model")
-        save_path.mkdir(exist_ok=True, parents=True)
-        torch.save(model_dict, save_path / "model.pkl")
+    # Incremental retraining also has to hold up against the model it would replace
+    promote = accuracy >= DEPLOY_ACCURACY and (
+        promote_tolerance is None or holds_against_deployed(bundle_dir, testing_batch, device,
+                                                            accuracy, f1_score, promote_tolerance))
+    mlflow.log_metric("promoted", int(promote))
+
+    if promote:
+        # A model trained with adapters is deployed as its adapter weights only
+        save_bundle(model, bert_tokenizer.get_tokenizer(), bundle_dir,
+                    metrics={"accuracy": accuracy, "f1_score": f1_score},
+                    params=params, mlflow_run_id=run_id, adapter=existing_adapter(adapter_path),
+                    prefilter=published_prefilter(dataset_manifest))
         logging.info("Model is saved for deployment")
     else:
         logging.info("Not good enough to save the model")
         
     return accuracy, precision, recall, f1_score
-
-
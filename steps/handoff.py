@@ -0,0 +1,187 @@
+import json
+import logging
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Annotated, Optional
+import datasets
+import numpy as np
+import pandas as pd
+import torch
+from datasets import Dataset
+from torch.utils.data import DataLoader
+from zenml import step
+from steps.profiling import profiled
+from steps import bert_tokenizer
+from steps.data_load import make_loader
+
+HANDOFF_DIR = Path("data/tokenized")
+MANIFEST_FILE = "manifest.json"
+# Bump when the published columns or their layout change, so stale directories are rejected
+FORMAT_VERSION = 1
+# attention_mask is rebuilt by the collator and BERT defaults token_type_ids to zeros, so neither is stored
+COLUMNS = ["input_ids", "labels", "length", "Messages"]
+TENSOR_COLUMNS = ["input_ids", "labels"]
+MAX_SHARD_SIZE = "128MB"
+SPLITS = ("train", "test")
+# Per split: a content hash of every row, and the positions of the rows the previous publish did not have
+ROW_HASHES_FILE = "{split}_row_hashes.npy"
+NEW_ROWS_FILE = "{split}_new_rows.npy"
+# Every training row hash published so far, kept out of later test splits
+TRAINED_HASHES_FILE = "trained_row_hashes.npy"
+
+
+def compact(dataset : Dataset) -> Dataset:
+    "Only the columns the loaders need, with token ids narrowed to int32 on disk."
+    dataset = dataset.with_format(None).select_columns([c for c in COLUMNS if c in dataset.column_names])
+    if dataset.features["input_ids"].feature.dtype != "int32":
+        dataset = dataset.cast_column("input_ids", datasets.List(datasets.Value("int32")))
+    return dataset
+
+
+def row_hashes(dataset : Dataset) -> np.ndarray:
+    "A 64-bit hash of the label and message of every row, in row order."
+    hashes = [pd.util.hash_pandas_object(batch.to_pandas(), index=False).to_numpy()
+              for batch in dataset.select_columns(["labels", "Messages"]).with_format("arrow").iter(batch_size=100_000)]
+    return np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+
+
+def previous_row_hashes(directory : Path, split : str) -> Optional[np.ndarray]:
+    path = directory / ROW_HASHES_FILE.format(split=split)
+    return np.load(path) if path.exists() else None
+
+
+def previously_trained_hashes(directory : Path) -> np.ndarray:
+    "Hashes of every row an earlier publish put in a training split (older publishes only kept the last one)."
+    path = directory / TRAINED_HASHES_FILE
+    if path.exists():
+        return np.load(path)
+    previous = previous_row_hashes(directory, "train")
+    return np.unique(previous) if previous is not None else np.empty(0, dtype=np.uint64)
+
+
+def directory_size(path : Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def publish_splits(splits : dict, batch_size : int, output_dir=HANDOFF_DIR, prefilter : Optional[dict] = None) -> dict:
+    """
+    Writes every split as sharded Arrow files under `output_dir` and returns the manifest.
+    The splits are written next to the old directory first and swapped in afterwards, so a reader never sees a half-written one.
+    Rows are hashed by content and compared with the previous publish, so incremental training can find the new ones.
+    Test rows that any publish so far trained on are dropped, so a warm-started model is never scored on its training data.
+    """
+    output_dir = Path(output_dir).resolve()
+    staging = output_dir.with_name(output_dir.name + ".tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+
+    manifest = {"format_version": FORMAT_VERSION,
+                "directory": str(output_dir),
+                "batch_size": batch_size,
+                "tokenizer": bert_tokenizer.MODEL_NAME,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                # The cascade prefilter fitted on these splits, which evaluation bundles with the model
+                "prefilter": prefilter,
+                "splits": {}}
+
+    splits = {name: compact(dataset) for name, dataset in splits.items()}
+    split_hashes = {name: row_hashes(dataset) for name, dataset in splits.items()}
+    trained = np.union1d(previously_trained_hashes(output_dir), split_hashes.get("train", np.empty(0, dtype=np.uint64)))
+    np.save(staging / TRAINED_HASHES_FILE, trained)
+
+    for name, dataset in splits.items():
+        hashes = split_hashes[name]
+        if name != "train":
+            seen = np.isin(hashes, trained)
+            if seen.any():
+                logging.warning(f"Dropping {int(seen.sum())} {name} rows that were already trained on")
+                dataset, hashes = dataset.select(np.flatnonzero(~seen)), hashes[~seen]
+        dataset.save_to_disk(str(staging / name), max_shard_size=MAX_SHARD_SIZE)
+
+        previous = previous_row_hashes(output_dir, name)
+        new_rows = np.flatnonzero(~np.isin(hashes, previous)) if previous is not None else np.arange(len(hashes))
+        np.save(staging / ROW_HASHES_FILE.format(split=name), hashes)
+        np.save(staging / NEW_ROWS_FILE.format(split=name), new_rows)
+
+        manifest["splits"][name] = {"rows": len(dataset),
+                                    "new_rows": len(new_rows),
+                                    "columns": dataset.column_names,
+                                    "shards": len(list((staging / name).glob("*.arrow"))),
+                                    "bytes": directory_size(staging / name)}
+        logging.info(f"Published {len(dataset)} {name} rows, {len(new_rows)} of them new "
+                     f"({manifest['splits'][name]['bytes'] / 2**20:.1f} MB)")
+
+    (staging / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+
+    previous = output_dir.with_name(output_dir.name + ".old")
+    shutil.rmtree(previous, ignore_errors=True)
+    if output_dir.exists():
+        output_dir.rename(previous)
+    staging.rename(output_dir)
+    shutil.rmtree(previous, ignore_errors=True)
+    return manifest
+
+
+def read_manifest(path=HANDOFF_DIR) -> dict:
+    "The manifest written by the last `publish` into `path`."
+    manifest = json.loads((Path(path) / MANIFEST_FILE).read_text())
+    check_manifest(manifest)
+    return manifest
+
+
+def check_manifest(manifest : dict):
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Tokenized dataset has format version {manifest.get('format_version')}, "
+                         f"expected {FORMAT_VERSION}; rerun the processing pipeline")
+    if not Path(manifest["directory"]).is_dir():
+        raise FileNotFoundError(f"Tokenized dataset directory {manifest['directory']} does not exist; "
+                                f"rerun the processing pipeline")
+
+
+def load_split(manifest : dict, split : str) -> Dataset:
+    "Memory-maps one published split, formatted for the collator."
+    check_manifest(manifest)
+    if split not in manifest["splits"]:
+        raise KeyError(f"Split {split} not in the tokenized dataset, found {list(manifest['splits'])}")
+
+    dataset = datasets.load_from_disk(str(Path(manifest["directory"]) / split))
+    dataset.set_format("torch", columns=TENSOR_COLUMNS, dtype=torch.long)
+    return dataset
+
+
+def new_row_indices(manifest : dict, split : str) -> np.ndarray:
+    "Positions in `split` of the rows the publish before this one did not have (all rows for a first publish)."
+    check_manifest(manifest)
+    path = Path(manifest["directory"]) / NEW_ROWS_FILE.format(split=split)
+    if not path.exists():
+        raise FileNotFoundError(f"{path} does not exist, the dataset was published before new rows were tracked; "
+                                f"rerun the processing pipeline")
+    return np.load(path)
+
+
+def published_prefilter(dataset_manifest : dict) -> Optional[Path]:
+    "The prefilter trained on the published splits, if the processing run trained one and it is still there."
+    prefilter = dataset_manifest.get("prefilter")
+    if not prefilter:
+        return None
+    directory = Path(prefilter["directory"])
+    if not directory.is_dir():
+        logging.warning(f"Prefilter directory {directory} does not exist; rerun the processing pipeline")
+        return None
+    return directory
+
+
+def build_loader(manifest : dict, split : str, batch_size : Optional[int] = None) -> DataLoader:
+    "A length-bucketed loader over a published split; only the training split is shuffled."
+    return make_loader(load_split(manifest, split), batch_size or manifest["batch_size"],
+                       shuffle=split == "train", name=split)
+
+
+@step(enable_cache=False)
+@profiled
+def publish(training : Dataset, testing : Dataset, batch_size : int,
+            prefilter : Optional[dict] = None) -> Annotated[dict, "dataset_manifest"]:
+    "Hands the tokenized splits (and the prefilter fitted on them) to the training and evaluation pipelines as files on disk plus a small manifest."
+    logging.info(f"Publishing the tokenized dataset to {HANDOFF_DIR}")
+    return publish_splits({"train": training, "test": testing}, batch_size, prefilter=prefilter)
@@ -1,5 +1,6 @@
 import logging
 from zenml import step
+from steps.profiling import profiled
 import pandas as pd
 
 class Ingest:
@@ -12,6 +13,7 @@ class Ingest:
         return pd.read_csv(self.path, sep='\t', names=['labels', 'Messages'])
     
 @step(enable_cache=False)
+@profiled
 def ingester(data_path : str) -> pd.DataFrame:
 
     try:
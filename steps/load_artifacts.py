@@ -1,9 +1,33 @@
 from zenml.client import Client
-from torch.utils.data import DataLoader
 from zenml import step
-from typing import Tuple
+from steps.profiling import profiled
+from typing import Annotated, Optional, Tuple
+from functools import lru_cache
+
+@lru_cache(maxsize=128)
+def get_artifact_version(artifact_id):
+    """
+    Artifact versions are immutable, so each one is looked up once per process. Only the
+    lookup is cached: a cached model would stay in memory for the life of the process.
+    """
+    client = Client()
+    try:
+        return client.get_artifact_version(artifact_id)
+    except Exception as e:
+        raise RuntimeError(f"Failed to retrieve artifact version '{artifact_id}': {e}")
 
-def load_artifact_from_pipeline(pipeline_name: str, step_name: str, output_name: str):
+
+def load_artifact_version(artifact_id):
+    "Deserializes the artifact, a new object on every call, so callers may modify what they get."
+    artifact = get_artifact_version(artifact_id)
+    try:
+        return artifact.load()
+    except Exception as e:
+        raise RuntimeError(f"Failed to load artifact content from '{artifact.name}': {e}")
+
+
+def load_artifacts_from_pipeline(pipeline_name: str, step_name: str, *output_names: str) -> tuple:
+    "Several outputs of one step of the last run, looking the run up only once."
     client = Client()
     pipeline_obj = client.get_pipeline(pipeline_name)
     last_run = pipeline_obj.last_successful_run or pipeline_obj.last_run
@@ -17,6 +41,10 @@ def load_artifact_from_pipeline(pipeline_name: str, step_name: str, output_name:
     step_obj = last_run.steps[step_name]
     outputs = step_obj.outputs
 
+    return tuple(load_output(outputs, step_name, output_name) for output_name in output_names)
+
+
+def load_output(outputs, step_name: str, output_name: str):
     if output_name not in outputs:
         raise RuntimeError(f"Output '{output_name}' not found in step '{step_name}' outputs")
 
@@ -36,36 +64,30 @@ def load_artifact_from_pipeline(pipeline_name: str, step_name: str, output_name:
     if artifact_id is None:
         raise RuntimeError(f"Artifact version does not contain a valid ID.")
 
-    try:
-        artifact = client.get_artifact_version(artifact_id)
-    except Exception as e:
-        raise RuntimeError(f"Failed to retrieve artifact version '{artifact_id}': {e}")
+    return load_artifact_version(artifact_id)
 
-    try:
-        loaded_data = artifact.load()
-    except Exception as e:
-        raise RuntimeError(f"Failed to load artifact content from '{artifact.name}': {e}")
 
-    return loaded_data
+def load_artifact_from_pipeline(pipeline_name: str, step_name: str, output_name: str):
+    return load_artifacts_from_pipeline(pipeline_name, step_name, output_name)[0]
 
 
 @step(enable_cache=False)
-def load_training_pipeline() -> DataLoader:
-    return load_artifact_from_pipeline("processing", "load", "training_batch")
+@profiled
+def load_dataset_manifest() -> Annotated[dict, "dataset_manifest"]:
+    return load_artifact_from_pipeline("processing", "publish", "dataset_manifest")
 
 @step(enable_cache=False)
-def load_testing_pipeline() -> DataLoader:
-    return load_artifact_from_pipeline("processing", "load", "testing_batch")
+@profiled
+def load_trained_model():
+    return load_artifact_from_pipeline("model_training", "training_model", "model")
 
 @step(enable_cache=False)
-def load_trained_model():
-    return load_artifact_from_pipeline("model_training", "training_model", "output")
+@profiled
+def load_trained_adapter() -> Annotated[Optional[str], "adapter_path"]:
+    return load_artifact_from_pipeline("model_training", "training_model", "adapter_path")
 
 @step(enable_cache=False)
+@profiled
 def load_scores() -> Tuple[float, float, float, float]:
-    accuracy = load_artifact_from_pipeline("model_evaluation_pipeline", "evaluation_model", "accuracy")
-    precision = load_artifact_from_pipeline("model_evaluation_pipeline", "evaluation_model", "precision")
-    recall = load_artifact_from_pipeline("model_evaluation_pipeline", "evaluation_model", "recall")
-    f1_score = load_artifact_from_pipeline("model_evaluation_pipeline", "evaluation_model", "f1_score")
-
-    return accuracy, precision, recall, f1_score
+    return load_artifacts_from_pipeline("model_evaluation_pipeline", "evaluation_model",
+                                        "accuracy", "precision", "recall", "f1_score")
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Annotated
+import mlflow
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertForSequenceClassification
+from zenml import step
+from steps.profiling import profiled
+from serving.backends import OPTIMIZED_DIR, OnnxModel, export_onnx, load_int8, quantize_int8
+from serving.artifacts import BUNDLE_DIR, MANIFEST_FILE, read_manifest
+from steps.evaluation import DEPLOY_ACCURACY
+from steps.handoff import build_loader
+from strategy.metrics import Metrics, confusion_counts
+
+
+def benchmark_backend(model, testing_batch : DataLoader) -> dict:
+    "Scores the test set with one backend and measures its accuracy, F1 and CPU speed."
+    TP = TN = FP = FN = 0
+    samples = 0
+    elapsed = 0.0
+
+    for batch in testing_batch:
+        labels = batch['labels'].long()
+
+        start = time.perf_counter()
+        with torch.inference_mode():
+            logits = model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask']).logits
+        elapsed += time.perf_counter() - start
+
+        preds = torch.sigmoid(logits).squeeze(-1) >= 0.5
+        counts = confusion_counts(preds.numpy(), labels.numpy())
+        TP, TN, FP, FN = (total + count for total, count in zip((TP, TN, FP, FN), counts))
+        samples += len(labels)
+
+    metrics = Metrics(TP, TN, FP, FN)
+    return {"accuracy": metrics.accuracy(), "f1_score": metrics.f1_score(),
+            "samples_per_sec": samples / elapsed if elapsed else 0.0,
+            "batch_latency_ms": 1000 * elapsed / max(len(testing_batch), 1)}
+
+
+def file_size_mb(path : Path) -> float:
+    return os.path.getsize(path) / 2**20
+
+
+@step(enable_cache=False)
+@profiled
+def optimize_model(model : BertForSequenceClassification, dataset_manifest : dict,
+                   accuracy : float, f1_score : float,
+                   tolerance : float = 0.01) -> Annotated[dict, "serving_backends"]:
+    """
+    Builds the CPU serving artifacts: a dynamically quantized int8 model and an ONNX export run
+    through a graph-optimized ONNX Runtime session. A backend is only accepted when its accuracy
+    and F1 stay within `tolerance` of the fp32 model evaluated by `evaluation_model`.
+    """
+    if accuracy < DEPLOY_ACCURACY:
+        logging.info("Model was not saved for deployment, skipping serving optimizations")
+        return {}
+
+    # The artifacts record the bundle they were built from, so the server never pairs them with another one
+    run = mlflow.active_run()
+    bundle = read_manifest(BUNDLE_DIR) if (BUNDLE_DIR / MANIFEST_FILE).exists() else None
+    if bundle is None or run is None or bundle["mlflow_run_id"] != run.info.run_id:
+        logging.info(f"The bundle in {BUNDLE_DIR} was not written by this run's evaluation, skipping serving optimizations")
+        return {}
+
+    model = model.to("cpu").eval()
+    testing_batch = build_loader(dataset_manifest, "test")
+    save_path = Path(OPTIMIZED_DIR)
+    save_path.mkdir(exist_ok=True, parents=True)
+
+    results = {"torch": {"path": None, **benchmark_backend(model, testing_batch),
+                         "size_mb": sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20}}
+
+    torch.save(quantize_int8(model).state_dict(), save_path / "model_int8.pt")
+    try:
+        # Benchmark the artifact exactly as the server will load it, so one that cannot be loaded is never accepted
+        quantized = load_int8(model, save_path / "model_int8.pt")
+        results["int8"] = {"path": "model_int8.pt", **benchmark_backend(quantized, testing_batch),
+                           "size_mb": file_size_mb(save_path / "model_int8.pt")}
+    except Exception:
+        logging.exception("The int8 artifact does not load back, leaving it out of the manifest")
+
+    export_onnx(model, save_path / "model.onnx")
+    # The session writes its graph-optimized model, which the server then loads directly
+    OnnxModel(save_path / "model.onnx", optimized_path=save_path / "model.optimized.onnx")
+    onnx_model = OnnxModel(save_path / "model.optimized.onnx")
+    results["onnx"] = {"path": "model.optimized.onnx", **benchmark_backend(onnx_model, testing_batch),
+                       "size_mb": file_size_mb(save_path / "model.optimized.onnx")}
+
+    for backend, result in results.items():
+        result["accepted"] = backend == "torch" or (accuracy - result["accuracy"] <= tolerance and
+                                                    f1_score - result["f1_score"] <= tolerance)
+
+        mlflow.log_metrics({f"{backend}_{name}": value for name, value in result.items()
+                            if isinstance(value, float)})
+        logging.info(f"{backend}: accuracy={result['accuracy']:.4f} f1={result['f1_score']:.4f} "
+                     f"{result['samples_per_sec']:.1f} samples/sec, {result['size_mb']:.1f} MB, "
+                     f"accepted={result['accepted']}")
+
+    mlflow.log_param("serving_tolerance", tolerance)
+    manifest = {**results, "source": {"weights_sha256": bundle["weights_sha256"], "mlflow_run_id": bundle["mlflow_run_id"]}}
+    (save_path / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+    return results
@@ -0,0 +1,111 @@
+import logging
+import time
+from pathlib import Path
+from typing import Annotated, Tuple
+import mlflow
+import numpy as np
+import pandas as pd
+import torch
+from transformers import BertForSequenceClassification
+from zenml import step
+from serving.cascade import DEFAULT_BAND, PREFILTER_DIR, band_sweep, build_prefilter, load_prefilter, save_prefilter
+from steps.data_load import make_loader
+from steps.evaluation import DECISION_THRESHOLD, evaluation_order
+from steps.handoff import load_split, published_prefilter
+from steps.profiling import profiled
+from strategy.metrics import Metrics, confusion_counts
+
+# Symmetric bands around the decision threshold scored by evaluate_cascade, from "never escalate" to "always"
+SWEEP_HALF_WIDTHS = np.round(np.linspace(0, 0.5, 11), 2)
+
+
+def texts_and_labels(data) -> Tuple[list, np.ndarray]:
+    "Messages and labels of a pandas split or of an Arrow-backed split from the streaming path."
+    if isinstance(data, pd.DataFrame):
+        return data["Messages"].astype(str).tolist(), data["labels"].to_numpy()
+    data = data.with_format(None)
+    return [str(text) for text in data["Messages"]], np.asarray(data["labels"])
+
+
+@step(enable_cache=False)
+@profiled
+def train_prefilter(training, testing) -> Annotated[dict, "prefilter"]:
+    """
+    Fits the TF-IDF + logistic regression first stage of the serving cascade on the cleaned training split.
+    Returns where it was saved and its metrics; `publish` records them in the dataset manifest.
+    """
+    train_texts, train_labels = texts_and_labels(training)
+    test_texts, test_labels = texts_and_labels(testing)
+
+    start = time.perf_counter()
+    prefilter = build_prefilter().fit(train_texts, train_labels)
+    fit_seconds = time.perf_counter() - start
+
+    predictions = prefilter.predict_proba(test_texts)[:, 1] >= DECISION_THRESHOLD
+    metrics = Metrics(*confusion_counts(predictions, test_labels))
+    results = {"prefilter_accuracy": metrics.accuracy(), "prefilter_f1_score": metrics.f1_score(),
+               "prefilter_fit_seconds": fit_seconds}
+    logging.info(f"Prefilter accuracy {results['prefilter_accuracy']:.4f}, F1 {results['prefilter_f1_score']:.4f} "
+                 f"(fit in {fit_seconds:.1f}s)")
+    if mlflow.active_run():
+        mlflow.log_metrics(results)
+
+    directory = save_prefilter(prefilter, PREFILTER_DIR, results)
+    return {"directory": str(Path(directory).resolve()), "metrics": results}
+
+
+@step(enable_cache=False)
+@profiled
+def evaluate_cascade(model : BertForSequenceClassification, dataset_manifest : dict,
+                     band : Tuple[float, float] = DEFAULT_BAND) -> Annotated[dict, "cascade_metrics"]:
+    """
+    Scores the test split with the prefilter and with the model once, then reports the cascade's
+    accuracy, escalated fraction and mean per-message latency for `band` and for a sweep of bands.
+    """
+    prefilter_dir = published_prefilter(dataset_manifest)
+    if prefilter_dir is None:
+        logging.warning("No prefilter was published with the dataset, skipping the cascade evaluation")
+        return {}
+
+    dataset = load_split(dataset_manifest, "test")
+    texts, labels = texts_and_labels(dataset)
+    prefilter = load_prefilter(prefilter_dir)
+
+    start = time.perf_counter()
+    prefilter_probs = prefilter.predict_proba(texts)[:, 1]
+    prefilter_seconds = time.perf_counter() - start
+
+    model = model.to("cpu").eval()
+    loader = make_loader(dataset, dataset_manifest["batch_size"], shuffle=False)
+    order = evaluation_order(loader)
+    model_probs = np.empty(len(order), dtype=np.float32)
+    offset = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for batch in loader:
+            logits = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]).logits
+            probs = torch.sigmoid(logits.float()).squeeze(-1).numpy()
+            model_probs[order[offset:offset + len(probs)]] = probs
+            offset += len(probs)
+    model_seconds = time.perf_counter() - start
+
+    low, high = band
+    bands = [(low, high)] + [(0.5 - w, 0.5 + w) for w in SWEEP_HALF_WIDTHS]
+    sweep = band_sweep(prefilter_probs, model_probs, labels, prefilter_seconds, model_seconds, bands,
+                       DECISION_THRESHOLD)
+    chosen = sweep[0]
+
+    results = {"cascade_accuracy": chosen["accuracy"], "cascade_f1_score": chosen["f1_score"],
+               "cascade_escalated_fraction": chosen["escalated_fraction"],
+               "cascade_mean_latency_ms": chosen["mean_latency_ms"],
+               "model_only_latency_ms": 1000 * model_seconds / max(len(labels), 1)}
+    logging.info(f"Cascade band [{low}, {high}]: accuracy {chosen['accuracy']:.4f}, "
+                 f"{chosen['escalated_fraction']:.1%} escalated, {chosen['mean_latency_ms']:.2f} ms/message "
+                 f"vs {results['model_only_latency_ms']:.2f} ms/message for the model alone")
+
+    if mlflow.active_run():
+        mlflow.log_params({"cascade_low": low, "cascade_high": high})
+        mlflow.log_metrics(results)
+        pd.DataFrame(sweep[1:]).to_csv("cascade_band_sweep.csv", index=False)
+        mlflow.log_artifact("cascade_band_sweep.csv")
+    return results
@@ -0,0 +1,233 @@
+"""
+Opt-in profiling of pipeline steps.
+
+`run_pipeline.py --profile-dir DIR` sets PROFILE_DIR_ENV before the pipelines run. Every step
+wrapped with `profiled` then appends its wall time, CPU time and peak RSS to DIR/steps.jsonl
+and logs them to the active MLflow run. The gap between one step ending and the next one
+starting is recorded as the step's handoff time: that is where ZenML stores the previous
+step's outputs and loads this step's inputs. Training and evaluation also write torch profiler
+traces. `write_report` turns the records into a Chrome trace and a per-step summary.
+
+Without the environment variable the wrappers call straight through.
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+import mlflow
+import pandas as pd
+
+PROFILE_DIR_ENV = "PIPELINE_PROFILE_DIR"
+STEPS_FILE = "steps.jsonl"
+TRACE_FILE = "pipeline_trace.json"
+SUMMARY_FILE = "step_profile.csv"
+# Batches recorded by the torch profiler after skipping the first (warm-up) ones; a whole
+# training run would give traces far too large to open
+TORCH_WAIT_STEPS = 1
+TORCH_WARMUP_STEPS = 2
+TORCH_ACTIVE_STEPS = 20
+
+
+def profile_dir() -> Optional[Path]:
+    path = os.getenv(PROFILE_DIR_ENV)
+    return Path(path) if path else None
+
+
+def start_profiling(path) -> Path:
+    "Turns profiling on for every step run by this process (and the processes it starts) and clears old records."
+    path = Path(path).resolve()
+    path.mkdir(parents=True, exist_ok=True)
+    (path / STEPS_FILE).unlink(missing_ok=True)
+    os.environ[PROFILE_DIR_ENV] = str(path)
+    logging.info(f"Profiling pipeline steps into {path}")
+    return path
+
+
+def peak_rss_mb() -> float:
+    "Peak resident memory of this process so far (ru_maxrss is in KB on Linux, bytes on macOS)."
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def reset_peak_rss() -> bool:
+    "Resets the kernel's peak RSS counter (Linux only), so the next reading covers one step and not the whole process."
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def window_peak_rss_mb() -> float:
+    "Peak RSS since the last `reset_peak_rss`, falling back to the process lifetime peak."
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def cpu_seconds() -> float:
+    "User plus system time of this process and of its finished children (tokenization workers, DDP ranks)."
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def read_records(path) -> list:
+    steps_file = Path(path) / STEPS_FILE
+    if not steps_file.exists():
+        return []
+    return [json.loads(line) for line in steps_file.read_text().splitlines() if line]
+
+
+def pipeline_run_name() -> Optional[str]:
+    try:
+        from zenml import get_step_context
+        return get_step_context().pipeline_run.name
+    except Exception:
+        return None
+
+
+def profiled(func):
+    """
+    Records one step's wall time, CPU time and peak RSS when profiling is on. Goes under `@step`,
+    and keeps the signature so ZenML still sees the step's inputs and outputs.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        path = profile_dir()
+        if path is None:
+            return func(*args, **kwargs)
+
+        run_name = pipeline_run_name()
+        previous = [r for r in read_records(path) if r["pipeline_run"] == run_name]
+        per_step_rss = reset_peak_rss()
+        start, cpu_start = time.time(), cpu_seconds()
+        wall_start = time.perf_counter()
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = cpu_seconds() - cpu_start
+            record = {"step": func.__name__, "pipeline_run": run_name, "start": start, "end": start + wall,
+                      "wall_s": wall, "cpu_s": cpu, "cpu_utilization": cpu / wall if wall else 0.0,
+                      "peak_rss_mb": window_peak_rss_mb() if per_step_rss else peak_rss_mb(),
+                      "peak_rss_scope": "step" if per_step_rss else "process",
+                      # ZenML storing the previous step's outputs and loading this one's inputs
+                      "handoff_s": start - previous[-1]["end"] if previous else None,
+                      "failed": failed}
+            with open(path / STEPS_FILE, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            log_step(record)
+
+    return wrapper
+
+
+def log_step(record : dict):
+    name = record["step"]
+    logging.info(f"[profile] {name}: {record['wall_s']:.2f}s wall, {record['cpu_s']:.2f}s CPU, "
+                 f"peak RSS {record['peak_rss_mb']:.0f} MB ({record['peak_rss_scope']})")
+    if mlflow.active_run() is None:
+        return
+    metrics = {f"profile.{name}.wall_s": record["wall_s"],
+               f"profile.{name}.cpu_s": record["cpu_s"],
+               f"profile.{name}.cpu_utilization": record["cpu_utilization"],
+               f"profile.{name}.peak_rss_mb": record["peak_rss_mb"]}
+    if record["handoff_s"] is not None:
+        metrics[f"profile.{name}.handoff_s"] = record["handoff_s"]
+    try:
+        mlflow.log_metrics(metrics)
+    except Exception as e:
+        # Profiling must never fail the step it measures
+        logging.warning(f"Could not log the profile of {name} to MLflow: {e}")
+
+
+@contextlib.contextmanager
+def torch_trace(name : str, enabled : bool = True):
+    """
+    Runs the torch profiler around a loop when profiling is on, recording TORCH_ACTIVE_STEPS batches
+    after a short warm-up. Yields a callable the loop calls once per batch. Writes a Chrome trace
+    (NAME.pt.trace.json) and folded stacks for flamegraph.pl or speedscope (NAME.stacks).
+    """
+    path = profile_dir()
+    if path is None or not enabled:
+        yield lambda: None
+        return
+
+    import torch
+    from torch.profiler import ProfilerActivity, profile, schedule
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    def export(prof):
+        prof.export_chrome_trace(str(path / f"{name}.pt.trace.json"))
+        prof.export_stacks(str(path / f"{name}.stacks"), "self_cpu_time_total")
+        logging.info(f"[profile] {name} torch trace written to {path}")
+
+    with profile(activities=activities, with_stack=True, on_trace_ready=export,
+                 schedule=schedule(wait=TORCH_WAIT_STEPS, warmup=TORCH_WARMUP_STEPS,
+                                   active=TORCH_ACTIVE_STEPS, repeat=1)) as prof:
+        yield prof.step
+
+
+def chrome_trace(records : list) -> dict:
+    "Steps and the handoffs between them as complete events, for chrome://tracing, Perfetto or speedscope."
+    events, tracks = [], {}
+    for record in records:
+        # One process row per pipeline run, named through a metadata event
+        name = record["pipeline_run"] or "pipeline"
+        if name not in tracks:
+            tracks[name] = len(tracks) + 1
+            events.append({"name": "process_name", "ph": "M", "pid": tracks[name], "args": {"name": name}})
+        track = tracks[name]
+        args = {k: record[k] for k in ("cpu_s", "cpu_utilization", "peak_rss_mb", "failed")}
+        events.append({"name": record["step"], "cat": "step", "ph": "X", "pid": track, "tid": 1,
+                       "ts": record["start"] * 1e6, "dur": record["wall_s"] * 1e6, "args": args})
+        if record["handoff_s"]:
+            events.append({"name": f"handoff -> {record['step']}", "cat": "zenml", "ph": "X", "pid": track,
+                           "tid": 1, "ts": (record["start"] - record["handoff_s"]) * 1e6,
+                           "dur": record["handoff_s"] * 1e6})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_report(path=None) -> Optional[pd.DataFrame]:
+    """
+    Writes the Chrome trace and a per-step summary, slowest step first, and logs them together with
+    the torch traces to the active MLflow run.
+    """
+    path = Path(path) if path else profile_dir()
+    records = read_records(path) if path else []
+    if not records:
+        logging.info("No profiled steps to report")
+        return None
+
+    (path / TRACE_FILE).write_text(json.dumps(chrome_trace(records)))
+
+    summary = pd.DataFrame(records).groupby("step", sort=False).agg(
+        runs=("wall_s", "size"), wall_s=("wall_s", "sum"), cpu_s=("cpu_s", "sum"),
+        handoff_s=("handoff_s", "sum"), peak_rss_mb=("peak_rss_mb", "max"))
+    summary["wall_share"] = summary["wall_s"] / summary["wall_s"].sum()
+    summary = summary.sort_values("wall_s", ascending=False)
+    summary.to_csv(path / SUMMARY_FILE)
+    logging.info(f"Step profile:\n{summary.to_string(float_format=lambda v: f'{v:.2f}')}")
+
+    if mlflow.active_run() is not None:
+        mlflow.log_artifacts(str(path), artifact_path="profile")
+    return summary
@@ -0,0 +1,96 @@
+from typing import Iterator, List
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthBucketBatchSampler(Sampler[List[int]]):
+    """
+    Groups examples whose token lengths fall in the same `bucket_width` wide bucket,
+    shuffles inside every bucket and then shuffles the order of the batches, so each
+    batch only needs padding up to a few tokens. With `shuffle=False` the examples
+    are simply batched in length order.
+
+    For distributed training every rank builds the same batch list (same seed and epoch)
+    and keeps every `num_replicas`-th batch, wrapping around so all ranks run the same
+    number of steps.
+    """
+
+    def __init__(self, lengths, batch_size : int, shuffle : bool = True,
+                 bucket_width : int = 8, seed : int = 42, drop_last : bool = False,
+                 num_replicas : int = 1, rank : int = 0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_width = bucket_width
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._skip = 0
+
+    def set_epoch(self, epoch : int):
+        self.epoch = epoch
+
+    def skip(self, batches : int):
+        "Makes the next iteration start `batches` batches into the epoch, for resuming mid-epoch."
+        self._skip = batches
+
+    def _batches(self, indices) -> List[np.ndarray]:
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def _shard(self, batches : List[List[int]]) -> List[List[int]]:
+        if self.num_replicas == 1 or not batches:
+            return batches
+        total = -(-len(batches) // self.num_replicas) * self.num_replicas
+        padded = [batches[i % len(batches)] for i in range(total)]
+        return padded[self.rank::self.num_replicas]
+
+    def batches(self) -> List[List[int]]:
+        if not self.shuffle:
+            return self._shard([batch.tolist() for batch in self._batches(np.argsort(self.lengths, kind="stable"))])
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        buckets = self.lengths // self.bucket_width
+
+        batches = []
+        for bucket in np.unique(buckets):
+            indices = np.flatnonzero(buckets == bucket)
+            rng.shuffle(indices)
+            batches.extend(self._batches(indices))
+
+        order = rng.permutation(len(batches))
+        return self._shard([batches[i].tolist() for i in order])
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self.batches()[self._skip:]
+        self._skip = 0
+        # A new shuffle every time the DataLoader starts an epoch, unless set_epoch is used explicitly
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return -(-self._num_batches() // self.num_replicas)
+
+    def _num_batches(self) -> int:
+        if not self.shuffle:
+            return len(self._batches(np.arange(len(self.lengths))))
+        buckets = self.lengths // self.bucket_width
+        counts = np.unique(buckets, return_counts=True)[1]
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int(np.ceil(counts / self.batch_size).sum())
+
+
+def padding_ratio(lengths, batches) -> float:
+    "Fraction of the tokens in the padded batches that are padding."
+    lengths = np.asarray(lengths)
+    real = padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += int(batch_lengths.sum())
+        padded += int(batch_lengths.max()) * len(batch_lengths)
+    return 1 - real / padded if padded else 0.0
@@ -0,0 +1,172 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Annotated, Iterator, Tuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import Dataset
+from zenml import step
+from steps.profiling import profiled
+import mlflow
+
+ARROW_DIR = Path("data/arrow")
+# Fixed up front instead of sorted over the whole corpus (as transform does), so chunks can be encoded on their own
+LABEL_MAP = {"ham": 0, "spam": 1}
+SCHEMA = pa.schema([("labels", pa.int64()), ("Messages", pa.string())])
+# Different 16 byte keys, so which rows are deduped and which land in the test set are unrelated
+DEDUPE_HASH_KEY = "dedupe-rows-0001"
+SPLIT_HASH_KEY = "split-message-01"
+SPLIT_BUCKETS = 10_000
+
+
+def read_chunks(path, chunk_size : int) -> Iterator[pd.DataFrame]:
+    "Yields the corpus a chunk at a time from a TSV (label<TAB>message), Parquet or Arrow IPC file."
+    suffix = Path(path).suffix.lower()
+    if suffix == ".parquet":
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=["labels", "Messages"]):
+            yield batch.to_pandas()
+    elif suffix in (".arrow", ".feather", ".ipc"):
+        with pa.memory_map(str(path)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).select(["labels", "Messages"]).to_pandas()
+    else:
+        yield from pd.read_csv(path, sep='\t', names=['labels', 'Messages'], chunksize=chunk_size)
+
+
+class Deduper:
+    "Keeps the first occurrence of every row hash across all chunks."
+
+    def new_rows(self, hashes : np.ndarray) -> np.ndarray:
+        keep = ~pd.Series(hashes).duplicated().to_numpy()
+        keep[keep] = self._check_and_add(hashes[keep])
+        return keep
+
+    def _check_and_add(self, hashes : np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+
+class HashSetDeduper(Deduper):
+    "Exact, but memory grows with the number of unique rows."
+
+    def __init__(self):
+        self.seen = set()
+
+    def _check_and_add(self, hashes):
+        hashes = hashes.tolist()
+        unseen = np.fromiter((h not in self.seen for h in hashes), dtype=bool, count=len(hashes))
+        self.seen.update(hashes)
+        return unseen
+
+
+class BloomDeduper(Deduper):
+    """
+    Fixed memory sized for `capacity` unique rows. A false positive drops a unique row,
+    which happens for roughly `error_rate` of them while the filter is below capacity.
+    """
+
+    def __init__(self, capacity : int, error_rate : float = 1e-4):
+        self.size = int(np.ceil(-capacity * np.log(error_rate) / np.log(2) ** 2))
+        self.num_hashes = max(1, round(self.size / capacity * np.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        logging.info(f"Bloom filter with {self.size} bits ({self.bits.nbytes / 2**20:.1f} MB) and {self.num_hashes} hashes")
+
+    def _check_and_add(self, hashes):
+        # Double hashing: the i-th probe is h1 + i * h2, with h2 odd
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        positions = (h1[:, None] + np.arange(self.num_hashes, dtype=np.uint64)[None, :] * h2[:, None]) % np.uint64(self.size)
+        byte, bit = positions >> np.uint64(3), (positions & np.uint64(7)).astype(np.uint8)
+
+        unseen = ~((self.bits[byte] >> bit) & 1).all(axis=1)
+        np.bitwise_or.at(self.bits, byte[unseen].ravel(), np.left_shift(1, bit[unseen]).astype(np.uint8).ravel())
+        return unseen
+
+
+def encode_labels(labels : pd.Series) -> pd.Series:
+    if pd.api.types.is_numeric_dtype(labels):
+        return labels.astype("int64")
+    encoded = labels.map(LABEL_MAP)
+    if encoded.isna().any():
+        raise ValueError(f"Unknown labels {sorted(set(labels[encoded.isna()]))}, expected one of {list(LABEL_MAP)}")
+    return encoded.astype("int64")
+
+
+def in_test_split(messages : pd.Series, test_size : float = 0.2) -> np.ndarray:
+    "Whether each message belongs to the test split, by a keyed hash of its text: a message never changes sides between runs."
+    message_hashes = pd.util.hash_pandas_object(messages, index=False, hash_key=SPLIT_HASH_KEY).to_numpy()
+    return message_hashes % np.uint64(SPLIT_BUCKETS) < np.uint64(int(test_size * SPLIT_BUCKETS))
+
+
+def stream_to_arrow(data_path, output_dir=ARROW_DIR, chunk_size : int = 100_000, dedupe : str = "hash",
+                    test_size : float = 0.2, bloom_capacity : int = 10_000_000,
+                    bloom_error_rate : float = 1e-4) -> Tuple[Dataset, Dataset, dict]:
+    """
+    One pass over the corpus: drop missing rows, dedupe, encode the labels and route every
+    row to train.arrow or test.arrow by a hash of its message. Only one chunk is in memory
+    at a time (plus the dedupe state), and the same message always lands in the same split,
+    whatever the chunk size or the order of the input.
+    """
+    if dedupe == "hash":
+        deduper = HashSetDeduper()
+    elif dedupe == "bloom":
+        deduper = BloomDeduper(bloom_capacity, bloom_error_rate)
+    else:
+        raise ValueError(f"Unknown dedupe mode {dedupe}, expected 'hash' or 'bloom'")
+
+    output_dir = Path(output_dir)
+    tmp_dir = output_dir.with_name(output_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    stats = {"rows_read": 0, "rows_missing": 0, "rows_duplicated": 0, "train_rows": 0, "test_rows": 0}
+
+    # Arrow IPC stream files are what datasets memory-maps in Dataset.from_file
+    with pa.OSFile(str(tmp_dir / "train.arrow"), "wb") as train_sink, \
+         pa.OSFile(str(tmp_dir / "test.arrow"), "wb") as test_sink, \
+         pa.ipc.new_stream(train_sink, SCHEMA) as train_writer, \
+         pa.ipc.new_stream(test_sink, SCHEMA) as test_writer:
+
+        for chunk in read_chunks(data_path, chunk_size):
+            rows = len(chunk)
+            chunk = chunk.dropna(subset=["labels", "Messages"])
+            stats["rows_read"] += rows
+            stats["rows_missing"] += rows - len(chunk)
+
+            frame = pd.DataFrame({"labels": encode_labels(chunk["labels"]),
+                                  "Messages": chunk["Messages"].astype(str)})
+
+            row_hashes = pd.util.hash_pandas_object(frame, index=False, hash_key=DEDUPE_HASH_KEY).to_numpy()
+            keep = deduper.new_rows(row_hashes)
+            stats["rows_duplicated"] += int((~keep).sum())
+            frame = frame[keep]
+
+            in_test = in_test_split(frame["Messages"], test_size)
+
+            for part, writer, name in [(frame[~in_test], train_writer, "train_rows"), (frame[in_test], test_writer, "test_rows")]:
+                if len(part):
+                    writer.write_table(pa.Table.from_pandas(part, schema=SCHEMA, preserve_index=False))
+                    stats[name] += len(part)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+
+    logging.info(f"Streamed {stats['rows_read']} rows: {stats['rows_missing']} missing, "
+                 f"{stats['rows_duplicated']} duplicated, {stats['train_rows']} train, {stats['test_rows']} test")
+
+    return (Dataset.from_file(str(output_dir / "train.arrow")),
+            Dataset.from_file(str(output_dir / "test.arrow")), stats)
+
+
+@step(enable_cache=False)
+@profiled
+def stream_ingest(data_path : str, chunk_size : int = 100_000, dedupe : str = "hash",
+                  test_size : float = 0.2) -> Tuple[Annotated[Dataset, "training_data"],
+                                                    Annotated[Dataset, "testing_data"]]:
+    train, test, stats = stream_to_arrow(data_path, chunk_size=chunk_size, dedupe=dedupe, test_size=test_size)
+    if mlflow.active_run():
+        mlflow.log_metrics({f"ingest_{name}": value for name, value in stats.items()})
+    return train, test
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+
+
+def normalize(text : str) -> str:
+    "Whitespace and unicode normalisation that does not change how BERT tokenizes the text."
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(text : str, tokenizer_name : str, max_length : int) -> bytes:
+    return hashlib.blake2b(f"{tokenizer_name}\0{max_length}\0{normalize(text)}".encode("utf-8"),
+                           digest_size=16).digest()
+
+
+class CacheStats:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self, prefix : str = "") -> dict:
+        return {f"{prefix}hits": self.hits, f"{prefix}misses": self.misses, f"{prefix}hit_rate": self.hit_rate}
+
+
+class TokenCache:
+    """
+    Content-addressed cache of `input_ids`, keyed by the normalized text, the tokenizer
+    name and max_length. Only the misses of a batch go through the tokenizer.
+    """
+
+    def __init__(self, tokenizer, tokenizer_name : str, max_length : int = 512):
+        self.tokenizer = tokenizer
+        self.tokenizer_name = tokenizer_name
+        self.max_length = max_length
+        self.stats = CacheStats()
+
+    def _get_many(self, keys : List[bytes]) -> List[Optional[List[int]]]:
+        raise NotImplementedError
+
+    def _put_many(self, keys : List[bytes], input_ids : List[List[int]]):
+        raise NotImplementedError
+
+    def encode(self, texts : List[str]) -> List[List[int]]:
+        keys = [cache_key(text, self.tokenizer_name, self.max_length) for text in texts]
+        found = self._get_many(keys)
+        missing = [i for i, ids in enumerate(found) if ids is None]
+
+        if missing:
+            encoded = self.tokenizer([normalize(texts[i]) for i in missing],
+                                     truncation=True, max_length=self.max_length)["input_ids"]
+            self._put_many([keys[i] for i in missing], encoded)
+            for i, ids in zip(missing, encoded):
+                found[i] = ids
+
+        self.stats.misses += len(missing)
+        self.stats.hits += len(texts) - len(missing)
+        return found
+
+
+class LRUTokenCache(TokenCache):
+    "Bounded in-process cache for the API."
+
+    def __init__(self, tokenizer, tokenizer_name : str, max_length : int = 512, maxsize : int = 50000):
+        super().__init__(tokenizer, tokenizer_name, max_length)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_many(self, keys):
+        found = []
+        for key in keys:
+            ids = self._entries.get(key)
+            if ids is not None:
+                self._entries.move_to_end(key)
+            found.append(ids)
+        return found
+
+    def _put_many(self, keys, input_ids):
+        for key, ids in zip(keys, input_ids):
+            self._entries[key] = ids
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class DiskTokenCache(TokenCache):
+    """
+    On-disk store for the training corpus. Token ids are appended to one flat int32
+    file that is read through a memory map, and `index.npz` maps every key to its
+    offset and length. Call `flush` to persist the index.
+    """
+
+    def __init__(self, directory, tokenizer, tokenizer_name : str, max_length : int = 512):
+        super().__init__(tokenizer, tokenizer_name, max_length)
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.ids_path = self.directory / "ids.bin"
+        self.index_path = self.directory / "index.npz"
+        self._index = {}
+        self._ids = None
+        self._dirty = False
+
+        if self.index_path.exists():
+            index = np.load(self.index_path)
+            self._index = dict(zip((key.tobytes() for key in index["keys"]),
+                                   zip(index["offsets"].tolist(), index["lengths"].tolist())))
+        logging.info(f"Token cache at {self.directory} holds {len(self._index)} entries")
+
+    def __len__(self):
+        return len(self._index)
+
+    def _memmap(self):
+        if self._ids is None and self.ids_path.exists() and self.ids_path.stat().st_size:
+            self._ids = np.memmap(self.ids_path, dtype=np.int32, mode="r")
+        return self._ids
+
+    def _get_many(self, keys):
+        ids = self._memmap()
+        found = []
+        for key in keys:
+            entry = self._index.get(key)
+            found.append(None if entry is None else ids[entry[0]:entry[0] + entry[1]].tolist())
+        return found
+
+    def _put_many(self, keys, input_ids):
+        with open(self.ids_path, "ab") as f:
+            # Entries left behind by a run that died before flush() are simply never referenced
+            offset = f.tell() // 4
+            for key, ids in zip(keys, input_ids):
+                f.write(np.asarray(ids, dtype=np.int32).tobytes())
+                self._index[key] = (offset, len(ids))
+                offset += len(ids)
+        self._ids = None
+        self._dirty = True
+
+    def flush(self):
+        if not self._dirty:
+            return
+        keys = np.frombuffer(b"".join(self._index.keys()), dtype=np.uint8).reshape(-1, 16)
+        offsets, lengths = zip(*self._index.values()) if self._index else ((), ())
+        tmp_path = self.directory / "index.tmp.npz"
+        np.savez(tmp_path, keys=keys, offsets=np.asarray(offsets, dtype=np.int64),
+                 lengths=np.asarray(lengths, dtype=np.int32))
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
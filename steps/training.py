@@ -1,3 +1,5 @@
+import copy
+import itertools
 import logging
 from zenml import step
 from transformers import BertForSequenceClassification
@@ -5,99 +7,610 @@ from torch.utils.data import DataLoader
 import torch
 import mlflow
 from tqdm.auto import tqdm
-from sklearn.metrics import accuracy_score
 import pickle
 from pathlib import Path
-from collections import Counter
+from typing import Annotated, Literal, Optional, Tuple
+from pydantic import BaseModel, Field, model_validator
+import contextlib
+import os
+import socket
+import tempfile
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import torch.nn as nn
-from steps.bert_tokenizer import tokenizer
+import time
+import numpy as np
+from steps.bert_tokenizer import get_tokenizer
+from steps.data_load import shard_loader, holdout_split, subset_loader
+from steps.handoff import build_loader, new_row_indices
+from steps.checkpoint import (CHECKPOINT_FILE, BEST_FILE, EarlyStopping, save_checkpoint, load_checkpoint,
+                              rng_state, set_rng_state)
+from steps.profiling import peak_rss_mb, profiled, torch_trace
+from serving.adapters import (BASE_MODEL, TARGET_MODULES, add_lora, freeze_encoder, merge_lora, save_adapter,
+                              state_dict_mb, trainable_state_dict)
 
-@step(enable_cache=True)
-def training_model(training_data: DataLoader, epoch: int, lr: float,  num_of_labels) -> BertForSequenceClassification:
 
-    model = BertForSequenceClassification.from_pretrained("bert-base-uncased", num_labels=num_of_labels)
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+class TrainingConfig(BaseModel):
+    "How the training loop runs. The defaults reproduce plain fp32 training with one optimizer step per batch."
 
-    model.to(device)
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    precision: Literal["fp32", "bf16"] = "fp32"
+    grad_accum_steps: int = Field(default=1, ge=1)
+    # 0 keeps torch's own default (or an even share of the cores per DDP process)
+    num_threads: int = Field(default=0, ge=0)
+    interop_threads: int = Field(default=0, ge=0)
+    compile_model: bool = False
 
-    loss_fun = nn.BCEWithLogitsLoss()
-    mlflow.log_param("loss_function","BCEWithLogitsLoss (unweighted)")
+    # Distributed data parallel over gloo; world_size processes split evenly across num_nodes
+    world_size: int = Field(default=1, ge=1)
+    num_nodes: int = Field(default=1, ge=1)
+    node_rank: int = Field(default=0, ge=0)
+    master_addr: str = "127.0.0.1"
+    # 0 picks a free port, which only works when every process is on this machine
+    master_port: int = Field(default=0, ge=0)
 
-    train_size = len(training_data.dataset)
-    mlflow.log_param("train_size", train_size)
+    # Checkpoints go to checkpoint_dir every checkpoint_every optimizer steps and at every epoch end
+    # (0 disables them). For multi-node runs the directory has to be shared by all nodes to resume
+    checkpoint_dir: str = "checkpoints"
+    checkpoint_every: int = Field(default=0, ge=0)
+    resume: bool = False
 
-    no_of_steps = epoch * len(training_data)
-    progress_bar = tqdm(range(no_of_steps))
+    # Early stopping on validation_fraction of the training data, held out from training (0 disables it)
+    early_stopping_patience: int = Field(default=0, ge=0)
+    validation_fraction: float = Field(default=0.1, gt=0, lt=1)
+    min_delta: float = Field(default=0.0, ge=0)
 
-    label_counter = Counter()
+    # Weight positives by negatives/positives in BCE instead of resampling (the class_weights balance strategy)
+    class_weighted_loss: bool = False
 
-    for batch in training_data:
-        labels = batch['labels']
-        if isinstance(labels, torch.Tensor):
-            labels = labels.tolist()
-        label_counter.update(labels)
+    # Incremental retraining: warm-start from the last trained model and fine-tune on the rows the last
+    # processing run added, plus replay_ratio times as many old rows so the model does not forget them
+    incremental: bool = False
+    replay_ratio: float = Field(default=1.0, ge=0)
+    replay_seed: int = 42
+
+    # Parameter-efficient fine-tuning: "frozen" trains only the classifier head, "lora" also trains rank
+    # lora_rank adapters on the attention query/value projections. Both save only the trained weights
+    finetune: Literal["full", "frozen", "lora"] = "full"
+    lora_rank: int = Field(default=8, ge=1)
+    lora_alpha: float = Field(default=16.0, gt=0)
+    lora_dropout: float = Field(default=0.1, ge=0, lt=1)
+    # Optimizer steps timed for full fine-tuning and for the chosen mode before training (0 skips it)
+    compare_steps: int = Field(default=5, ge=0)
+
+    @model_validator(mode="after")
+    def check_distributed(self):
+        if self.world_size % self.num_nodes:
+            raise ValueError(f"world_size {self.world_size} is not divisible by num_nodes {self.num_nodes}")
+        if self.node_rank >= self.num_nodes:
+            raise ValueError(f"node_rank {self.node_rank} must be below num_nodes {self.num_nodes}")
+        if self.num_nodes > 1 and not self.master_port:
+            raise ValueError("master_port must be set when training across several nodes")
+        return self
+
+    @property
+    def procs_per_node(self) -> int:
+        return self.world_size // self.num_nodes
+
+
+def set_threads(config : TrainingConfig, default_threads : int = 0):
+    num_threads = config.num_threads or default_threads
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if config.interop_threads:
+        try:
+            torch.set_num_interop_threads(config.interop_threads)
+        except RuntimeError as e:
+            # Only allowed before the first parallel op of the process
+            logging.warning(f"Could not set inter-op threads: {e}")
+    logging.info(f"Training with {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads")
+
+
+def autocast(device : str, config : TrainingConfig):
+    if config.precision == "bf16":
+        return torch.autocast(device_type=device.split(":")[0], dtype=torch.bfloat16)
+    return contextlib.nullcontext()
 
-    logging.info("Model is training")
-    model.train()
 
+def is_main_process() -> bool:
+    return not dist.is_initialized() or dist.get_rank() == 0
 
-    for epoch_idx in range(epoch):
-        total_loss = 0
 
-        for i, batch in enumerate(training_data):
+def all_reduce(values, op=dist.ReduceOp.SUM) -> list:
+    "Sums (or maxes) a list of numbers over every rank; a no-op outside distributed training."
+    tensor = torch.tensor(values, dtype=torch.float64)
+    if dist.is_initialized():
+        dist.all_reduce(tensor, op=op)
+    return tensor.tolist()
 
+
+def prepare_finetune(model : BertForSequenceClassification, config : TrainingConfig) -> BertForSequenceClassification:
+    "Freezes the encoder or adds LoRA adapters as `config.finetune` asks; full fine-tuning leaves the model as it is."
+    if config.finetune == "lora":
+        add_lora(model, config.lora_rank, config.lora_alpha, config.lora_dropout)
+    elif config.finetune == "frozen":
+        freeze_encoder(model)
+    return model
+
+
+def trainable_parameters(model : nn.Module) -> list:
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+def optimizer_state_mb(optimizer : torch.optim.Optimizer) -> float:
+    "Memory held by the optimizer's per-parameter state (Adam's two moment estimates)."
+    return sum(t.numel() * t.element_size() for state in optimizer.state.values()
+               for t in state.values() if torch.is_tensor(t)) / 2**20
+
+
+def replay_indices(new_rows : np.ndarray, size : int, ratio : float, seed : int = 42) -> np.ndarray:
+    "The new rows plus a seeded sample of `ratio` times as many old rows (all of them if there are fewer)."
+    old_rows = np.setdiff1d(np.arange(size), new_rows)
+    replay = min(len(old_rows), int(round(ratio * len(new_rows))))
+    sampled = np.random.default_rng(seed).choice(old_rows, replay, replace=False)
+    return np.concatenate([new_rows, sampled])
+
+
+def class_pos_weight(training_data : DataLoader) -> float:
+    "negatives / positives over the whole training set, the BCE pos_weight that balances the two classes."
+    labels = training_data.dataset.with_format("numpy")["labels"]
+    positives = int((labels == 1).sum())
+    return (len(labels) - positives) / positives if positives else 1.0
+
+
+def validation_loss(model : BertForSequenceClassification, validation_data : DataLoader,
+                    config : TrainingConfig, device : str) -> float:
+    loss_fun = nn.BCEWithLogitsLoss(reduction="sum")
+    total_loss = count = 0
+    model.eval()
+    with torch.no_grad():
+        for batch in validation_data:
             batch = {k: v.to(device) for k, v in batch.items()}
+            with autocast(device, config):
+                logits = model(**batch).logits
+            total_loss += loss_fun(logits.float().squeeze(1), batch['labels'].float()).item()
+            count += batch['labels'].shape[0]
+    model.train()
+    total_loss, count = all_reduce([total_loss, count])
+    return total_loss / count
+
+
+def fit(model : BertForSequenceClassification, training_data : DataLoader, epoch : int, lr : float,
+        config : TrainingConfig, device : str, validation_data : Optional[DataLoader] = None):
+    """
+    The training loop. Under DDP every rank runs it on its own shard and only rank 0 logs
+    and writes checkpoints. With `config.resume` it continues from the last checkpoint,
+    mid-epoch if that is where it was written.
+    """
+
+    # Frozen parameters get no optimizer state, which is most of the memory saved by adapters
+    optimizer = torch.optim.Adam(trainable_parameters(model), lr=lr)
+    distributed = dist.is_initialized()
+    main = is_main_process()
+
+    no_of_batches = len(training_data)
+    accum = config.grad_accum_steps
+    sampler = training_data.batch_sampler
+
+    checkpoint_dir = Path(config.checkpoint_dir)
+    stopper = EarlyStopping(config.early_stopping_patience, config.min_delta) \
+        if validation_data is not None and config.early_stopping_patience else None
+    # Checked on resume: the saved batch position is only meaningful for the same batching
+    layout = {"world_size": config.world_size, "grad_accum_steps": accum, "batches_per_epoch": no_of_batches}
 
-            labels = batch['labels'].float()
+    start_epoch = start_batch = optimizer_steps = 0
+    epoch_loss = 0.0
+    resume_rng = None
 
-            output = model(**batch)
-            logits = output.logits.squeeze(1)
+    if config.resume:
+        state = load_checkpoint(checkpoint_dir / CHECKPOINT_FILE)
+        if state is None:
+            logging.warning(f"No checkpoint in {checkpoint_dir}, training from scratch")
+        else:
+            if state["layout"] != layout:
+                raise ValueError(f"Checkpoint was written for {state['layout']}, this run has {layout}")
+            model.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+            start_epoch, start_batch = state["epoch"], state["batch"]
+            optimizer_steps, epoch_loss = state["optimizer_steps"], state["epoch_loss"]
+            # Creating the DataLoader iterator draws from the torch RNG. A mid-epoch checkpoint was written
+            # after that draw, so its state is restored just before the first resumed batch instead
+            if start_batch:
+                resume_rng = state["rng"]
+            else:
+                set_rng_state(state["rng"])
+            if stopper and state["early_stopping"]:
+                stopper.load_state_dict(state["early_stopping"])
+            logging.info(f"Resuming at epoch {start_epoch + 1}, batch {start_batch} of {no_of_batches}")
 
-            loss = loss_fun(logits, labels)
+    def save(epoch_idx : int, batch_idx : int):
+        if not main:
+            return
+        save_checkpoint({"model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                         "epoch": epoch_idx, "batch": batch_idx, "optimizer_steps": optimizer_steps,
+                         "epoch_loss": epoch_loss, "rng": rng_state(), "layout": layout,
+                         "early_stopping": stopper.state_dict() if stopper else None},
+                        checkpoint_dir / CHECKPOINT_FILE)
+
+    ddp = DistributedDataParallel(model) if distributed else None
+    forward = ddp or model
+    # The compiled module shares its parameters with `model`, which is what gets returned and saved.
+    # Bucketed batches have varying sequence lengths, so compile for dynamic shapes up front
+    if config.compile_model:
+        forward = torch.compile(forward, dynamic=True)
+
+    pos_weight = torch.tensor(class_pos_weight(training_data), device=device) if config.class_weighted_loss else None
+    loss_fun = nn.BCEWithLogitsLoss(pos_weight=pos_weight)
+
+    no_of_steps = epoch * len(training_data)
+    progress_bar = tqdm(range(no_of_steps), initial=start_epoch * no_of_batches + start_batch, disable=not main)
+
+    logging.info("Model is training")
+    model.train()
 
+    epoch_idx = max(start_epoch - 1, 0)
+    # Only rank 0 traces; the profiler records a window of batches early in the run
+    with torch_trace("training", enabled=main) as trace_step:
+        for epoch_idx in range(start_epoch, epoch):
+            # Explicit epochs keep the shuffle order reproducible across a resume
+            sampler.set_epoch(epoch_idx)
+            first_batch = start_batch if epoch_idx == start_epoch else 0
+            if first_batch:
+                sampler.skip(first_batch)
+            else:
+                epoch_loss = 0.0
+
+            real_tokens = padded_tokens = samples = epoch_steps = 0
+            epoch_start = time.perf_counter()
             optimizer.zero_grad()
-            loss.backward()
 
-            optimizer.step()
+            for i, batch in enumerate(training_data, start=first_batch):
+
+                if resume_rng is not None:
+                    set_rng_state(resume_rng)
+                    resume_rng = None
+
+                real_tokens += int(batch['attention_mask'].sum())
+                padded_tokens += batch['attention_mask'].numel()
+                samples += batch['labels'].shape[0]
+
+                batch = {k: v.to(device) for k, v in batch.items()}
+
+                labels = batch['labels'].float()
+
+                step_now = (i + 1) % accum == 0 or i + 1 == no_of_batches
+                # Gradients are only all-reduced on the micro-batch that ends an accumulation group
+                sync = contextlib.nullcontext() if ddp is None or step_now else ddp.no_sync()
+
+                with sync:
+                    with autocast(device, config):
+                        output = forward(**batch)
+                    logits = output.logits.float().squeeze(1)
+
+                    loss = loss_fun(logits, labels)
+
+                    # The last group of an epoch can be shorter than grad_accum_steps
+                    group_size = min(accum, no_of_batches - (i // accum) * accum)
+                    (loss / group_size).backward()
+
+                progress_bar.update(1)
+                epoch_loss += loss.item()
+
+                if step_now:
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    optimizer_steps += 1
+                    epoch_steps += 1
+
+                    # Only on optimizer-step boundaries, so no half-accumulated gradients are lost
+                    if config.checkpoint_every and optimizer_steps % config.checkpoint_every == 0 and i + 1 < no_of_batches:
+                        save(epoch_idx, i + 1)
+
+                trace_step()
 
-            progress_bar.update(1)
-            total_loss += loss.item()
-        
-        avg_loss = total_loss / len(training_data)
-        mlflow.log_metric("average_loss", avg_loss, step=epoch_idx)
-        logging.info(f"Epoch {epoch_idx + 1} average loss: {avg_loss:.5f}")
+            epoch_time = time.perf_counter() - epoch_start
+            total_loss, batches, samples, real_tokens, padded_tokens = all_reduce(
+                [epoch_loss, no_of_batches, samples, real_tokens, padded_tokens])
+            epoch_time, peak_rss = all_reduce([epoch_time, peak_rss_mb()], op=dist.ReduceOp.MAX)
+
+            if main:
+                avg_loss = total_loss / batches
+                mlflow.log_metric("average_loss", avg_loss, step=epoch_idx)
+                logging.info(f"Epoch {epoch_idx + 1} average loss: {avg_loss:.5f}")
+
+                mlflow.log_metrics({"tokens_per_sec": real_tokens / epoch_time,
+                                    "padded_tokens_per_sec": padded_tokens / epoch_time,
+                                    "batch_padding_ratio": 1 - real_tokens / padded_tokens,
+                                    "samples_per_sec": samples / epoch_time,
+                                    "step_time_ms": 1000 * epoch_time / max(epoch_steps, 1),
+                                    "optimizer_state_mb": optimizer_state_mb(optimizer),
+                                    "peak_rss_mb": peak_rss}, step=epoch_idx)
+                logging.info(f"Epoch {epoch_idx + 1} processed {samples / epoch_time:.1f} samples/sec, "
+                             f"{real_tokens / epoch_time:.0f} tokens/sec, peak RSS {peak_rss:.0f} MB")
+
+            stop = False
+            if stopper:
+                val_loss = validation_loss(model, validation_data, config, device)
+                stop = stopper.step(val_loss)
+                if main:
+                    mlflow.log_metric("validation_loss", val_loss, step=epoch_idx)
+                    logging.info(f"Epoch {epoch_idx + 1} validation loss: {val_loss:.5f}")
+                    if stopper.improved:
+                        save_checkpoint(model.state_dict(), checkpoint_dir / BEST_FILE)
+
+            if config.checkpoint_every:
+                save(epoch_idx + 1, 0)
+
+            if stop:
+                logging.info(f"Validation loss has not improved for {stopper.patience} epochs, stopping early")
+                break
+
+    if stopper and stopper.best is not None:
+        if distributed:
+            dist.barrier()
+        model.load_state_dict(load_checkpoint(checkpoint_dir / BEST_FILE))
+        if main:
+            mlflow.log_metrics({"best_validation_loss": stopper.best, "epochs_trained": epoch_idx + 1})
+            logging.info(f"Restored the weights with the best validation loss {stopper.best:.5f}")
 
     logging.info("Started training evaluation")
     model.eval()
-    all_preds = []
-    all_labels = []
+    correct = total = 0
 
     with torch.no_grad():
-        for batch in tqdm(training_data, desc="Training evaluation started"):
+        for batch in tqdm(training_data, desc="Training evaluation started", disable=not main):
             batch = {k: v.to(device) for k, v in batch.items()}
-            logits = model(**batch).logits
-            probs = torch.sigmoid(logits).squeeze(-1)
-            preds = (probs >= 0.5)
-            all_preds.extend(preds.cpu().long().tolist())
-            all_labels.extend(batch['labels'].cpu().long().tolist())
+            with autocast(device, config):
+                logits = model(**batch).logits
+            probs = torch.sigmoid(logits.float()).squeeze(-1)
+            preds = (probs >= 0.5).long()
+            correct += int((preds == batch['labels'].long()).sum())
+            total += preds.shape[0]
 
     logging.info("Training evaluation completed")
 
-    accuracy = accuracy_score(all_labels, all_preds)
-    mlflow.log_metric("train_accuracy", accuracy, step=epoch_idx)
-    logging.info(f"Epoch {epoch_idx+1} Accuracy: {accuracy:.4f}")
+    correct, total = all_reduce([correct, total])
+    accuracy = correct / total
+    if main:
+        mlflow.log_metric("train_accuracy", accuracy, step=epoch_idx)
+        logging.info(f"Epoch {epoch_idx+1} Accuracy: {accuracy:.4f}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def ddp_worker(local_rank : int, config : TrainingConfig, training_data : DataLoader,
+               validation_data : Optional[DataLoader], epoch : int, lr : float,
+               num_of_labels, tracking_uri : str, run_id : str, output_path : str,
+               base_path : Optional[str] = None):
+    "One DDP process. Started by torch.multiprocessing.spawn, so it has to live at module level."
+
+    rank = config.node_rank * config.procs_per_node + local_rank
+    dist.init_process_group("gloo", rank=rank, world_size=config.world_size)
+    try:
+        set_threads(config, default_threads=max(1, (os.cpu_count() or 1) // config.procs_per_node))
+
+        device = f"cuda:{local_rank}" if torch.cuda.device_count() > local_rank else "cpu"
+        model = BertForSequenceClassification.from_pretrained(BASE_MODEL, num_labels=num_of_labels)
+        if base_path:
+            model.load_state_dict(torch.load(base_path, map_location="cpu"))
+        prepare_finetune(model, config)
+        model.to(device)
+
+        loader = shard_loader(training_data, config.world_size, rank)
+        if validation_data is not None:
+            validation_data = shard_loader(validation_data, config.world_size, rank)
+
+        if rank == 0:
+            mlflow.set_tracking_uri(tracking_uri)
+            with mlflow.start_run(run_id=run_id):
+                fit(model, loader, epoch, lr, config, device, validation_data)
+        else:
+            fit(model, loader, epoch, lr, config, device, validation_data)
+
+        # Every rank ends with the same weights; one process per node hands them back to its pipeline
+        if local_rank == 0:
+            torch.save(model.state_dict(), output_path)
+        dist.barrier()
+    finally:
+        dist.destroy_process_group()
+
+
+def train_distributed(training_data : DataLoader, validation_data : Optional[DataLoader], epoch : int, lr : float,
+                      num_of_labels, config : TrainingConfig,
+                      base_model : Optional[BertForSequenceClassification] = None) -> BertForSequenceClassification:
+    os.environ["MASTER_ADDR"] = config.master_addr
+    os.environ["MASTER_PORT"] = str(config.master_port or free_port())
+    logging.info(f"Starting {config.procs_per_node} DDP processes on node {config.node_rank} "
+                 f"(world size {config.world_size}, rendezvous {os.environ['MASTER_ADDR']}:{os.environ['MASTER_PORT']})")
+
+    run = mlflow.active_run()
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = os.path.join(tmp, "model.pt")
+        base_path = None
+        if base_model is not None:
+            base_path = os.path.join(tmp, "base.pt")
+            torch.save(base_model.state_dict(), base_path)
+        mp.spawn(ddp_worker, nprocs=config.procs_per_node, join=True,
+                 args=(config, training_data, validation_data, epoch, lr, num_of_labels, mlflow.get_tracking_uri(),
+                       run.info.run_id if run else None, output_path, base_path))
+
+        model = prepare_finetune(BertForSequenceClassification.from_pretrained(BASE_MODEL, num_labels=num_of_labels),
+                                 config)
+        model.load_state_dict(torch.load(output_path, map_location="cpu"))
+    return model
+
+
+def time_training_steps(model : BertForSequenceClassification, training_data : DataLoader, lr : float,
+                        config : TrainingConfig, device : str, steps : int) -> dict:
+    "Times `steps` optimizer steps after a warm-up one and measures the optimizer state they leave behind."
+    state = rng_state()
+    optimizer = torch.optim.Adam(trainable_parameters(model), lr=lr)
+    loss_fun = nn.BCEWithLogitsLoss()
+    model.to(device)
+    model.train()
+
+    elapsed = 0.0
+    timed = 0
+    for i, batch in enumerate(itertools.islice(training_data, steps + 1)):
+        start = time.perf_counter()
+        batch = {k: v.to(device) for k, v in batch.items()}
+        with autocast(device, config):
+            logits = model(**batch).logits
+        loss_fun(logits.float().squeeze(1), batch['labels'].float()).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if i:
+            elapsed += time.perf_counter() - start
+            timed += 1
+
+    # The timing run must not shift the shuffle or dropout of the real one
+    set_rng_state(state)
+    return {"step_time_ms": 1000 * elapsed / max(timed, 1), "optimizer_state_mb": optimizer_state_mb(optimizer)}
+
+
+def log_finetune_comparison(model : BertForSequenceClassification, training_data : DataLoader, lr : float,
+                            config : TrainingConfig, device : str) -> dict:
+    """
+    Step time, optimizer memory and artifact size of full fine-tuning next to `config.finetune`,
+    both measured on copies of `model` over the same first batches.
+    """
+    full = copy.deepcopy(model).requires_grad_(True)
+    comparison = {f"full_{k}": v for k, v in time_training_steps(full, training_data, lr, config, device,
+                                                                 config.compare_steps).items()}
+    comparison["full_artifact_mb"] = state_dict_mb(full.state_dict())
+    del full
 
+    peft = prepare_finetune(copy.deepcopy(model), config)
+    mode = config.finetune
+    comparison.update({f"{mode}_{k}": v for k, v in time_training_steps(peft, training_data, lr, config, device,
+                                                                        config.compare_steps).items()})
+    comparison[f"{mode}_artifact_mb"] = state_dict_mb(trainable_state_dict(peft))
+    comparison[f"{mode}_trainable_params"] = sum(p.numel() for p in trainable_parameters(peft))
+    del peft
 
+    mlflow.log_metrics(comparison)
+    logging.info(f"Full fine-tuning vs {mode}: {comparison['full_step_time_ms']:.0f} vs "
+                 f"{comparison[f'{mode}_step_time_ms']:.0f} ms/step, optimizer state "
+                 f"{comparison['full_optimizer_state_mb']:.0f} vs {comparison[f'{mode}_optimizer_state_mb']:.1f} MB, "
+                 f"artifact {comparison['full_artifact_mb']:.0f} vs {comparison[f'{mode}_artifact_mb']:.1f} MB")
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
+    return comparison
 
-    logging.info("Training is finished")
 
-    components = {"model":model, "tokenizer":tokenizer}
+@step(enable_cache=True)
+@profiled
+def training_model(dataset_manifest: dict, epoch: int, lr: float,  num_of_labels,
+                   config: Optional[TrainingConfig] = None,
+                   base_model: Optional[BertForSequenceClassification] = None
+                   ) -> Tuple[Annotated[BertForSequenceClassification, "model"], Annotated[Optional[str], "adapter_path"]]:
+    """
+    Fine-tunes bert-base-uncased on the published training split. Given a `base_model` (incremental
+    mode) it warm-starts from that model instead and trains only on the new rows plus a replay sample.
+    With adapters (`config.finetune`) the returned model has them merged in, and only the adapter
+    weights are saved as the run's artifact; their file is the second output, for `evaluation_model`.
+    """
 
-    mlflow.transformers.log_model(transformers_model=components, task="text-classification", name="model")
-    
-    return model
+    config = config or TrainingConfig()
+    main_node = config.node_rank == 0
+
+    training_data = build_loader(dataset_manifest, "train")
+
+    if base_model is not None:
+        if base_model.config.num_labels != num_of_labels:
+            raise ValueError(f"Base model has {base_model.config.num_labels} labels, this run asks for {num_of_labels}")
+
+        new_rows = new_row_indices(dataset_manifest, "train")
+        if main_node:
+            mlflow.log_params({"incremental": True, "new_rows": len(new_rows), "replay_ratio": config.replay_ratio})
+        if not len(new_rows):
+            logging.warning("The last processing run added no training rows, keeping the base model as it is")
+            return base_model, None
+
+        rows = replay_indices(new_rows, len(training_data.dataset), config.replay_ratio, config.replay_seed)
+        logging.info(f"Incremental training on {len(new_rows)} new and {len(rows) - len(new_rows)} replayed rows "
+                     f"out of {len(training_data.dataset)}")
+        training_data = subset_loader(training_data, rows, shuffle=True)
+
+    validation_data = None
+    if config.early_stopping_patience:
+        training_data, validation_data = holdout_split(training_data, config.validation_fraction)
+
+    if main_node:
+        mlflow.log_param("loss_function", f"BCEWithLogitsLoss (pos_weight={class_pos_weight(training_data):.3f})"
+                         if config.class_weighted_loss else "BCEWithLogitsLoss (unweighted)")
 
+        train_size = len(training_data.dataset)
+        mlflow.log_param("train_size", train_size)
+        if validation_data is not None:
+            mlflow.log_params({"validation_size": len(validation_data.dataset),
+                               "early_stopping_patience": config.early_stopping_patience})
+        mlflow.log_params({"training_precision": config.precision,
+                           "grad_accum_steps": config.grad_accum_steps,
+                           "effective_batch_size": training_data.batch_sampler.batch_size
+                                                   * config.grad_accum_steps * config.world_size,
+                           "world_size": config.world_size,
+                           "num_nodes": config.num_nodes,
+                           "torch_compile": config.compile_model,
+                           "finetune": config.finetune})
+        if config.finetune == "lora":
+            mlflow.log_params({"lora_rank": config.lora_rank, "lora_alpha": config.lora_alpha,
+                               "lora_targets": ",".join(TARGET_MODULES)})
 
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if config.world_size == 1:
+        set_threads(config)
+        mlflow.log_params({"num_threads": torch.get_num_threads(),
+                           "interop_threads": torch.get_num_interop_threads()})
+
+    compare = main_node and config.finetune != "full" and config.compare_steps > 0
+    model = base_model
+    if model is None and (compare or config.world_size == 1):
+        model = BertForSequenceClassification.from_pretrained(BASE_MODEL, num_labels=num_of_labels)
+
+    if compare:
+        log_finetune_comparison(model, training_data, lr, config, device)
+
+    if config.world_size > 1:
+        model = train_distributed(training_data, validation_data, epoch, lr, num_of_labels, config, base_model)
+    else:
+        prepare_finetune(model, config)
+        model.to(device)
+        fit(model, training_data, epoch, lr, config, device, validation_data)
+
+    adapter_weights = None
+    if config.finetune != "full":
+        adapter_weights = trainable_state_dict(model)
+        # Everything downstream (evaluation, serving optimizations, distillation) gets a plain BERT
+        merge_lora(model)
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    logging.info("Training is finished")
+
+    adapter = None
+    if main_node:
+        # Adapters only stand on their own on top of the pristine base model they are merged into at serving time
+        if adapter_weights is not None and base_model is None:
+            path = save_adapter(adapter_weights, mlflow.active_run().info.run_id,
+                                {"method": config.finetune, "rank": config.lora_rank,
+                                 "alpha": config.lora_alpha, "targets": list(TARGET_MODULES),
+                                 "base_model": BASE_MODEL, "num_labels": num_of_labels})
+            # Evaluation deploys the adapter file instead of the merged weights
+            adapter = str(path)
+            mlflow.log_artifact(str(path), artifact_path="adapter")
+            mlflow.log_metric("artifact_mb", path.stat().st_size / 2**20)
+        else:
+            if adapter_weights is not None:
+                logging.info("Adapters were trained on a warm-started model, logging the full merged model")
+            components = {"model":model, "tokenizer":get_tokenizer()}
+
+            mlflow.transformers.log_model(transformers_model=components, task="text-classification", name="model")
+            mlflow.log_metric("artifact_mb", state_dict_mb(model.state_dict()))
+    
+    return model, adapter
@@ -1,7 +1,23 @@
 from typing import Annotated, Tuple
 from zenml import step
+import numpy as np
+
+
+def safe_divide(numerator, denominator):
+    "Element-wise division that returns 0.0 where the denominator is 0, for scalars and arrays alike."
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    result = np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape),
+                       where=denominator != 0)
+    return result.item() if result.ndim == 0 else result
+
 
 class Metrics:
+    """
+    Confusion-matrix metrics. TP, TN, FP and FN can be plain counts or arrays of counts
+    (for example one entry per decision threshold), and every metric is returned in
+    the same shape.
+    """
 
     def __init__(self, TP, TN, FP, FN):
         self.TP = TP
@@ -10,28 +26,58 @@ class Metrics:
         self.FN = FN
         
     def accuracy(self):
-        total = self.TP + self.TN + self.FP + self.FN
-        print("Total : ", total)
-        return (self.TP + self.TN) / total if total else 0.0
+        total = np.add(np.add(self.TP, self.TN), np.add(self.FP, self.FN))
+        return safe_divide(np.add(self.TP, self.TN), total)
     
     def precision(self):
-        denom = self.TP + self.FP
-        return self.TP / denom if denom else 0.0
+        return safe_divide(self.TP, np.add(self.TP, self.FP))
     
     def recall(self):
-        denom = self.TP + self.FN
-        return self.TP / denom if denom else 0.0
+        return safe_divide(self.TP, np.add(self.TP, self.FN))
+
+    def false_positive_rate(self):
+        return safe_divide(self.FP, np.add(self.FP, self.TN))
     
     def f1_score(self, precision = None, recall= None):
-        print("Precision : ", precision)
-        print("Recall : ", recall)
         if precision is None:
             precision = self.precision()
         if recall is None:
             recall = self.recall()
         
-        denom = precision + recall
-        return 2 * (precision * recall) / denom if denom else 0.0
+        return safe_divide(2 * np.multiply(precision, recall), np.add(precision, recall))
+
+
+def confusion_counts(predictions : np.ndarray, labels : np.ndarray) -> Tuple[int, int, int, int]:
+    "TP, TN, FP and FN of boolean (or 0/1) predictions against 0/1 labels."
+    predictions = np.asarray(predictions).astype(bool)
+    labels = np.asarray(labels).astype(bool)
+    TP = int((predictions & labels).sum())
+    TN = int((~predictions & ~labels).sum())
+    FP = int((predictions & ~labels).sum())
+    FN = int((~predictions & labels).sum())
+    return TP, TN, FP, FN
+
+
+def roc_auc(probs : np.ndarray, labels : np.ndarray) -> float:
+    """
+    Exact ROC-AUC from the Mann-Whitney rank statistic, with tied scores sharing their average rank.
+    Undefined (NaN) when the labels hold a single class.
+    """
+    probs = np.asarray(probs)
+    labels = np.asarray(labels).astype(bool)
+    positives = int(labels.sum())
+    negatives = len(labels) - positives
+    if positives == 0 or negatives == 0:
+        return float("nan")
+
+    _, inverse, counts = np.unique(probs, return_inverse=True, return_counts=True)
+    # Average rank of every distinct score: ranks of a tie group are consecutive
+    upper = np.cumsum(counts)
+    average_rank = upper - (counts - 1) / 2
+    ranks = average_rank[inverse]
+
+    return float((ranks[labels].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
     
 @step
 def confusion_matrix(TP : int, TN: int, FP: int , FN: int) -> Tuple[Annotated[float, "accuracy"],
@@ -46,4 +92,4 @@ def confusion_matrix(TP : int, TN: int, FP: int , FN: int) -> Tuple[Annotated[fl
     f1_score = metrics.f1_score(precision=precision, recall=recall)
 
     return accuracy, precision, recall, f1_score 
-        
\ No newline at end of file
+        